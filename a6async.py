@@ -0,0 +1,186 @@
+"""
+Background jobs for the imager application.
+
+This module contains the Job class returned by Filter.submit.  A job runs a
+filter in a worker thread, so that the thread that submitted it (such as the
+viewer) is not held up.  The job keeps track of how many rows are done, and
+can be cancelled.  Cancelling is cooperative: the filter checks for it after
+each row or band, and stops by raising a CancelledError.
+
+The worker thread never changes anything that the submitting thread uses.  It
+only makes the result.  The result is put in place by calling apply, in the
+thread that owns the image (usually the one that submitted the job).
+
+Each job is backed by a concurrent.futures.Future, so it works with the usual
+tools for futures.  In particular, asyncio code can await it with
+
+    await asyncio.wrap_future(job.getFuture())
+
+All jobs share a single worker thread, so they run one at a time, in order.
+"""
+import concurrent.futures
+import threading
+
+# The executor that runs the jobs
+_executor = None
+
+
+def getExecutor():
+    """
+    Returns the executor that runs the jobs, making it the first time.
+    """
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(1, 'a6async')
+    return _executor
+
+
+class Job(object):
+    """
+    A class representing a filter running in the background.
+
+    The job is started with start, and finishes with the result of the function
+    given to it (or its exception).  While it runs, the function reports its
+    progress with update, which is also where cancellation takes effect.  Once
+    it has finished, apply hands the result to the finish function given to
+    the initializer, in the thread that calls apply.
+    """
+    # Attribute _future: The future for the result of the job
+    # Invariant: _future is a Future, or None if the job has not started
+    #
+    # Attribute _callback: The function to call with the progress
+    # Invariant: _callback is None or a function taking two ints
+    #
+    # Attribute _done: The number of rows finished in the current pass
+    # Invariant: _done is an int, 0 <= _done <= _total
+    #
+    # Attribute _total: The number of rows in the current pass
+    # Invariant: _total is an int >= 0
+    #
+    # Attribute _cancelled: Whether the job has been asked to stop
+    # Invariant: _cancelled is an Event
+    #
+    # Attribute _finish: The function to call with the result in apply
+    # Invariant: _finish is None or a function taking one argument
+    #
+    # Attribute _applied: Whether apply has been called successfully
+    # Invariant: _applied is a bool
+
+    def getFuture(self):
+        """
+        Returns the future for the result of this job
+        """
+        return self._future
+
+    def getProgress(self):
+        """
+        Returns the tuple (done, total) of rows finished in the current pass
+        """
+        return (self._done, self._total)
+
+    def __init__(self, callback=None, finish=None):
+        """
+        Initializes a job that has not started yet.
+
+        Parameter callback: The function to call with the progress (see update)
+        Precondition: callback is None or a function taking two ints
+
+        Parameter finish: The function to call with the result (see apply)
+        Precondition: finish is None or a function taking one argument
+        """
+        assert callback is None or callable(callback), repr(callback)
+        assert finish is None or callable(finish), repr(finish)
+        self._future    = None
+        self._callback  = callback
+        self._done      = 0
+        self._total     = 0
+        self._cancelled = threading.Event()
+        self._finish    = finish
+        self._applied   = False
+
+    def start(self, func):
+        """
+        Starts running func() in the worker thread.
+
+        Parameter func: The work to do
+        Precondition: func is a function with no parameters
+        """
+        assert self._future is None, 'job already started'
+        self._future = getExecutor().submit(func)
+
+    def update(self, done, total):
+        """
+        Records that done of the total rows of the current pass are finished.
+
+        The progress callback (if any) is called with done and total.  If the
+        job has been cancelled, this raises a CancelledError instead, which
+        stops the work.
+
+        Parameter done: The number of rows finished
+        Precondition: done is an int, 0 <= done <= total
+
+        Parameter total: The number of rows in the pass
+        Precondition: total is an int >= 0
+        """
+        if self._cancelled.is_set():
+            raise concurrent.futures.CancelledError()
+        self._done  = done
+        self._total = total
+        if self._callback is not None:
+            self._callback(done, total)
+
+    def cancel(self):
+        """
+        Asks this job to stop.
+
+        A job that has not started yet never runs.  A running job stops at its
+        next update.  Either way, result raises a CancelledError.  A job that
+        has already finished is not affected.
+        """
+        self._cancelled.set()
+        if self._future is not None:
+            self._future.cancel()
+
+    def isCancelled(self):
+        """
+        Returns True if this job has been asked to stop, False otherwise
+        """
+        return self._cancelled.is_set()
+
+    def done(self):
+        """
+        Returns True if this job has finished (or was cancelled), False otherwise
+        """
+        return self._future is not None and self._future.done()
+
+    def result(self, timeout=None):
+        """
+        Returns the result of this job, waiting for it to finish if needed.
+
+        This raises the exception of the job if it failed, a CancelledError if
+        it was cancelled, and a TimeoutError if it does not finish in time.
+
+        Parameter timeout: The most seconds to wait (None to wait forever)
+        Precondition: timeout is None or a number >= 0
+        """
+        return self._future.result(timeout)
+
+    def apply(self, timeout=None):
+        """
+        Returns the value of the finish function, called with the result of this job.
+
+        This waits for the job to finish first, and raises the same exceptions
+        as result if it does not.  The finish function runs in the thread that
+        calls this method, so it is safe for it to change what that thread owns.
+        A job can only be applied once.  If there is no finish function, this
+        is the same as result.
+
+        Parameter timeout: The most seconds to wait (None to wait forever)
+        Precondition: timeout is None or a number >= 0
+        """
+        assert not self._applied, 'job already applied'
+        value = self.result(timeout)
+        if self._finish is not None:
+            value = self._finish(value)
+        self._applied = True
+        return value
@@ -0,0 +1,277 @@
+"""
+Batch processing for the imager application.
+
+This module applies a chain of filters, and optionally hides a message with
+encode, to every image in a directory tree, without the viewer.  The images
+must be binary PPM (P6) or PAM (P7) files, which are memory-mapped (see
+Image.openMmap).  The results are written to a second directory tree with the
+same layout.
+
+Run it from the command line, giving the filters in order:
+
+    python a6batch.py photos/ out/ --filter invert --filter levels:10,200 --workers 8
+
+A filter is the name of a Filter method, followed by a colon and its arguments
+separated by commas if it has any (like monochromify:true).  Use --encode TEXT
+or --encode-file PATH to hide a message after the filters are applied.
+
+The files are handed to a pool of worker processes a few at a time, so the list
+of pending work stays small however many files there are.  A file is skipped if
+its output is newer than it (use --force to redo it).  The time for each file is
+printed as it finishes, followed by the overall number of images per second.
+If any file fails, the exit status is 1.
+"""
+import a6encode
+import a6filter
+import a6image
+import argparse
+import concurrent.futures
+import os
+import sys
+import time
+
+# The file extensions of the images to process
+EXTENSIONS = ('.ppm', '.pam')
+
+# The number of files given to each worker at once
+FILES_PER_WORKER = 2
+
+
+def parse_step(text):
+    """
+    Returns the applyPipeline step for the filter described by text.
+
+    The text is a Filter method name, optionally followed by a colon and a
+    comma-separated list of arguments.  Each argument is a bool (true or false),
+    an int or a float.  So 'levels:10,200' becomes ('levels', 10, 200).  This
+    raises ValueError if an argument is not one of these.
+
+    Parameter text: The filter description
+    Precondition: text is a string
+    """
+    assert type(text) == str
+    name, _, args = text.partition(':')
+    if args == '':
+        return name
+    return tuple([name]+[_parse_value(arg.strip()) for arg in args.split(',')])
+
+
+def check_steps(steps):
+    """
+    Checks that the steps are a valid filter chain, raising ValueError if not.
+
+    The chain is applied to a small blank image, so bad names and arguments are found
+    before any files are processed.
+
+    Parameter steps: The filter chain
+    Precondition: steps is a list of applyPipeline steps
+    """
+    try:
+        image = a6image.Image.fromBytes(bytes(3*64*64), 64)
+        a6filter.Filter(image).applyPipeline(steps)
+    except (AssertionError, AttributeError, TypeError, ValueError):
+        raise ValueError('invalid filter chain %r' % (steps,))
+
+
+def find_jobs(source, target, format='ppm'):
+    """
+    Returns a list of (input, output) paths for the images under source.
+
+    The output path is the same path relative to target, with the extension
+    for format.  The list is sorted so the files are processed in a fixed order.
+
+    Parameter source: The directory to search
+    Precondition: source is a string naming a directory
+
+    Parameter target: The directory for the results
+    Precondition: target is a string
+
+    Parameter format: The output file format
+    Precondition: format is 'ppm' or 'pam'
+    """
+    assert format in ('ppm', 'pam')
+    jobs = []
+    for (folder, dirs, files) in os.walk(source):
+        dirs.sort()
+        for name in sorted(files):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() in EXTENSIONS:
+                relative = os.path.relpath(os.path.join(folder, stem), source)
+                jobs.append((os.path.join(folder, name),
+                             os.path.join(target, relative+'.'+format)))
+    return jobs
+
+
+def is_current(path, output):
+    """
+    Returns True if output exists and is at least as new as path.
+
+    Parameter path: The input file
+    Precondition: path is a string naming an existing file
+
+    Parameter output: The output file
+    Precondition: output is a string
+    """
+    return os.path.exists(output) and os.path.getmtime(output) >= os.path.getmtime(path)
+
+
+def process(path, output, steps, text=None, format='ppm'):
+    """
+    Returns a result dictionary for applying steps (and encode) to one file.
+
+    The dictionary has the keys 'path', 'output', 'pixels', 'seconds' and
+    'error' (None if the file was processed).  Errors of any kind are reported
+    in the result instead of being raised, so one bad file does not stop the batch.
+
+    Parameter path: The image to process
+    Precondition: path is a string naming an existing file
+
+    Parameter output: The file to write the result to
+    Precondition: output is a string
+
+    Parameter steps: The filter chain
+    Precondition: steps is a list of applyPipeline steps
+
+    Parameter text: The message to hide, or None to skip encoding
+    Precondition: text is None or a string
+
+    Parameter format: The output file format
+    Precondition: format is 'ppm' or 'pam'
+    """
+    result = {'path': path, 'output': output, 'pixels': 0, 'seconds': 0.0, 'error': None}
+    start = time.perf_counter()
+    try:
+        image = a6image.Image.openMmap(path)
+        result['pixels'] = len(image)
+        editor = a6encode.Encoder(image)
+        editor.applyPipeline(steps)
+        if text is not None and not editor.encode(text):
+            raise ValueError('message does not fit in the image')
+        folder = os.path.dirname(output)
+        if folder != '':
+            os.makedirs(folder, exist_ok=True)
+        editor.getCurrent().saveRaw(output, format)
+    except Exception as e:
+        # Any failure (even a bug in a filter) only fails this one file
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+    result['seconds'] = time.perf_counter()-start
+    return result
+
+
+def run(jobs, steps, text=None, format='ppm', workers=1):
+    """
+    Yields the result dictionary for each job as it finishes (see process).
+
+    With one worker the jobs are processed in this process, in order.
+    Otherwise they are processed in a pool of worker processes, and at most
+    FILES_PER_WORKER*workers of them are pending at any time.
+
+    Parameter jobs: The (input, output) paths to process
+    Precondition: jobs is an iterable of pairs of strings
+
+    Parameter steps: The filter chain
+    Precondition: steps is a list of applyPipeline steps
+
+    Parameter text: The message to hide, or None to skip encoding
+    Precondition: text is None or a string
+
+    Parameter format: The output file format
+    Precondition: format is 'ppm' or 'pam'
+
+    Parameter workers: The number of worker processes
+    Precondition: workers is an int >= 1
+    """
+    assert type(workers) == int and workers >= 1
+    if workers == 1:
+        for (path, output) in jobs:
+            yield process(path, output, steps, text, format)
+        return
+
+    limit = FILES_PER_WORKER*workers
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        pending = set()
+        for (path, output) in jobs:
+            if len(pending) >= limit:
+                done, pending = concurrent.futures.wait(pending,
+                                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(pool.submit(process, path, output, steps, text, format))
+        for future in concurrent.futures.as_completed(pending):
+            yield future.result()
+
+
+def main():
+    """
+    Runs the batch described on the command line.
+
+    This exits with status 1 if any file failed.
+    """
+    parser = argparse.ArgumentParser(description='Filter and encode a tree of images.')
+    parser.add_argument('source', help='the directory of images to process')
+    parser.add_argument('target', help='the directory to write the results to')
+    parser.add_argument('--filter', action='append', default=[], dest='filters',
+                        help='a filter to apply, like invert or levels:10,200 (repeatable)')
+    parser.add_argument('--encode', help='a message to hide in each image')
+    parser.add_argument('--encode-file', help='a file holding the message to hide')
+    parser.add_argument('--format', choices=('ppm', 'pam'), default='ppm',
+                        help='the output file format')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='the number of worker processes')
+    parser.add_argument('--force', action='store_true',
+                        help='process files even if their output is up to date')
+    args = parser.parse_args()
+
+    try:
+        steps = [parse_step(text) for text in args.filters]
+        check_steps(steps)
+    except ValueError as e:
+        parser.error(str(e))
+    text = args.encode
+    if args.encode_file is not None:
+        with open(args.encode_file, encoding='utf-8') as file:
+            text = file.read()
+    if len(steps) == 0 and text is None:
+        parser.error('nothing to do (give --filter, --encode or --encode-file)')
+
+    jobs = find_jobs(args.source, args.target, args.format)
+    todo = [job for job in jobs if args.force or not is_current(*job)]
+    skipped = len(jobs)-len(todo)
+
+    start  = time.perf_counter()
+    done   = 0
+    failed = 0
+    for result in run(todo, steps, text, args.format, max(1, args.workers)):
+        if result['error'] is None:
+            done += 1
+            print('%8.3fs %s' % (result['seconds'], result['path']))
+        else:
+            failed += 1
+            print('  FAILED %s (%s)' % (result['path'], result['error']))
+    seconds = time.perf_counter()-start
+
+    rate = done/seconds if seconds > 0 else 0.0
+    print('%d images in %.2fs (%.2f images/sec), %d skipped, %d failed' %
+          (done, seconds, rate, skipped, failed))
+    if failed > 0:
+        sys.exit(1)
+
+
+# HELPER FUNCTIONS
+def _parse_value(text):
+    """
+    Returns the bool, int or float written in text, raising ValueError if none.
+
+    Parameter text: The value to parse
+    Precondition: text is a string
+    """
+    if text.lower() in ('true', 'false'):
+        return text.lower() == 'true'
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+if __name__ == '__main__':
+    main()
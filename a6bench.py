@@ -0,0 +1,388 @@
+"""
+Benchmarks for the imager application.
+
+By default, this module times the geometric transforms in Filter (transpose, 
+rotateLeft and rotateRight) against the original pixel-at-a-time versions, 
+which are kept here for comparison.  With --all, it instead times every Filter
+method, Encoder.encode and decode, Image.copy, the Image initializer and 
+__str__.  For each image size and aspect ratio it reports the throughput (in 
+megapixels per second) and the peak memory allocated while the operation runs.
+
+Run it from the command line, giving the image sizes in megapixels:
+
+    python a6bench.py --sizes 1,4,16,50
+
+The original versions are very slow on large images, so they can be skipped
+with --no-legacy.
+
+The test images are the same on every run, and each timing is the best of
+--repeat runs, so results are comparable between runs.  Use --json to save the
+results, and --baseline to compare them with a saved run.  Any operation that
+got slower (or used more memory) by more than --threshold is flagged as a 
+regression, and the exit status is then 1.
+"""
+import a6encode
+import a6filter
+import a6image
+import a6vector
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+# The image sizes to benchmark by default (in megapixels)
+DEFAULT_SIZES = [1, 4, 16, 50]
+
+# The image sizes for the full suite by default (__str__ makes huge strings)
+SUITE_SIZES = [0.1, 0.5, 2]
+
+# The fraction by which an operation may get worse before it is a regression
+DEFAULT_THRESHOLD = 0.1
+
+
+# ORIGINAL VERSIONS (FOR COMPARISON)
+def _legacy_transpose(current):
+    """
+    Transposes current one pixel at a time (the original Filter.transpose)
+
+    Parameter current: The image to transpose
+    Precondition: current is an Image
+    """
+    original = current.copy()
+    current.setWidth(current.getHeight())
+    for row in range(current.getHeight()):
+        for col in range(current.getWidth()):
+            current.setPixel(row,col,original.getPixel(col,row))
+
+
+def _legacy_rotateRight(current):
+    """
+    Rotates current right one pixel at a time (the original Filter.rotateRight)
+
+    Parameter current: The image to rotate
+    Precondition: current is an Image
+    """
+    original = current.copy()
+    current.setWidth(current.getHeight())
+    for row in range(current.getHeight()):
+        for col in range(current.getWidth()):
+            current.setPixel(row,col,original.getPixel(original.getHeight()-col-1,row))
+
+
+def _legacy_rotateLeft(current):
+    """
+    Rotates current left one pixel at a time (the original Filter.rotateLeft)
+
+    Parameter current: The image to rotate
+    Precondition: current is an Image
+    """
+    original = current.copy()
+    current.setWidth(current.getHeight())
+    for row in range(current.getHeight()):
+        for col in range(current.getWidth()):
+            current.setPixel(row,col,original.getPixel(col,original.getWidth()-row-1))
+
+
+# BENCHMARK FUNCTIONS
+def make_image(megapixels, aspect=1.0):
+    """
+    Returns a test image with about the given number of megapixels.
+
+    The pixels follow a simple pattern, so making the image is fast.
+
+    Parameter megapixels: The image size
+    Precondition: megapixels is a number > 0
+
+    Parameter aspect: The ratio of width to height
+    Precondition: aspect is a number > 0
+    """
+    pixels = int(megapixels*1000000)
+    height = max(1, int((pixels/aspect)**0.5))
+    width  = max(1, pixels // height)
+    data   = bytes(range(256))*(3*width*height // 256 + 1)
+    return a6image.Image.fromBytes(data[:3*width*height], width)
+
+
+def _fresh(image):
+    """
+    Returns a copy of image that owns all of its tiles.
+
+    Unlike image.copy(), the copy does not share tiles with image, so writing 
+    to it does not trigger copy-on-write (which would be counted as memory 
+    used by the function being measured).
+
+    Parameter image: The image to copy
+    Precondition: image is an Image
+    """
+    data = image.region(0, 0, image.getHeight(), image.getWidth()).read()
+    return a6image.Image.fromBytes(data, image.getWidth())
+
+
+def measure(func, image, repeat=1):
+    """
+    Returns the tuple (seconds, peak) for calling func(image).
+
+    The function is called on copies of image: repeat times to time it (the 
+    best time is used), and once with tracemalloc on to find the peak number of
+    bytes allocated (tracing slows the code down, so it is not timed).
+
+    Parameter func: The function to measure
+    Precondition: func is a function taking an Image
+
+    Parameter image: The image to run it on
+    Precondition: image is an Image
+
+    Parameter repeat: The number of timed runs
+    Precondition: repeat is an int > 0
+    """
+    seconds = None
+    for run in range(repeat):
+        subject = _fresh(image)
+        start = time.perf_counter()
+        func(subject)
+        elapsed = time.perf_counter()-start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+    subject = _fresh(image)
+    tracemalloc.start()
+    func(subject)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (seconds, peak)
+
+
+def bench_transforms(sizes, legacy=True, aspects=(1.0, 1.5), repeat=1):
+    """
+    Returns a list of results for the geometric transforms.
+
+    Each result is a dictionary with the keys 'op', 'version', 'megapixels',
+    'aspect', 'seconds', 'mpx_per_sec' and 'peak_bytes'.
+
+    Parameter sizes: The image sizes to use (in megapixels)
+    Precondition: sizes is a list of numbers > 0
+
+    Parameter legacy: Whether to also measure the original versions
+    Precondition: legacy is a bool
+
+    Parameter aspects: The width to height ratios to use
+    Precondition: aspects is a sequence of numbers > 0
+
+    Parameter repeat: The number of timed runs of each transform
+    Precondition: repeat is an int > 0
+    """
+    versions = [('blocked', {
+        'transpose':   lambda image: a6filter._Proxy(image).transpose(),
+        'rotateRight': lambda image: a6filter._Proxy(image).rotateRight(),
+        'rotateLeft':  lambda image: a6filter._Proxy(image).rotateLeft(),
+    })]
+    if legacy:
+        versions.append(('legacy', {
+            'transpose':   _legacy_transpose,
+            'rotateRight': _legacy_rotateRight,
+            'rotateLeft':  _legacy_rotateLeft,
+        }))
+
+    results = []
+    for size in sizes:
+        for aspect in aspects:
+            image = make_image(size, aspect)
+            for (version, funcs) in versions:
+                for op in ('transpose', 'rotateRight', 'rotateLeft'):
+                    seconds, peak = measure(funcs[op], image, repeat)
+                    results.append({'op': op, 'version': version, 'megapixels': len(image)/1e6,
+                                    'aspect': aspect, 'seconds': seconds,
+                                    'mpx_per_sec': len(image)/1e6/seconds, 'peak_bytes': peak})
+    return results
+
+
+def suite_operations(image):
+    """
+    Returns a dictionary of the operations in the full suite for the given image.
+
+    Each value is a function taking a fresh copy of image (see measure).  The 
+    encode and decode operations hide a message in up to a tenth of the pixels.
+    The initializer is given a pixel list that is made here, so making the 
+    list is not counted.
+
+    Parameter image: The test image
+    Precondition: image is an Image
+    """
+    width  = image.getWidth()
+    pixels = image.getData()
+    text   = ('The quick brown fox jumps over the lazy dog. '*(len(image)//450+1))
+    text   = text[:max(0, min(len(image)//10, 999999))]
+    encoded = _fresh(image)
+    a6encode._Proxy(encoded).encode(text)
+
+    ops = {}
+    for name in ('invert', 'transpose', 'reflectHori', 'reflectVert', 'rotateLeft', 
+                 'rotateRight', 'jail', 'vignette'):
+        ops[name] = lambda subject, name=name: getattr(a6filter._Proxy(subject), name)()
+    ops['monochromify'] = lambda subject: a6filter._Proxy(subject).monochromify(False)
+    ops['sepia']     = lambda subject: a6filter._Proxy(subject).monochromify(True)
+    ops['levels']    = lambda subject: a6filter._Proxy(subject).levels(16, 240)
+    ops['gamma']     = lambda subject: a6filter._Proxy(subject).gamma(2.2)
+    ops['posterize'] = lambda subject: a6filter._Proxy(subject).posterize(4)
+    ops['pipeline']  = lambda subject: a6filter._Proxy(subject).applyPipeline(['invert', 
+                                                    ('monochromify', True), 'vignette'])
+    ops['encode']    = lambda subject: a6encode._Proxy(subject).encode(text)
+    ops['decode']    = lambda subject: a6encode._Proxy(encoded).decode()
+    ops['copy']      = lambda subject: subject.copy()
+    ops['init']      = lambda subject: a6image.Image(pixels, width)
+    ops['str']       = lambda subject: str(subject)
+    return ops
+
+
+def bench_suite(sizes, aspects=(1.0, 1.5), repeat=1):
+    """
+    Returns a list of results for the full suite (see suite_operations).
+
+    The results are dictionaries as for bench_transforms, with the version 
+    'current'.
+
+    Parameter sizes: The image sizes to use (in megapixels)
+    Precondition: sizes is a list of numbers > 0
+
+    Parameter aspects: The width to height ratios to use
+    Precondition: aspects is a sequence of numbers > 0
+
+    Parameter repeat: The number of timed runs of each operation
+    Precondition: repeat is an int > 0
+    """
+    results = []
+    for size in sizes:
+        for aspect in aspects:
+            image = make_image(size, aspect)
+            for (op, func) in suite_operations(image).items():
+                seconds, peak = measure(func, image, repeat)
+                results.append({'op': op, 'version': 'current', 'megapixels': len(image)/1e6,
+                                'aspect': aspect, 'seconds': seconds,
+                                'mpx_per_sec': len(image)/1e6/seconds, 'peak_bytes': peak})
+    return results
+
+
+def save_results(path, results):
+    """
+    Saves benchmark results to the given JSON file.
+
+    The file also records the Python version, the platform and whether the 
+    NumPy kernels were used, since those all change the timings.
+
+    Parameter path: The file to write
+    Precondition: path is a string
+
+    Parameter results: The results to save
+    Precondition: results is a list of dictionaries (see bench_transforms)
+    """
+    data = {'python': platform.python_version(), 'platform': platform.platform(),
+            'numpy': a6vector.isEnabled(), 'results': results}
+    with open(path, 'w') as file:
+        json.dump(data, file, indent=1)
+
+
+def load_results(path):
+    """
+    Returns the list of benchmark results saved in the given JSON file.
+
+    Parameter path: The file to read
+    Precondition: path is a string naming a file written by save_results
+    """
+    with open(path) as file:
+        return json.load(file)['results']
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Returns a list of the regressions in results compared to baseline.
+
+    Results are matched by operation, version, size and aspect ratio (results 
+    with no match are ignored).  A result is a regression if its time or peak 
+    memory is more than (1+threshold) times the baseline.  Each regression is 
+    a tuple (result, base, field), where field is 'seconds' or 'peak_bytes'.
+
+    Parameter results: The new results
+    Precondition: results is a list of dictionaries (see bench_transforms)
+
+    Parameter baseline: The results to compare against
+    Precondition: baseline is a list of dictionaries (see bench_transforms)
+
+    Parameter threshold: The fraction by which a result may be worse
+    Precondition: threshold is a number >= 0
+    """
+    key = lambda item: (item['op'], item['version'], round(item['megapixels'], 3), item['aspect'])
+    bases = {key(item): item for item in baseline}
+    regressions = []
+    for item in results:
+        base = bases.get(key(item))
+        if base is None:
+            continue
+        for field in ('seconds', 'peak_bytes'):
+            if item[field] > base[field]*(1+threshold):
+                regressions.append((item, base, field))
+    return regressions
+
+
+def report(results, regressions=()):
+    """
+    Prints a table of benchmark results, followed by any regressions.
+
+    Parameter results: The results to print
+    Precondition: results is a list of dictionaries (see bench_transforms)
+
+    Parameter regressions: The regressions to flag
+    Precondition: regressions is a list of tuples (see compare)
+    """
+    print('%-12s %-8s %8s %6s %10s %10s %12s' % ('op','version','MP','aspect','seconds','MP/s','peak MB'))
+    for item in results:
+        print('%-12s %-8s %8.2f %6.2f %10.3f %10.2f %12.1f' % (item['op'], item['version'],
+              item['megapixels'], item['aspect'], item['seconds'], item['mpx_per_sec'],
+              item['peak_bytes']/1e6))
+    for (item, base, field) in regressions:
+        print('REGRESSION %s %s %.2f MP aspect %.2f: %s %.4g -> %.4g (%+.0f%%)' % (item['op'],
+              item['version'], item['megapixels'], item['aspect'], field, base[field],
+              item[field], 100*(item[field]/base[field]-1) if base[field] else 100.0))
+
+
+def main():
+    """
+    Runs the benchmarks given on the command line.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the imager operations.')
+    parser.add_argument('--sizes', help='comma-separated image sizes in megapixels')
+    parser.add_argument('--aspects', default='1,1.5',
+                        help='comma-separated width to height ratios')
+    parser.add_argument('--no-legacy', action='store_true',
+                        help='skip the original pixel-at-a-time versions')
+    parser.add_argument('--all', action='store_true',
+                        help='run the full suite instead of just the transforms')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='the number of timed runs (the best is kept)')
+    parser.add_argument('--json', help='save the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with results saved by --json')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='the fraction worse than the baseline that is flagged')
+    args = parser.parse_args()
+
+    sizes = args.sizes or ','.join(map(str, SUITE_SIZES if args.all else DEFAULT_SIZES))
+    sizes = [float(size) for size in sizes.split(',')]
+    aspects = [float(aspect) for aspect in args.aspects.split(',')]
+    repeat  = max(1, args.repeat)
+    if args.all:
+        results = bench_suite(sizes, aspects, repeat)
+    else:
+        results = bench_transforms(sizes, not args.no_legacy, aspects, repeat)
+
+    regressions = []
+    if args.baseline is not None:
+        regressions = compare(results, load_results(args.baseline), args.threshold)
+    report(results, regressions)
+    if args.json is not None:
+        save_results(args.json, results)
+    if len(regressions) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
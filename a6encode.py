@@ -12,6 +12,61 @@ Tiffany Yeung (ty272), Luke Shao (lys8)
 11/15/2022
 """
 import a6filter
+import a6vector
+import itertools
+import operator
+
+# The marker at the start of every hidden message
+MARKER = b'abc'
+
+# The marker at the end of a message in the legacy format (no header)
+TERMINATOR = b'%@('
+
+# The byte after MARKER that starts a header (it never starts UTF-8 text)
+HEADER_TAG = 0xFF
+
+# The header version for a message hidden as decimal digits
+VERSION = 1
+
+# The header version for a message packed into the low bits of each channel
+BITS_VERSION = 2
+
+# The number of bytes holding the message length in the header
+LENGTH_BYTES = 3
+
+# The number of bytes in a header: MARKER, HEADER_TAG, the version and the length
+HEADER_SIZE = len(MARKER)+2+LENGTH_BYTES
+
+# The number of bytes in a BITS_VERSION header, which adds the bits per channel
+BITS_HEADER_SIZE = HEADER_SIZE+1
+
+# The most low bits of each channel that can be used to hide a message
+MAX_BITS = 4
+
+# The three decimal digits of each byte value, as bytes
+_DIGITS = [bytes((value//100, value//10 % 10, value % 10)) for value in range(256)]
+
+# The last decimal digit of each channel value, as a translate table
+_LAST_DIGIT = bytes([value % 10 for value in range(256)])
+
+# For each digit, the table mapping a channel value to that value with its last
+# digit replaced (going down 10 if that is over 255), as in _encode_pixel
+_DIGIT_TABLES = [bytes([value-value % 10+digit if value-value % 10+digit <= 255 
+                        else value-value % 10+digit-10 for value in range(256)]) 
+                 for digit in range(10)]
+
+# For each number of bits (from 1), the translate table keeping the low bits 
+_LOW_BITS = [None]+[bytes([value & ((1 << bits)-1) for value in range(256)]) 
+                    for bits in range(1, MAX_BITS+1)]
+
+# For each number of bits (from 1), the binary text of each low-bits value
+_BIT_TEXT = [None]+[[format(value, '0%db' % bits) for value in range(1 << bits)]
+                    for bits in range(1, MAX_BITS+1)]
+
+# For each number of bits (from 1) and each low-bits value, the table mapping a
+# channel value to that value with its low bits replaced
+_BIT_TABLES = [None]+[[bytes([value & ~((1 << bits)-1) | low for value in range(256)])
+                       for low in range(1 << bits)] for bits in range(1, MAX_BITS+1)]
 
 
 class Encoder(a6filter.Filter):
@@ -26,6 +81,38 @@ class Encoder(a6filter.Filter):
     Both the `encode` and `decode` methods should work with the most recent
     image in the edit history.
     """
+    # Attribute _bits: The number of low bits of each channel used by encode
+    # Invariant: _bits is an int, 0 <= _bits <= MAX_BITS (0 for decimal digits)
+    _bits = 0
+    
+    # GETTERS AND SETTERS
+    def getBits(self):
+        """
+        Returns the number of low bits of each channel used by encode.
+        
+        This is 0 (the default) if the message is hidden as decimal digits.
+        """
+        return self._bits
+    
+    def setBits(self, value):
+        """
+        Sets the number of low bits of each channel used by encode.
+        
+        With 0 (the default), each byte is hidden in a pixel as three decimal
+        digits.  Otherwise the bits of the message are packed into the value
+        lowest bits of each channel, one channel after another.  A message then
+        needs 8/(3*value) pixels per byte, so with 3 or 4 bits it fits in fewer
+        pixels than with decimal digits, and changes fewer pixels.  With 1 or
+        2 bits it needs more pixels, but each channel changes by less.
+        
+        The header of the message records how it is hidden, so decode works
+        the same in either case.
+        
+        Parameter value: The number of bits per channel
+        Precondition: value is an int, 0 <= value <= MAX_BITS
+        """
+        assert type(value) == int and 0 <= value <= MAX_BITS, repr(value)
+        self._bits = value
     
     def encode(self, text):
         """
@@ -39,6 +126,19 @@ class Encoder(a6filter.Filter):
         
         This allows the encode method to support all text, including emoji.
         
+        The bytes are hidden one per pixel, starting at the first pixel, as 
+        the last decimal digit of each color channel (see _encode_pixel).  They
+        come after a header of HEADER_SIZE bytes: the marker 'abc', the byte 
+        HEADER_TAG, the header version and the number of bytes in the message
+        (big-endian).  All of the pixels are changed in a single pass, instead
+        of one at a time.
+        
+        If the bits per channel are set (see setBits), the header instead has 
+        the version BITS_VERSION and the number of bits (before the length), 
+        and the bits of the message are packed into the low bits of the 
+        channels after it.  The guarantee below holds for 3 or 4 bits, but
+        with 1 or 2 bits a message needs more pixels than it has bytes.
+        
         If the text UTF-8 encoding requires more than 999999 bytes or the 
         picture does  not have enough pixels to store these bytes this method
         returns False without storing the message. However, if the number of
@@ -51,21 +151,32 @@ class Encoder(a6filter.Filter):
         """
         assert type(text) == str
         current = self.getCurrent()
-        start = 'abc'
-        x = list(start.encode('utf-8')) 
-        blist = list(text.encode('utf-8'))
-        end = '%@('
-        y = list(end.encode('utf-8'))
+        blist = text.encode('utf-8')
 
         if len(blist) > 999999:
             return False
-        if len(x) + len(y) + len(blist) > len(current):
+        
+        bits = self._bits
+        if bits == 0:
+            header = MARKER+bytes([HEADER_TAG, VERSION])
+        else:
+            header = MARKER+bytes([HEADER_TAG, BITS_VERSION, bits])
+        header += len(blist).to_bytes(LENGTH_BYTES, 'big')
+        if len(header) + _payload_pixels(len(blist), bits) > len(current):
             return False
-
-        newlist = x + blist + y
         
-        for i in range(len(newlist)):
-            self._encode_pixel(i, newlist[i])
+        # Hide every byte in one pass over the pixels holding the payload
+        self._noteEdit('encode')
+        pixels = _read_pixels(current, 0, len(header)+_payload_pixels(len(blist), bits))
+        size   = 3*len(header)
+        if bits == 0:
+            data = _embed_digits(pixels, header+blist)
+        else:
+            channels = _payload_channels(len(blist), bits)
+            data = (_embed_digits(pixels[:size], header)+
+                    _embed_bits(pixels[size:size+channels], blist, bits)+
+                    pixels[size+channels:])
+        _write_pixels(current, 0, data)
         
         return True
 
@@ -85,25 +196,75 @@ class Encoder(a6filter.Filter):
             
             text = bytes(blist).decode('utf-8')
         
+        The pixels of the header are read at once.  If they start with a 
+        header (see encode), the message is read in one slice of exactly the 
+        length in the header, as decimal digits or as packed bits, whichever
+        the header says.  If they start with the marker 'abc' but no 
+        header, the message is in the legacy format, which ends with '%@(' 
+        instead (see _decodeLegacy).  Otherwise there is no message, which is
+        known without reading any more pixels.
+        
         If no message is detected, or if there is an error in decoding the
         message, this method returns None
         """
         # You may modify anything in the above specification EXCEPT
         # The first line (Returns the secret...)
         # The last paragraph (If no message is detected...)
-        pass    # Implement me
         current = self.getCurrent()
-        start = 'abc'
-        end = '%@('
-        endlist = list(end.encode('utf-8'))
+        pixels = _read_pixels(current, 0, min(BITS_HEADER_SIZE, len(current)))
+        head = _extract_digits(pixels[:3*(len(MARKER)+1)])
+        if head is None or head[:len(MARKER)] != MARKER:
+            return None
+        if len(head) <= len(MARKER) or head[len(MARKER)] != HEADER_TAG:
+            return self._decodeLegacy()
+        
+        head = _extract_digits(pixels[:3*(len(MARKER)+2)])
+        if head is None or len(head) < len(MARKER)+2:
+            return None
+        if head[-1] == VERSION:
+            size = HEADER_SIZE
+        elif head[-1] == BITS_VERSION:
+            size = BITS_HEADER_SIZE
+        else:
+            return None
+        head = _extract_digits(pixels[:3*size])
+        if head is None or len(head) < size:
+            return None
+        bits = 0 if size == HEADER_SIZE else head[len(MARKER)+2]
+        if size == BITS_HEADER_SIZE and not 1 <= bits <= MAX_BITS:
+            return None
+        
+        length = int.from_bytes(head[size-LENGTH_BYTES:size], 'big')
+        if size + _payload_pixels(length, bits) > len(current):
+            return None
+        data = _read_pixels(current, size, _payload_pixels(length, bits))
+        if bits == 0:
+            blist = _extract_digits(data)
+        else:
+            blist = _extract_bits(data[:_payload_channels(length, bits)], length, bits)
+        if blist is None:
+            return None
+        try:
+            return blist.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+    
+    # HELPER METHODS
+    def _decodeLegacy(self):
+        """
+        Returns the message stored in the current image in the legacy format.
+        
+        In that format there is no header.  The message comes right after the
+        marker 'abc' and ends with the marker '%@('.  So the pixels are read 
+        one at a time until the end marker is found.
+        
+        If no message is detected, or if there is an error in decoding the
+        message, this method returns None
+        """
+        endlist = list(TERMINATOR)
 
         bytelist = [self._decode_pixel(0), self._decode_pixel(1), self._decode_pixel(2)]
-        newstart = bytes(bytelist).decode('utf-8')
-
-        if newstart != start:
-            return None
         
-        #newlist = []
         position = 3
         while True:
             y = self._decode_pixel(position)
@@ -113,14 +274,12 @@ class Encoder(a6filter.Filter):
             if position >= len(self.getCurrent()):
                 return None
             if bytelist[-3:] == endlist:
-                if bytelist == start+end:
-                    return ''
                 returnlist = bytelist[3:(len(bytelist)-3)]
-                new = bytes(returnlist)
-                return new.decode('utf-8')
-                
-            
-    # HELPER METHODS
+                try:
+                    return bytes(returnlist).decode('utf-8')
+                except ValueError:
+                    return None
+    
     def _decode_pixel(self, pos):
         """
         Return: the number n hidden in pixel pos of the current image.
@@ -175,4 +334,184 @@ class Encoder(a6filter.Filter):
         rgb = (red, green, blue)
         current[pos] = rgb
         return current[pos]
-    
\ No newline at end of file
+    
+
+
+class _Proxy(a6filter._Proxy, Encoder):
+    """
+    An Encoder that works directly on a single image, with no edit history.
+    
+    This is the Encoder version of a6filter._Proxy.
+    """
+    pass
+
+
+# HELPER FUNCTIONS
+def _embed_digits(data, payload):
+    """
+    Returns the packed pixels in data with the bytes of payload hidden in them.
+    
+    Byte i of payload is hidden in pixel i, exactly as by Encoder._encode_pixel.
+    If NumPy is available, the vectorized version in a6vector is used.
+    
+    Parameter data: The packed pixels
+    Precondition: data is a bytes object with 3*len(payload) bytes
+    
+    Parameter payload: The bytes to hide
+    Precondition: payload is a bytes object
+    """
+    if a6vector.isEnabled():
+        return a6vector.embedDigits(data, payload)
+    digits = b''.join(map(_DIGITS.__getitem__, payload))
+    return bytes(map(operator.getitem, map(_DIGIT_TABLES.__getitem__, digits), data))
+
+
+def _extract_digits(data):
+    """
+    Returns the bytes hidden in the packed pixels in data, or None if invalid.
+    
+    This is the inverse of _embed_digits.  The value in each pixel is read as
+    by Encoder._decode_pixel.  If any pixel holds a value over 255, it is not a
+    byte, and this returns None.  If NumPy is available, the vectorized version
+    in a6vector is used.
+    
+    Parameter data: The packed pixels
+    Precondition: data is a bytes object
+    """
+    if a6vector.isEnabled():
+        return a6vector.extractDigits(data)
+    digits = data.translate(_LAST_DIGIT)
+    values = [100*red+10*green+blue for (red, green, blue) 
+              in zip(digits[0::3], digits[1::3], digits[2::3])]
+    if len(values) > 0 and max(values) > 255:
+        return None
+    return bytes(values)
+
+
+def _embed_bits(data, payload, bits):
+    """
+    Returns the channels in data with the bits of payload packed into them.
+    
+    The bits of the payload (highest bit of each byte first) are split into 
+    groups of the given size, which replace the low bits of the channels in
+    order.  The last group is padded with zeros.  If NumPy is available, the
+    vectorized version in a6vector is used.
+    
+    Parameter data: The channels to change
+    Precondition: data is a bytes object with _payload_channels(len(payload), bits)
+    bytes
+    
+    Parameter payload: The bytes to hide
+    Precondition: payload is a bytes object
+    
+    Parameter bits: The number of low bits of each channel to use
+    Precondition: bits is an int, 1 <= bits <= MAX_BITS
+    """
+    if a6vector.isEnabled():
+        return a6vector.embedBits(data, payload, bits)
+    if len(payload) == 0:
+        return data
+    text = format(int.from_bytes(payload, 'big'), '0%db' % (8*len(payload)))
+    text += '0'*(-len(text) % bits)
+    groups = bytes(map(int, map(''.join, zip(*[iter(text)]*bits)), itertools.repeat(2)))
+    return bytes(map(operator.getitem, map(_BIT_TABLES[bits].__getitem__, groups), data))
+
+
+def _extract_bits(data, length, bits):
+    """
+    Returns the bytes packed into the low bits of the channels in data.
+    
+    This is the inverse of _embed_bits.  If NumPy is available, the vectorized
+    version in a6vector is used.
+    
+    Parameter data: The channels to read
+    Precondition: data is a bytes object with _payload_channels(length, bits) bytes
+    
+    Parameter length: The number of bytes packed into data
+    Precondition: length is an int >= 0
+    
+    Parameter bits: The number of low bits of each channel used
+    Precondition: bits is an int, 1 <= bits <= MAX_BITS
+    """
+    if a6vector.isEnabled():
+        return a6vector.extractBits(data, length, bits)
+    if length == 0:
+        return b''
+    text = ''.join(map(_BIT_TEXT[bits].__getitem__, data.translate(_LOW_BITS[bits])))
+    return int(text[:8*length], 2).to_bytes(length, 'big')
+
+
+def _payload_channels(length, bits):
+    """
+    Returns the number of channels that hold a message of the given length.
+    
+    Parameter length: The number of bytes in the message
+    Precondition: length is an int >= 0
+    
+    Parameter bits: The number of low bits of each channel used
+    Precondition: bits is an int, 1 <= bits <= MAX_BITS
+    """
+    return -(-8*length // bits)
+
+
+def _payload_pixels(length, bits):
+    """
+    Returns the number of pixels that hold a message of the given length.
+    
+    Parameter length: The number of bytes in the message
+    Precondition: length is an int >= 0
+    
+    Parameter bits: The number of low bits of each channel used (0 for digits)
+    Precondition: bits is an int, 0 <= bits <= MAX_BITS
+    """
+    if bits == 0:
+        return length
+    return -(-_payload_channels(length, bits) // 3)
+
+
+def _read_pixels(image, start, count):
+    """
+    Returns the packed pixels at positions start..start+count-1 of image.
+    
+    The positions are as for the 1d list view of image.  The pixels are read 
+    as one slice of the rows that hold them.
+    
+    Parameter image: The image to read
+    Precondition: image is an Image
+    
+    Parameter start: The position of the first pixel
+    Precondition: start is an int, 0 <= start <= len(image)
+    
+    Parameter count: The number of pixels
+    Precondition: count is an int, 0 <= count <= len(image)-start
+    """
+    width = image.getWidth()
+    first = start // width
+    rows  = -(-(start+count) // width)-first
+    data  = image.region(first, 0, rows, width).read()
+    offset = 3*(start-first*width)
+    return data[offset:offset+3*count]
+
+
+def _write_pixels(image, start, data):
+    """
+    Overwrites the pixels of image starting at position start with data.
+    
+    This is the inverse of _read_pixels.
+    
+    Parameter image: The image to change
+    Precondition: image is an Image
+    
+    Parameter start: The position of the first pixel
+    Precondition: start is an int, 0 <= start <= len(image)
+    
+    Parameter data: The packed pixels
+    Precondition: data is a bytes object with at most 3*(len(image)-start) bytes
+    """
+    width  = image.getWidth()
+    first  = start // width
+    rows   = -(-(start+len(data)//3) // width)-first
+    region = image.region(first, 0, rows, width)
+    pixels = region.read()
+    offset = 3*(start-first*width)
+    region.write(pixels[:offset]+data+pixels[offset+len(data):])
@@ -10,13 +10,753 @@ of the undo functionality. You do not have to do anything special to take
 advantage of this.  Just make sure you use getCurrent() to access the most 
 recent version of the image.
 
+The point filters (invert, monochromify and vignette) are written as kernels.
+A kernel is a function that takes the packed pixels of a band of whole rows and
+returns the new pixels for that band.  This lets several filters be fused into
+a single pass over the image (see applyPipeline).  If NumPy is installed, the 
+vectorized kernels in a6vector are used instead of the Python kernels here.  The
+results are identical either way.
+
 Based on an original file by Dexter Kozen (dck10) and Walker White (wmw2)
 
 Tiffany Yeung (ty272), Luke Shao (lys8)
 11/15/22
 """
+import a6async
 import a6editor
+import a6history
+import a6image
+import a6parallel
+import a6vector
+import array
+import collections
 import math
+import threading
+
+# The side (in pixels) of the blocks used by the geometric transforms
+BLOCK_SIZE = 64
+
+# The number of pixels in each band of rows given to a kernel
+BAND_PIXELS = 1 << 18
+
+# The smallest image (in pixels) worth splitting between worker processes
+PARALLEL_PIXELS = 1 << 20
+
+# The color of the bars drawn by jail
+JAIL_COLOR = (255, 0, 0)
+
+# The most pixels in the proxy image used by the preview mode
+PREVIEW_PIXELS = 1 << 20
+
+# The shortest side of a proxy image (so that jail has room for its bars)
+PREVIEW_SIDE = 8
+
+# The most bytes of vignette masks kept by a MaskCache by default
+MASK_BYTES = 64 << 20
+
+# The filters that can be fused into a single pass by applyPipeline
+KERNEL_FILTERS = ('invert', 'monochromify', 'vignette', 'applyTables', 'levels', 
+                  'gamma', 'posterize')
+
+# The filters that applyPipeline runs as a pass of their own
+OTHER_FILTERS = ('transpose', 'reflectHori', 'reflectVert', 'rotateLeft', 
+                 'rotateRight', 'jail')
+
+
+def _reverse_pixels(data):
+    """
+    Returns the packed pixels in data in reverse order.
+    
+    The pixels are reversed as whole 3-byte groups, so the color channels of
+    each pixel stay in the order red, green, blue.
+    
+    Parameter data: The packed pixels to reverse
+    Precondition: data is a bytes-like object whose length is a multiple of 3
+    """
+    result = bytearray(len(data))
+    result[0::3] = data[-3::-3]
+    result[1::3] = data[-2::-3]
+    result[2::3] = data[-1::-3]
+    return result
+
+
+def _transpose_pixels(data, width):
+    """
+    Returns the transpose of the block of packed pixels in data.
+    
+    The block has the given width, and its height is the number of pixels 
+    divided by width.  The result is a block of height width and width height,
+    where pixel (row, col) is pixel (col, row) of the original.  Each row of 
+    the result is a column of the original, which is read with one extended
+    slice per color channel.
+    
+    Parameter data: The packed pixels of the block, in row-major order
+    Precondition: data is a bytes-like object whose length is a multiple of 3*width
+    
+    Parameter width: The width of the block
+    Precondition: width is an int > 0
+    """
+    height = len(data) // (3*width)
+    step   = 3*width
+    size   = 3*height
+    result = bytearray(len(data))
+    for col in range(width):
+        start = col*size
+        result[start:start+size:3]   = data[3*col::step]
+        result[start+1:start+size:3] = data[3*col+1::step]
+        result[start+2:start+size:3] = data[3*col+2::step]
+    return result
+
+
+# LOOKUP TABLES
+# A lookup table is a bytes object of length 256.  Entry v is the new value of a
+# color channel whose old value is v.  Tables are applied with bytes.translate,
+# which maps a whole buffer through the table in C.
+_INVERT_TABLE = bytes(range(255, -1, -1))
+
+# The brightness weight of each channel value (so 0.3*red is _RED_WEIGHTS[red])
+_RED_WEIGHTS   = [0.3*value for value in range(256)]
+_GREEN_WEIGHTS = [0.6*value for value in range(256)]
+_BLUE_WEIGHTS  = [0.1*value for value in range(256)]
+
+
+def _jail_columns(width):
+    """
+    Returns the list of left columns of the vertical bars drawn by jail.
+    
+    There are n+2 bars, where n is (width - 8) // 50, spaced as evenly as 
+    possible from column 0 to column width-4.
+    
+    Parameter width: The image width
+    Precondition: width is an int >= 4
+    """
+    n = (width-8)//50
+    dist = width-4
+    x = dist/(n+1)
+    return [int(round(i*x)) for i in range(n+2)]
+
+
+def _make_table(func):
+    """
+    Returns the lookup table for the given function on channel values.
+    
+    Each value func(v) is converted to an int and clamped to 0..255.
+    
+    Parameter func: The function to tabulate
+    Precondition: func is a function taking an int in 0..255 and returning a number
+    """
+    return bytes([min(255, max(0, int(func(value)))) for value in range(256)])
+
+
+def _is_table(table):
+    """
+    Returns True if table is a lookup table, False otherwise.
+    
+    Parameter table: The value to check
+    Precondition: NONE (table can be anything)
+    """
+    return type(table) in (bytes, bytearray) and len(table) == 256
+
+
+# KERNELS
+# Each kernel has the parameters (data, row, width, height, ...) where data is the
+# packed pixels of a band of whole rows, row is the first row of the band, and
+# width and height are the size of the whole image.  It returns the new packed
+# pixels of the band.
+def _invert_kernel(data, row, width, height):
+    """
+    Returns the color complement of the pixels in data.
+    
+    See Filter.invert for details.  The other parameters are described above.
+    """
+    return data.translate(_INVERT_TABLE)
+
+
+def _monochromify_kernel(data, row, width, height, sepia):
+    """
+    Returns the pixels in data converted to greyscale or sepia tone.
+    
+    See Filter.monochromify for details.  The other parameters are described above.
+    
+    Parameter sepia: Whether to use sepia tone instead of greyscale.
+    Precondition: sepia is a bool
+    """
+    # Looking up the weighted values gives the same floats as multiplying
+    rw = _RED_WEIGHTS
+    gw = _GREEN_WEIGHTS
+    bw = _BLUE_WEIGHTS
+    brightness = [rw[red] + gw[green] + bw[blue] for (red, green, blue)
+                  in zip(data[0::3], data[1::3], data[2::3])]
+    result = bytearray(len(data))
+    result[0::3] = bytes([int(value) for value in brightness])
+    if sepia:
+        result[1::3] = bytes([int(0.6*value) for value in brightness])
+        result[2::3] = bytes([int(0.4*value) for value in brightness])
+    else:
+        result[1::3] = result[0::3]
+        result[2::3] = result[0::3]
+    return result
+
+
+def _vignette_kernel(data, row, width, height, mask, first=0):
+    """
+    Returns the pixels in data darkened to simulate vignetting.
+    
+    See Filter.vignette for details.  The other parameters are described above.
+    
+    Parameter mask: The falloff factors for rows first and below
+    Precondition: mask is an array returned by _vignette_rows or 
+    _vignette_factors(width, height, first, stop, fixed) for stop past the band
+    
+    Parameter first: The image row of the first factors in mask
+    Precondition: first is an int, 0 <= first <= row
+    """
+    start   = (row-first)*width
+    factors = mask[start:start+len(data)//3]
+    result  = bytearray(len(data))
+    for channel in range(3):
+        values = zip(data[channel::3], factors)
+        if mask.typecode == 'd':
+            result[channel::3] = bytes([int(value*factor) for (value, factor) in values])
+        else:
+            result[channel::3] = bytes([(value*factor) >> 16 for (value, factor) in values])
+    return result
+
+
+def _tables_kernel(data, row, width, height, red, green, blue):
+    """
+    Returns the pixels in data with each channel mapped through a lookup table.
+    
+    See Filter.applyTables for details.  The other parameters are described above.
+    
+    Parameter red: The table for the red channel
+    Precondition: red is a lookup table (bytes of length 256)
+    
+    Parameter green: The table for the green channel
+    Precondition: green is a lookup table (bytes of length 256)
+    
+    Parameter blue: The table for the blue channel
+    Precondition: blue is a lookup table (bytes of length 256)
+    """
+    if red == green == blue:
+        return data.translate(red)
+    
+    result = bytearray(len(data))
+    result[0::3] = data[0::3].translate(red)
+    result[1::3] = data[1::3].translate(green)
+    result[2::3] = data[2::3].translate(blue)
+    return result
+
+
+# The Python version of each kernel
+_KERNELS = {'invert': _invert_kernel, 'monochromify': _monochromify_kernel,
+            'vignette': _vignette_kernel, 'tables': _tables_kernel}
+
+
+def getKernel(name):
+    """
+    Returns the kernel with the given name.
+    
+    The kernel comes from a6vector if it is enabled and has a version of it, and 
+    from this module otherwise.
+    
+    Parameter name: The kernel name
+    Precondition: name is one of 'invert', 'monochromify', 'vignette' or 'tables'
+    """
+    kernel = getattr(a6vector, name, None) if a6vector.isEnabled() else None
+    return _KERNELS[name] if kernel is None else kernel
+
+
+def kernelStep(name, args):
+    """
+    Returns the kernel step (kernel, args) for the given point filter.
+    
+    This checks the preconditions of the filter method and turns its 
+    arguments into the arguments of its kernel.  The tone curves all become
+    the 'tables' kernel with a table for each channel.
+    
+    Parameter name: The filter method name
+    Precondition: name is in KERNEL_FILTERS
+    
+    Parameter args: The arguments to the filter method
+    Precondition: args is a tuple
+    """
+    if name == 'invert' or name == 'vignette':
+        assert len(args) == 0
+        return (name, ())
+    elif name == 'monochromify':
+        assert len(args) == 1 and type(args[0]) == bool
+        return (name, args)
+    elif name == 'applyTables':
+        assert 1 <= len(args) <= 3
+        red = args[0]
+        green = args[1] if len(args) > 1 and args[1] is not None else red
+        blue  = args[2] if len(args) > 2 and args[2] is not None else red
+        assert _is_table(red) and _is_table(green) and _is_table(blue)
+        return ('tables', (bytes(red), bytes(green), bytes(blue)))
+    elif name == 'levels':
+        low, high = args
+        assert type(low) == int and type(high) == int
+        assert 0 <= low < high <= 255
+        table = _make_table(lambda value: (value-low)*255 // (high-low))
+    elif name == 'gamma':
+        (value,) = args
+        assert type(value) in (int, float) and value > 0
+        table = _make_table(lambda v: 255*(v/255)**(1/value)+0.5)
+    elif name == 'posterize':
+        (levels,) = args
+        assert type(levels) == int and 2 <= levels <= 256
+        table = _make_table(lambda value: value*levels // 256 * 255 // (levels-1))
+    else:
+        assert False, repr(name)
+    return ('tables', (table, table, table))
+
+
+# SIMPLIFYING DEFERRED FILTERS
+# Where each transform sends the pixel at (row, col) of an image of size height x width.
+# The result is (row, col, height, width) in the transformed image.
+_DIHEDRAL = {
+    'transpose':   lambda r, c, h, w: (c, r, w, h),
+    'reflectHori': lambda r, c, h, w: (r, w-1-c, h, w),
+    'reflectVert': lambda r, c, h, w: (h-1-r, c, h, w),
+    'rotateRight': lambda r, c, h, w: (c, h-1-r, w, h),
+    'rotateLeft':  lambda r, c, h, w: (w-1-c, r, w, h),
+    '_rotate180':  lambda r, c, h, w: (h-1-r, w-1-c, h, w),
+}
+
+# The identity lookup table
+_IDENTITY_TABLE = bytes(range(256))
+
+
+def _dihedral_key(names):
+    """
+    Returns a key identifying the transform made by applying names in order.
+    
+    Two sequences of transforms have the same key exactly when they move every 
+    pixel to the same place.  The key is where the sequence sends each pixel of
+    a 2x3 image; since that image is not square, no two of the eight transforms
+    agree on it.
+    
+    Parameter names: The transforms to apply
+    Precondition: names is a sequence of keys of _DIHEDRAL
+    """
+    points = [(r, c, 2, 3) for r in range(2) for c in range(3)]
+    for name in names:
+        move   = _DIHEDRAL[name]
+        points = [move(*point) for point in points]
+    return tuple(points)
+
+
+# The cheapest way to make each of the eight transforms, indexed by _dihedral_key
+_DIHEDRAL_FORMS = {_dihedral_key(form): form for form in [(), ('transpose',), 
+                   ('reflectHori',), ('reflectVert',), ('rotateRight',), ('rotateLeft',),
+                   ('_rotate180',), ('transpose', '_rotate180')]}
+
+
+def _simplify_plan(plan):
+    """
+    Returns a plan that has the same result as plan, but with fewer passes.
+    
+    See Filter.materialize for the simplifications.  Nothing is merged across
+    an 'increment' or a 'finish', since they are boundaries between steps of 
+    the history.
+    
+    Parameter plan: The filters to simplify
+    Precondition: plan is a list of pairs (name, step) (see Filter._runPlan)
+    """
+    result = []
+    names  = []
+    colors = []
+    for (name, step) in plan:
+        if name in _DIHEDRAL:
+            names.append(name)
+        elif step is not None and step[0] != 'vignette':
+            _add_color(colors, step)
+        else:
+            result.extend(_merged_plan(names, colors))
+            result.append((name, step))
+            names  = []
+            colors = []
+    result.extend(_merged_plan(names, colors))
+    return result
+
+
+def _add_color(colors, step):
+    """
+    Adds the kernel step for a color filter to the end of colors.
+    
+    An invert becomes lookup tables, and lookup tables right after other 
+    lookup tables are composed with them instead of being added.
+    
+    Parameter colors: The kernel steps of the color filters so far
+    Precondition: colors is a list of kernel steps
+    
+    Parameter step: The kernel step to add
+    Precondition: step is the kernel step of a color filter (not vignette)
+    """
+    if step[0] == 'invert':
+        step = ('tables', (_INVERT_TABLE,)*3)
+    if step[0] == 'tables' and len(colors) > 0 and colors[-1][0] == 'tables':
+        first  = colors.pop()[1]
+        step   = ('tables', tuple([a.translate(b) for (a, b) in zip(first, step[1])]))
+    colors.append(step)
+
+
+def _merged_plan(names, colors):
+    """
+    Returns the plan for a run of transforms and color filters.
+    
+    The transforms are merged into one (see _DIHEDRAL_FORMS) and done first, 
+    followed by the color filters.  Tables that do nothing are dropped, and 
+    tables that invert every channel become an invert.
+    
+    Parameter names: The transforms in the run, in order
+    Precondition: names is a list of keys of _DIHEDRAL
+    
+    Parameter colors: The kernel steps of the color filters in the run, in order
+    Precondition: colors is a list of kernel steps (see _add_color)
+    """
+    result = [(name, None) for name in _DIHEDRAL_FORMS[_dihedral_key(names)]]
+    for step in colors:
+        if step[0] != 'tables':
+            result.append((step[0], step))
+        elif step[1] == (_INVERT_TABLE,)*3:
+            result.append(('invert', ('invert', ())))
+        elif step[1] != (_IDENTITY_TABLE,)*3:
+            result.append(('applyTables', step))
+    return result
+
+
+# The lock that guards the deferred filters of a Filter while it replays them
+_PENDING_LOCK = threading.Lock()
+
+
+def _make_proxy(image, maxpixels):
+    """
+    Returns a downscaled copy of image with at most maxpixels pixels.
+    
+    The copy takes every 2^k-th pixel of every 2^k-th row, for the smallest k
+    that makes it small enough.  Only the rows that are used are read.  A side
+    is never made shorter than PREVIEW_SIDE, so a filter that works on image 
+    does not fail on the copy.  So a very long, thin image can have a copy with 
+    more than maxpixels pixels.
+    
+    Parameter image: The image to downscale
+    Precondition: image is an Image
+    
+    Parameter maxpixels: The most pixels in the copy
+    Precondition: maxpixels is an int > 0
+    """
+    width  = image.getWidth()
+    height = image.getHeight()
+    step = 1
+    while -(-width // step) * -(-height // step) > maxpixels:
+        if min(-(-width // (2*step)), -(-height // (2*step))) < PREVIEW_SIDE:
+            break
+        step *= 2
+    if step == 1:
+        return image.copy()
+    
+    size   = -(-width // step)
+    buffer = bytearray()
+    line   = bytearray(3*size)
+    for row in range(0, height, step):          # Loop over the rows used
+        data = image.row(row).getRow(0)
+        line[0::3] = data[0::3*step]
+        line[1::3] = data[1::3*step]
+        line[2::3] = data[2::3*step]
+        buffer += line
+    return a6image.Image.fromBuffer(buffer, size)
+
+
+def _vignette_factors(width, height, start, stop, fixed, quadrant=False):
+    """
+    Returns the vignette factors for rows start..stop-1 of an image.
+    
+    The factors are computed with the same expression as the original
+    pixel-by-pixel vignette, so they are bit-for-bit the same.  Rows row and
+    height-row are the same distance from the center, so a row whose mirror 
+    has already been computed is copied instead.  The same goes for columns
+    col and width-col, so if quadrant is True, only the columns 0..width//2
+    are computed (see _vignette_rows for the others).
+    
+    Parameter width: The image width
+    Precondition: width is an int > 0
+    
+    Parameter height: The image height
+    Precondition: height is an int > 0
+    
+    Parameter start: The first row
+    Precondition: start is an int, 0 <= start <= stop
+    
+    Parameter stop: The row after the last one
+    Precondition: stop is an int, start <= stop <= height
+    
+    Parameter fixed: Whether to use fixed-point factors (see MaskCache)
+    Precondition: fixed is a bool
+    
+    Parameter quadrant: Whether to compute only the left half of each row
+    Precondition: quadrant is a bool
+    """
+    hfD  = (((width**2) + (height**2))**0.5)/2
+    cols = [(width/2-col)**2 for col in range(width//2+1 if quadrant else width)]
+    size = len(cols)
+    mask = array.array('I' if fixed else 'd')
+    for row in range(start, stop):
+        if start <= height-row < row:
+            # The mirror row has already been computed
+            pos = (height-row-start)*size
+            mask.extend(mask[pos:pos+size])
+            continue
+        
+        rowterm = (height/2-row)**2
+        factors = [1 - (((col+rowterm)**0.5) / hfD)**2 for col in cols]
+        if fixed:
+            factors = [int(factor*65536) if factor > 0 else 0 for factor in factors]
+        mask.extend(factors)
+    return mask
+
+
+def _vignette_rows(mask, width, height, start, stop, fixed):
+    """
+    Returns the vignette factors for rows start..stop-1 of an image.
+    
+    The result is the same as _vignette_factors(width, height, start, stop, 
+    fixed).  If mask is not None, the factors are copied from it, using the
+    mirror rows and columns for those past the center.  Otherwise they are
+    computed.
+    
+    Parameter mask: The upper left quarter of the factors (see MaskCache.getMask)
+    Precondition: mask is None or a mask for width, height and fixed
+    
+    Parameter width: The image width
+    Precondition: width is an int > 0
+    
+    Parameter height: The image height
+    Precondition: height is an int > 0
+    
+    Parameter start: The first row
+    Precondition: start is an int, 0 <= start <= stop
+    
+    Parameter stop: The row after the last one
+    Precondition: stop is an int, start <= stop <= height
+    
+    Parameter fixed: Whether to use fixed-point factors (see MaskCache)
+    Precondition: fixed is a bool
+    """
+    if mask is None:
+        return _vignette_factors(width, height, start, stop, fixed)
+    
+    size   = width//2+1
+    right  = width-size
+    result = array.array(mask.typecode)
+    for row in range(start, stop):
+        pos  = (row if 2*row <= height else height-row)*size
+        line = mask[pos:pos+size]
+        result.extend(line)
+        result.extend(line[right:0:-1])     # Column col is column width-col
+    return result
+
+
+class MaskCache(object):
+    """
+    A class that caches the falloff masks used by Filter.vignette.
+    
+    The darkening factor of each pixel in a vignette depends only on the size of
+    the image.  So the factors are computed once for each (width, height) and 
+    kept in an array (the mask).  Vignetting an image of the same size again is
+    then just a multiplication per channel.  The factors are the same in each 
+    quarter of the image (mirrored), so a mask only holds the upper left 
+    quarter, and the factors for each band of rows are copied out of it (see
+    _vignette_rows).
+    
+    The cache keeps at most maxsize masks, and at most maxbytes bytes of them,
+    dropping the least recently used ones when it is full.  A mask bigger than
+    maxbytes is not made at all, and the factors are computed for each band 
+    instead.  So the memory used is bounded however big the image is.  The 
+    cache counts hits and misses so that the sizes can be tuned.
+    
+    Normally a mask holds the factors as floats, which gives exactly the same 
+    result as computing them on the fly.  A fixed-point cache instead stores 
+    each factor as an int scaled by 2^16, which uses half the memory but can 
+    make a channel value one less than the exact result.
+    """
+    # Attribute _masks: The cached masks, from least to most recently used
+    # Invariant: _masks is an OrderedDict mapping (width, height) to an array
+    # of the factors for rows 0..height//2 and columns 0..width//2, in 
+    # row-major order
+    #
+    # Attribute _maxsize: The maximum number of masks to keep
+    # Invariant: _maxsize is an int >= 0
+    #
+    # Attribute _maxbytes: The maximum bytes of masks to keep
+    # Invariant: _maxbytes is an int >= 0
+    #
+    # Attribute _bytes: The bytes used by the cached masks
+    # Invariant: _bytes is the sum of the sizes of the arrays in _masks
+    #
+    # Attribute _fixed: Whether masks use fixed-point factors
+    # Invariant: _fixed is a bool.  The masks have typecode 'I' if it is True,
+    # and 'd' otherwise.
+    #
+    # Attribute _hits: The number of requests for a cached mask
+    # Invariant: _hits is an int >= 0
+    #
+    # Attribute _misses: The number of requests that computed a new mask
+    # Invariant: _misses is an int >= 0
+    
+    def getMaxSize(self):
+        """
+        Returns the maximum number of masks kept by this cache
+        """
+        return self._maxsize
+    
+    def setMaxSize(self, value):
+        """
+        Sets the maximum number of masks kept by this cache.
+        
+        If the cache has too many masks, the least recently used are dropped.
+        
+        Parameter value: The new maximum
+        Precondition: value is an int >= 0
+        """
+        assert type(value) == int and value >= 0
+        self._maxsize = value
+        self._evict()
+    
+    def getMaxBytes(self):
+        """
+        Returns the maximum bytes of masks kept by this cache
+        """
+        return self._maxbytes
+    
+    def setMaxBytes(self, value):
+        """
+        Sets the maximum bytes of masks kept by this cache.
+        
+        If the masks use more, the least recently used are dropped.
+        
+        Parameter value: The new maximum
+        Precondition: value is an int >= 0
+        """
+        assert type(value) == int and value >= 0
+        self._maxbytes = value
+        self._evict()
+    
+    def getBytes(self):
+        """
+        Returns the bytes used by the masks in this cache
+        """
+        return self._bytes
+    
+    def isFixed(self):
+        """
+        Returns True if this cache uses fixed-point masks, False otherwise
+        """
+        return self._fixed
+    
+    def getHits(self):
+        """
+        Returns the number of requests that found their mask in the cache
+        """
+        return self._hits
+    
+    def getMisses(self):
+        """
+        Returns the number of requests that had to compute their mask
+        """
+        return self._misses
+    
+    def __init__(self, maxsize=4, fixed=False, maxbytes=MASK_BYTES):
+        """
+        Initializes an empty mask cache.
+        
+        Parameter maxsize: The maximum number of masks to keep
+        Precondition: maxsize is an int >= 0
+        
+        Parameter fixed: Whether to use fixed-point masks
+        Precondition: fixed is a bool
+        
+        Parameter maxbytes: The maximum bytes of masks to keep
+        Precondition: maxbytes is an int >= 0
+        """
+        assert type(maxsize) == int and maxsize >= 0
+        assert type(fixed) == bool
+        assert type(maxbytes) == int and maxbytes >= 0
+        self._masks    = collections.OrderedDict()
+        self._maxsize  = maxsize
+        self._maxbytes = maxbytes
+        self._bytes    = 0
+        self._fixed    = fixed
+        self._hits     = 0
+        self._misses   = 0
+    
+    def getMask(self, width, height):
+        """
+        Returns the vignette mask for an image of the given size, or None.
+        
+        The mask is an array of the factors for rows 0..height//2 and columns
+        0..width//2 in row-major order (use _vignette_rows to get the factors
+        for any rows).  The factor for (row, col) is 1 - (d / hfD)^2, as 
+        described in vignette.  If the mask would be bigger than the maximum 
+        bytes, the value returned is None (which counts as a miss).
+        
+        Parameter width: The image width
+        Precondition: width is an int > 0
+        
+        Parameter height: The image height
+        Precondition: height is an int > 0
+        """
+        key  = (width, height)
+        mask = self._masks.get(key)
+        if mask is not None:
+            self._hits += 1
+            self._masks.move_to_end(key)
+            return mask
+        
+        self._misses += 1
+        size = (height//2+1)*(width//2+1)*array.array('I' if self._fixed else 'd').itemsize
+        if size > self._maxbytes:
+            return None
+        mask = self._compute(width, height)
+        if self._maxsize > 0:
+            self._masks[key] = mask
+            self._bytes += size
+            self._evict()
+        return mask
+    
+    def clear(self):
+        """
+        Removes every mask from this cache (the counts are not reset).
+        """
+        self._masks.clear()
+        self._bytes = 0
+    
+    # HELPER METHODS
+    def _compute(self, width, height):
+        """
+        Returns a new vignette mask for an image of the given size.
+        
+        Parameter width: The image width
+        Precondition: width is an int > 0
+        
+        Parameter height: The image height
+        Precondition: height is an int > 0
+        """
+        return _vignette_factors(width, height, 0, height//2+1, self._fixed, True)
+    
+    def _evict(self):
+        """
+        Drops the least recently used masks until the limits are met.
+        """
+        while len(self._masks) > self._maxsize or self._bytes > self._maxbytes:
+            mask = self._masks.popitem(last=False)[1]
+            self._bytes -= len(mask)*mask.itemsize
+
+
+# The mask cache used by Filter.vignette
+VIGNETTE_MASKS = MaskCache()
+
 
 class Filter(a6editor.Editor):
     """
@@ -34,91 +774,291 @@ class Filter(a6editor.Editor):
     
     Each one of the non-hidden functions should edit the most recent image 
     in the edit history (which is inherited from Editor).
+    
+    The point filters can run in several worker processes at once (see 
+    setWorkers).  By default they run in this process only.  Filters can also be
+    deferred, so that they are simplified and applied only when the image is
+    needed (see setDeferred).
     """
+    # Attribute _workers: The number of worker processes for the point filters
+    # Invariant: _workers is an int >= 1 (1 means no worker processes)
+    _workers = 1
+    #
+    # Attribute _deferred: Whether filters are recorded instead of applied
+    # Invariant: _deferred is a bool
+    _deferred = False
+    #
+    # Attribute _pending: The deferred filters, not yet applied to the current image
+    # Invariant: _pending is a list of pairs (name, step), where name is in 
+    # KERNEL_FILTERS or OTHER_FILTERS and step is the kernel step for name (or
+    # None if name is not in KERNEL_FILTERS).  A pair ('increment', None) is 
+    # a call to increment made in preview mode, and a pair ('finish', None) is
+    # where undo took one back (the step before it ends there, see undo).
+    _pending = []
+    #
+    # Attribute _replaying: The thread applying filters at full resolution
+    # Invariant: _replaying is the thread identifier, or None if no thread is
+    # applying them.  Filters called by that thread are never deferred.
+    _replaying = None
+    #
+    # Attribute _thread: The background thread started by replay
+    # Invariant: _thread is a Thread, or None if replay has not started one
+    _thread = None
+    #
+    # Attribute _proxy: The downscaled copy of the current image used for preview
+    # Invariant: _proxy is an Image with every filter so far applied to it, or
+    # None if the preview mode is off
+    _proxy = None
+    #
+    # Attribute _maxpixels: The most pixels in the proxy image
+    # Invariant: _maxpixels is an int > 0
+    _maxpixels = PREVIEW_PIXELS
+    #
+    # Attribute _snapshots: The proxy image before each deferred filter
+    # Invariant: _snapshots is a list of Images, one per element of _pending
+    # in preview mode (and empty otherwise)
+    _snapshots = []
+    #
+    # Attribute _edits: The compact undo history (see a6history)
+    # Invariant: _edits is a History, or None if it has not been needed yet
+    _edits = None
+    #
+    # Attribute _job: The job that this filter is running for (see submit)
+    # Invariant: _job is a Job, or None if this filter is not running a job
+    _job = None
+    
+    # GETTERS AND SETTERS
+    def getHistoryBudget(self):
+        """
+        Returns the most bytes that the undo history may use
+        """
+        return self._getEdits().getBudget()
+    
+    def setHistoryBudget(self, value):
+        """
+        Sets the most bytes that the undo history may use.
+        
+        The history keeps each step as the inverse filters, or as the 
+        compressed changes to the tiles of the image (see a6history).  When it
+        goes over this budget, the oldest steps are dropped and can no longer
+        be undone.
+        
+        Parameter value: The budget in bytes
+        Precondition: value is an int >= 0
+        """
+        self._getEdits().setBudget(value)
+    
+    def isDeferred(self):
+        """
+        Returns True if filters are deferred, False if they are applied at once
+        """
+        return self._deferred
+    
+    def setDeferred(self, value):
+        """
+        Sets whether filters are deferred.
+        
+        In deferred mode, the filter methods (and applyPipeline) only record 
+        what to do.  The image is not changed until getCurrent is called, 
+        which is when it is displayed, encoded or saved.  At that point the 
+        recorded filters are simplified and applied (see materialize).
+        
+        Turning deferred mode off does not apply the recorded filters; they are
+        still applied by the next call to getCurrent.
+        
+        Parameter value: Whether to defer filters
+        Precondition: value is a bool
+        """
+        assert type(value) == bool, repr(value)
+        self._deferred = value
+    
+    def isPreview(self):
+        """
+        Returns True if the preview mode is on, False otherwise
+        """
+        return self._proxy is not None
+    
+    def setPreview(self, value, maxpixels=PREVIEW_PIXELS):
+        """
+        Sets whether the preview mode is on.
+        
+        In preview mode, the current image is kept as a downscaled proxy of at
+        most maxpixels pixels (see getPreview).  Each filter is applied to the
+        proxy at once, so the preview is updated in time proportional to the
+        proxy size, not the image size.  The filters are also deferred, as in
+        deferred mode, and applied at full resolution when getCurrent is 
+        called (as when saving or encoding) or in the background (see replay).
+        increment and undo make and take back the same steps as they would with
+        the filters applied at once.  undo of a step that has not been applied 
+        yet uses only the proxy.
+        
+        The proxy is a level of an image pyramid: every 2^k-th pixel of every 
+        2^k-th row, for the smallest k that fits.  Filters that depend on the 
+        image size (vignette and jail) are scaled to the proxy, so the preview
+        is only an approximation of the result.
+        
+        Turning the preview mode on applies any deferred filters first.  Turning
+        it off keeps the filters not yet applied; they are still applied by the
+        next call to getCurrent.
+        
+        Parameter value: Whether to use the preview mode
+        Precondition: value is a bool
+        
+        Parameter maxpixels: The most pixels in the proxy
+        Precondition: maxpixels is an int > 0
+        """
+        assert type(value) == bool, repr(value)
+        assert type(maxpixels) == int and maxpixels > 0, repr(maxpixels)
+        if value:
+            self._maxpixels = maxpixels
+            self._proxy = _make_proxy(self.getCurrent(), maxpixels)
+        else:
+            self._proxy = None
+        self._snapshots = []
+    
+    def getPreview(self):
+        """
+        Returns the image to display.
+        
+        This is the proxy image in preview mode, and the current image otherwise.
+        """
+        return self._proxy if self._proxy is not None else self.getCurrent()
+    
+    def getWorkers(self):
+        """
+        Returns the number of worker processes used by the point filters
+        """
+        return self._workers
+    
+    def setWorkers(self, value):
+        """
+        Sets the number of worker processes used by the point filters.
+        
+        With more than one worker, invert, monochromify, vignette, the tone 
+        curves and applyPipeline split large images into bands of rows and 
+        process the bands in a pool of worker processes (see a6parallel).  The
+        results are exactly the same as with one worker.
+        
+        Parameter value: The number of workers
+        Precondition: value is an int >= 1
+        """
+        assert type(value) == int and value >= 1, repr(value)
+        self._workers = value
     
     # PROVIDED ACTIONS (STUDY THESE)
     def invert(self):
         """
         Inverts the current image, replacing each element with its color complement
         """
-        current = self.getCurrent()
-        for pos in range(len(current)): # We can do this because of __len__
-            rgb = current[pos]          # We can do this because of __getitem__
-            red   = 255 - rgb[0]
-            green = 255 - rgb[1]
-            blue  = 255 - rgb[2]
-            rgb = (red,green,blue)      # New pixel value
-            current[pos] = rgb          # We can do this because of __setitem__
+        if self._record('invert', ()):
+            return
+        self._applyKernels([kernelStep('invert', ())])
     
     def transpose(self):
         """
         Transposes the current image
         
         Transposing is tricky, as it is hard to remember which values have been 
-        changed and which have not.  To simplify the process, we copy the 
-        current image and use that as a reference.  So we change the current 
-        image with setPixel, but read (with getPixel) from the copy.
+        changed and which have not.  For a square image, we work in place on
+        pairs of BLOCK_SIZE x BLOCK_SIZE blocks on opposite sides of the 
+        diagonal: we read both blocks, transpose them in memory and write each
+        into the other's place.  So no second copy of the image is needed.
+        
+        If the width and height have a large common divisor g (as photos with
+        a 3:2 or 4:3 shape do), we also work in place (see _transposeChunks).
+        
+        Otherwise, we copy the current image and use that as a reference (the
+        copy is copy-on-write, so it is cheap).  We read it a block at a time, 
+        transpose the block in memory, and write it to its place in the current
+        image.  Each tile that is written is duplicated (since it is shared with
+        the copy), so this needs memory for a second image, as the original 
+        pixel-at-a-time version did.  Working on small blocks keeps the data 
+        being moved in the cache, and keeps the other memory used small.
         """
-        current  = self.getCurrent()
+        if self._record('transpose', ()):
+            return
+        self._noteEdit('transpose')
+        current = self.getCurrent()
+        if current.getWidth() == current.getHeight():
+            self._transposeSquare()
+            return
+        if math.gcd(current.getWidth(), current.getHeight()) >= BLOCK_SIZE:
+            self._transposeChunks()
+            return
+        
         original = current.copy()
-        current.setWidth(current.getHeight())
+        width    = original.getWidth()
+        height   = original.getHeight()
+        current.setWidth(height)
         
-        for row in range(current.getHeight()):      # Loop over the rows
-            for col in range(current.getWidth()):   # Loop over the columnns
-                current.setPixel(row,col,original.getPixel(col,row))
+        for row in range(0, height, BLOCK_SIZE):    # Loop over the bands
+            size = min(BLOCK_SIZE, height-row)
+            for col in range(0, width, BLOCK_SIZE):
+                part  = min(BLOCK_SIZE, width-col)
+                block = original.region(row, col, size, part).read()
+                current.region(col, row, part, size).write(_transpose_pixels(block, part))
+            self._progress(row+size, height)
     
     def reflectHori(self):
         """
         Reflects the current image around the horizontal middle.
+        
+        Each row is read as a single packed strip, reversed in bulk, and 
+        written back.
         """
+        if self._record('reflectHori', ()):
+            return
+        self._noteEdit('reflectHori')
         current = self.getCurrent()
-        for h in range(current.getWidth()//2):      # Loop over the columnns
-            for row in range(current.getHeight()):  # Loop over the rows
-                k = current.getWidth()-1-h
-                current.swapPixels(row,h,row,k)
+        for row in range(current.getHeight()):      # Loop over the rows
+            strip = current.row(row)
+            strip.setRow(0,_reverse_pixels(strip.getRow(0)))
+            self._progress(row+1, current.getHeight())
     
     def rotateRight(self):
         """
-        Rotates the current image left by 90 degrees.
+        Rotates the current image right by 90 degrees.
         
-        Technically, we can implement this via a transpose followed by a 
-        vertical reflection. However, this is slow, so we use the faster 
-        strategy below.
+        This is a transpose followed by a horizontal reflection.  Both of these
+        work on blocks or whole rows at a time, so this is much faster than 
+        moving the pixels one at a time, and it is in place for square images.
         """
-        current  = self.getCurrent()
-        original = current.copy()
-        current.setWidth(current.getHeight())
-        
-        for row in range(current.getHeight()):      # Loop over the rows
-            for col in range(current.getWidth()):   # Loop over the columnns
-                current.setPixel(row,col,original.getPixel(original.getHeight()-col-1,row))
+        if self._record('rotateRight', ()):
+            return
+        self.transpose()
+        self.reflectHori()
     
     def rotateLeft(self):
         """
         Rotates the current image left by 90 degrees.
         
-        Technically, we can implement this via a transpose followed by a 
-        vertical reflection. However, this is slow, so we use the faster 
-        strategy below.
+        This is a transpose followed by a vertical reflection.  Both of these
+        work on blocks or whole rows at a time, so this is much faster than 
+        moving the pixels one at a time, and it is in place for square images.
         """
-        current  = self.getCurrent()
-        original = current.copy()
-        current.setWidth(current.getHeight())
-        
-        for row in range(current.getHeight()):      # Loop over the rows
-            for col in range(current.getWidth()):   # Loop over the columnns
-                current.setPixel(row,col,original.getPixel(col,original.getWidth()-row-1))
+        if self._record('rotateLeft', ()):
+            return
+        self.transpose()
+        self.reflectVert()
     
     # ASSIGNMENT METHODS (IMPLEMENT THESE)
     def reflectVert(self):
         """ 
         Reflects the current image around the vertical middle.
+        
+        This swaps whole rows at a time, using row views of the image.
         """
+        if self._record('reflectVert', ()):
+            return
+        self._noteEdit('reflectVert')
         current = self.getCurrent()
         for x in range(current.getHeight()//2):      # Loop over the rows
-            for col in range(current.getWidth()):  # Loop over the columns
-                k = current.getHeight()-1-x
-                current.swapPixels(x,col,k,col)
+            top    = current.row(x)
+            bottom = current.row(current.getHeight()-1-x)
+            temp   = top.getRow(0)
+            top.setRow(0,bottom.getRow(0))
+            bottom.setRow(0,temp)
+            self._progress(2*(x+1), current.getHeight())
 
  
     
@@ -138,22 +1078,9 @@ class Filter(a6editor.Editor):
         Parameter sepia: Whether to use sepia tone instead of greyscale.
         Precondition: sepia is a bool
         """
-        assert type(sepia) == bool
-        current = self.getCurrent()
-        for pos in range(len(current)): # We can do this because of __len__
-            rgb = current[pos]   
-            brightness = 0.3 * rgb[0] + 0.6 * rgb[1] + 0.1 * rgb[2]
-            red = int(brightness)
-            if sepia == True:
-                green = int(0.6*brightness)
-                blue = int(0.4*brightness)
-            else:
-                green = int(brightness)
-                blue = int(brightness)
-            rgb = (red,green,blue)      # New pixel value
-            current[pos] = rgb   
-
-  
+        if self._record('monochromify', (sepia,)):
+            return
+        self._applyKernels([kernelStep('monochromify', (sepia,))])
     
     def jail(self):
         """
@@ -170,18 +1097,15 @@ class Filter(a6editor.Editor):
         
         The n+2 vertical bars should be as evenly spaced as possible.
         """
+        if self._record('jail', ()):
+            return
+        self._noteEdit('jail')
         current = self.getCurrent()
-        pixel = (255, 0, 0)
+        pixel = JAIL_COLOR
         self._drawHBar(0, pixel)
         self._drawHBar((current.getHeight()-3), pixel)
-
-        n = (current.getWidth()-8)//50
-        dist = current.getWidth()-4
-        x = dist/(n+1)
-        for i in range(n+2):
-            self._drawVBar(int(round(i*x)), pixel)
-            
- 
+        for col in _jail_columns(current.getWidth()):
+            self._drawVBar(col, pixel)
     
     def vignette(self):
         """
@@ -198,25 +1122,646 @@ class Filter(a6editor.Editor):
         hfD (for half diagonal) is the distance from the center of the image 
         to any of the corners.  The values d and hfD should be left as floats
         and not converted to ints.
+        
+        The factors only depend on the size of the image, so they are taken 
+        from the mask cache VIGNETTE_MASKS (or computed a band at a time, if
+        the image is too big for it).
+        """
+        if self._record('vignette', ()):
+            return
+        self._applyKernels([kernelStep('vignette', ())])
+    
+    # TONE CURVES
+    def applyTables(self, red, green=None, blue=None):
+        """
+        Maps each color channel of the current image through a lookup table.
+        
+        A lookup table is a bytes object of length 256, where entry v is the 
+        new value for a channel whose value is v.  The tables are applied with
+        bytes.translate, so this runs at the speed of a memory copy.  Any tone
+        curve can be written as a table.
+        
+        Parameter red: The table for the red channel
+        Precondition: red is a lookup table (bytes of length 256)
+        
+        Parameter green: The table for the green channel (red if None)
+        Precondition: green is a lookup table or None
+        
+        Parameter blue: The table for the blue channel (red if None)
+        Precondition: blue is a lookup table or None
         """
+        if self._record('applyTables', (red, green, blue)):
+            return
+        self._applyKernels([kernelStep('applyTables', (red, green, blue))])
+    
+    def levels(self, low, high):
+        """
+        Stretches the channel values of the current image from low..high to 0..255.
+        
+        Values at or below low become 0, and values at or above high become 255.
+        
+        Parameter low: The value that becomes 0
+        Precondition: low is an int, 0 <= low < high
+        
+        Parameter high: The value that becomes 255
+        Precondition: high is an int, low < high <= 255
+        """
+        if self._record('levels', (low, high)):
+            return
+        self._applyKernels([kernelStep('levels', (low, high))])
+    
+    def gamma(self, value):
+        """
+        Applies gamma correction to the current image.
+        
+        Each channel value v becomes 255*(v/255)^(1/value), rounded.  A value 
+        above 1 brightens the midtones, and a value below 1 darkens them.
+        
+        Parameter value: The gamma
+        Precondition: value is a number > 0
+        """
+        if self._record('gamma', (value,)):
+            return
+        self._applyKernels([kernelStep('gamma', (value,))])
+    
+    def posterize(self, levels):
+        """
+        Reduces each color channel of the current image to the given number of levels.
+        
+        Parameter levels: The number of values per channel
+        Precondition: levels is an int, 2 <= levels <= 256
+        """
+        if self._record('posterize', (levels,)):
+            return
+        self._applyKernels([kernelStep('posterize', (levels,))])
+    
+    def applyPipeline(self, steps):
+        """
+        Applies a sequence of filters to the current image.
+        
+        Each step is either the name of a filter method (like 'invert') or a 
+        tuple of the name and its arguments (like ('monochromify', True)).  The
+        result is exactly the same as calling the methods one after the other.
+        
+        However, consecutive point filters (those in KERNEL_FILTERS) are fused:
+        each band of rows is read once, run through all of their kernels, and 
+        written back once.  So a stack of N point filters makes one pass over 
+        the image instead of N.  The filters in OTHER_FILTERS need the whole 
+        image, so each of them is run as a pass of its own.  Since this is a 
+        single method, the whole pipeline is also a single step in the edit 
+        history.
+        
+        Parameter steps: The filters to apply, in order
+        Precondition: steps is a list of filter names in KERNEL_FILTERS or
+        OTHER_FILTERS, or tuples of a name and the arguments for that method
+        """
+        assert type(steps) == list
+        plan = []
+        for step in steps:
+            name, args = (step, ()) if type(step) == str else (step[0], tuple(step[1:]))
+            assert name in KERNEL_FILTERS or name in OTHER_FILTERS, repr(name)
+            if not self._record(name, args):
+                plan.append((name, kernelStep(name, args) if name in KERNEL_FILTERS else None))
+        self._runPlan(plan)
+    
+    # BACKGROUND JOBS
+    def submit(self, name, *args, progress=None):
+        """
+        Returns a Job that applies a filter to the current image in the background.
+        
+        The filter is the method name with the given arguments.  It is run by a
+        worker thread on a copy of the current image (the copy shares tiles with
+        the image, so it is cheap to make).  This method returns at once, so a
+        slow filter does not hold up the caller.  Jobs are run one at a time, in
+        the order they are submitted.
+        
+        As the filter runs, the job is told how many rows of the image are done.
+        progress(done, total) is called with them, if it is given.  A filter 
+        that makes several passes (like rotateRight) reports each one in turn.
+        
+        The job can be cancelled at any time (see Job.cancel).  The filter stops
+        at the next row or band, and the current image is left untouched.  The 
+        worker thread never changes the current image or the edit history.  The
+        job's result is the filtered copy, and calling Job.apply (in the thread
+        that edits this filter) copies it into the current image and returns 
+        the current image.  The change then belongs to the open step of the 
+        edit history, as if the filter had been called at that point, so call
+        increment first to make it a step of its own.  If the current image was
+        changed while the job was running, Job.apply raises a RuntimeError 
+        instead.
+        
+        Use Job.getFuture with asyncio.wrap_future to await a job, and then 
+        call Job.apply.
+        
+        Parameter name: The filter method name
+        Precondition: name is in KERNEL_FILTERS or OTHER_FILTERS, or is 
+        'applyPipeline'
+        
+        Parameter args: The arguments to the filter method
+        Precondition: args are valid arguments for that method
+        
+        Parameter progress: The function to call with the rows done
+        Precondition: progress is None or a function taking two ints
+        """
+        if name in KERNEL_FILTERS:
+            kernelStep(name, args)
+        elif name == 'applyPipeline':
+            assert len(args) == 1 and type(args[0]) == list, repr(args)
+        else:
+            assert name in OTHER_FILTERS, repr(name)
+            assert len(args) == 0, repr(args)
+        
         current = self.getCurrent()
-        hfD = (((current.getWidth()**2) + (current.getHeight()**2))**0.5)/2
-        for row in range(current.getHeight()):
-            for col in range(current.getWidth()):
-                d = (((current.getWidth()/2-col)**2)+(current.getHeight()/2-row)**2)**0.5
-                darken = 1 - (d / hfD)**2
-                color = current.getPixel(row, col)
-                red = int(color[0]*darken) #ask about rounding
-                green = int(color[1]*darken)
-                blue = int(color[2]*darken)
-                pixel = (red, green, blue)
-                current.setPixel(row, col, pixel)
-                
-                
-
-
+        origin  = current.copy()
+        work    = current.copy()
+        work._unmap()
+        job = a6async.Job(progress, lambda result: self._applyJob(name, origin, result))
+        job.start(lambda: self._runJob(job, name, args, work))
+        return job
+    
+    # DEFERRED FILTERS
+    def materialize(self):
+        """
+        Applies the filters that have been deferred (see setDeferred).
+        
+        The deferred filters are simplified before they are applied, so the 
+        result is exactly the same as applying them one at a time, but with 
+        fewer passes over the image:
+        
+        * A run of transpose, rotateLeft, rotateRight, reflectHori and 
+          reflectVert is merged into the single equivalent transform (these 
+          form a group of eight), so inverse pairs like rotateLeft then 
+          rotateRight cancel out entirely.
+        * The color filters (invert, monochromify and the tone curves) move
+          pixels nowhere, so they are moved past the transforms in the run.
+        * Adjacent per-channel filters (invert and the tone curves) are 
+          composed into one set of lookup tables, and dropped if the tables do 
+          nothing.  So a double invert costs nothing.
+        
+        vignette and jail depend on where each pixel is, so runs are not merged
+        across them.  This method does nothing if there are no deferred filters.
+        
+        Runs are not merged across a call to increment made in preview mode 
+        either.  Each one starts a new step of the edit history when it is 
+        reached, so the steps are the same as if the filters had been applied
+        at once.  If a background replay is running, this method waits for it
+        to finish first.
+        """
+        self._waitForReplay()
+        with _PENDING_LOCK:
+            plan = _simplify_plan(self._pending)
+            self._pending   = []
+            self._snapshots = []
+        if len(plan) == 0:
+            return
+        
+        replaying = self._replaying
+        self._replaying = threading.get_ident()
+        try:
+            self._runPlan(plan)
+        finally:
+            self._replaying = replaying
+    
+    def replay(self, wait=True):
+        """
+        Applies the deferred filters at full resolution.
+        
+        If wait is True, this is the same as materialize.  Otherwise the 
+        filters are applied by a background thread, and this method returns at
+        once.  Filters deferred while the thread runs are applied by it too. 
+        Calling getCurrent (or materialize) waits for the thread to finish.
+        
+        Parameter wait: Whether to wait for the filters to be applied
+        Precondition: wait is a bool
+        """
+        assert type(wait) == bool, repr(wait)
+        if wait:
+            self.materialize()
+        elif self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._drain, daemon=True)
+            self._thread.start()
+    
+    def isReplaying(self):
+        """
+        Returns True if a background replay is running, False otherwise
+        """
+        return self._thread is not None and self._thread.is_alive()
+    
+    def getCurrent(self):
+        """
+        Returns the current image.
+        
+        If any filters have been deferred, they are applied first (see 
+        materialize).  So the image is always up to date when it is displayed,
+        encoded or saved.
+        """
+        if self._replaying != threading.get_ident():
+            if len(self._pending) > 0 or self.isReplaying():
+                self.materialize()
+        return super().getCurrent()
+    
+    def increment(self):
+        """
+        Adds a new step to the edit history.
+        
+        Instead of a copy of the image, the step only keeps what is needed to
+        undo it (see a6history), so the memory used by the history stays 
+        within its budget (see setHistoryBudget).
+        
+        In preview mode the step is deferred along with the filters, and 
+        started when materialize reaches it.  So starting an edit does not have
+        to wait for the full-resolution image.
+        """
+        if self._proxy is None:
+            self._getEdits().begin(self.getCurrent())
+            return
+        with _PENDING_LOCK:
+            self._snapshots = self._snapshots+[self._proxy.copy()]
+            self._pending = self._pending+[('increment', None)]
+    
+    def undo(self):
+        """
+        Undoes the most recent edit.
+        
+        In preview mode, if the last call to increment has not been applied yet,
+        this takes it back along with the deferred filters after it, and 
+        restores the proxy as it was before it.  Otherwise, if a step is open
+        (increment was called since the last undo), that step is the one undone,
+        and any deferred filters are dropped, since they belong to it.  It is
+        undone even if all of its filters were dropped, so each undo still 
+        matches one increment.  If no step is open, the deferred filters belong
+        to no step, so they are applied (as they would have been in eager mode)
+        before undoing the last stored step.
+        """
+        with _PENDING_LOCK:
+            names = [name for (name, step) in self._pending]
+            if 'increment' in names:
+                index = len(names)-1-names[::-1].index('increment')
+                if 'finish' not in names[index:]:
+                    # As in eager mode, the step before it is finished too
+                    self._pending = self._pending[:index]+[('finish', None)]
+                    if self._proxy is not None:
+                        self._proxy = self._snapshots[index]
+                        self._snapshots = self._snapshots[:index]+[self._proxy.copy()]
+                    return True
+        self._waitForReplay()
+        with _PENDING_LOCK:
+            names = [name for (name, step) in self._pending]
+            if 'finish' not in names and self._getEdits().isOpen():
+                self._pending = []
+        self.materialize()
+        
+        replaying = self._replaying
+        self._replaying = threading.get_ident()
+        try:
+            result = self._getEdits().undo(super().getCurrent(), 
+                                           lambda name: getattr(self, name)())
+        finally:
+            self._replaying = replaying
+        self._resetProxy()
+        return result
+    
+    def clear(self):
+        """
+        Reverts to the original image, dropping any deferred filters and the
+        undo history first.
+        """
+        with _PENDING_LOCK:
+            self._pending = []
+        self._waitForReplay()
+        self._getEdits().clear()
+        result = super().clear()
+        self._resetProxy()
+        return result
     
     # HELPER METHODS
+    def _record(self, name, args):
+        """
+        Returns True if the given filter was deferred, False if it should run now.
+        
+        In deferred mode (or preview mode) the filter, with its preconditions
+        checked, is added to the deferred filters instead of being applied.  In
+        preview mode it is also applied to the proxy image right away.
+        
+        Parameter name: The filter method name
+        Precondition: name is in KERNEL_FILTERS or OTHER_FILTERS
+        
+        Parameter args: The arguments to the filter method
+        Precondition: args is a tuple
+        """
+        if not self._deferred and self._proxy is None:
+            return False
+        if self._replaying == threading.get_ident():
+            return False
+        if name in KERNEL_FILTERS:
+            step = kernelStep(name, args)
+        else:
+            assert len(args) == 0, repr(args)
+            step = None
+        
+        with _PENDING_LOCK:
+            if self._proxy is not None:
+                # Filter a copy, so nothing changes if the filter fails
+                proxy = self._proxy.copy()
+                getattr(_Proxy(proxy), name)(*args)
+                self._snapshots = self._snapshots+[self._proxy]
+                self._proxy = proxy
+            self._pending = self._pending+[(name, step)]
+        return True
+    
+    def _getEdits(self):
+        """
+        Returns the undo history, making it if this is the first time it is needed.
+        """
+        if self._edits is None:
+            self._edits = a6history.History()
+        return self._edits
+    
+    def _noteEdit(self, name):
+        """
+        Reports to the undo history that the filter name is changing the image.
+        
+        Parameter name: The filter method name
+        Precondition: name is a string
+        """
+        if self._edits is not None:
+            self._edits.note(name)
+    
+    def _progress(self, done, total):
+        """
+        Reports that done of the total rows of the current pass are finished.
+        
+        This does nothing unless the filter is running a job, in which case the 
+        job is updated.  That raises a CancelledError if the job was cancelled.
+        
+        Parameter done: The number of rows finished
+        Precondition: done is an int, 0 <= done <= total
+        
+        Parameter total: The number of rows in the pass
+        Precondition: total is an int >= 0
+        """
+        if self._job is not None:
+            self._job.update(done, total)
+    
+    def _runJob(self, job, name, args, work):
+        """
+        Returns work after applying the filter for a job of submit to it.
+        
+        This runs in the worker thread, so it touches nothing but work.
+        
+        Parameter job: The job being run
+        Precondition: job is a Job
+        
+        Parameter name: The filter method name
+        Precondition: name is a filter method name (see submit)
+        
+        Parameter args: The arguments to the filter method
+        Precondition: args is a tuple
+        
+        Parameter work: A copy of the current image, to apply the filter to
+        Precondition: work is an Image not used by any other thread
+        """
+        worker = _Proxy(work)
+        worker._job = job
+        worker._workers = self._workers
+        getattr(worker, name)(*args)
+        job.update(work.getHeight(), work.getHeight())
+        return work
+    
+    def _applyJob(self, name, origin, work):
+        """
+        Returns the current image after copying the result of a job into it.
+        
+        This is called by Job.apply, in the thread that edits this filter.  Only
+        the tiles that the job changed are copied.
+        
+        Parameter name: The filter method name
+        Precondition: name is a filter method name (see submit)
+        
+        Parameter origin: A copy of the current image from when the job was submitted
+        Precondition: origin is an Image
+        
+        Parameter work: The copy that the filter was applied to
+        Precondition: work is an Image with the same number of pixels as origin
+        """
+        current = self.getCurrent()
+        if len(current.getChangedTiles(origin)) > 0 or current.getWidth() != origin.getWidth():
+            raise RuntimeError('the image was changed while the job was running')
+        self._noteEdit(name)
+        for index in work.getChangedTiles(current):
+            current.setTile(index, work.getTile(index))
+        current.setWidth(work.getWidth())
+        self._resetProxy()
+        return current
+    
+    def _drain(self):
+        """
+        Applies deferred filters until there are none left.
+        
+        This is run by the background thread started by replay.
+        """
+        while len(self._pending) > 0:
+            self.materialize()
+    
+    def _waitForReplay(self):
+        """
+        Waits for the background replay to finish, unless this is that thread.
+        """
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+    
+    def _resetProxy(self):
+        """
+        Makes a new proxy image from the current image, if in preview mode.
+        
+        The proxy has at most the number of pixels given to setPreview.
+        """
+        if self._proxy is not None:
+            self._proxy = _make_proxy(super().getCurrent(), self._maxpixels)
+            self._snapshots = []
+    
+    def _runPlan(self, plan):
+        """
+        Applies the filters in plan to the current image.
+        
+        Consecutive kernel steps are fused into a single pass (see 
+        _applyKernels).  The other filters are run by calling their methods.
+        'increment' starts a new step of the edit history, and 'finish' ends
+        the open step.
+        
+        Parameter plan: The filters to apply, in order
+        Precondition: plan is a list of pairs (name, step), where step is the
+        kernel step for name, or None if name is a method that takes no arguments
+        (or is 'increment' or 'finish')
+        """
+        group = []
+        for (name, step) in plan:
+            if step is not None:
+                group.append(step)
+            elif name == 'increment':
+                self._applyKernels(group)
+                group = []
+                self._getEdits().begin(self.getCurrent())
+            elif name == 'finish':
+                self._applyKernels(group)
+                group = []
+                self._getEdits().finish(self.getCurrent())
+            else:
+                self._applyKernels(group)
+                group = []
+                getattr(self, name)()
+        self._applyKernels(group)
+    
+    def _rotate180(self):
+        """
+        Rotates the current image by 180 degrees in a single pass.
+        
+        This is the same as reflectHori followed by reflectVert.  Each pair of
+        rows is swapped, and both are reversed on the way.
+        """
+        self._noteEdit('_rotate180')
+        current = self.getCurrent()
+        height  = current.getHeight()
+        for x in range((height+1)//2):              # Loop over the rows
+            top    = current.row(x)
+            bottom = current.row(height-1-x)
+            temp   = top.getRow(0)
+            top.setRow(0,_reverse_pixels(bottom.getRow(0)))
+            bottom.setRow(0,_reverse_pixels(temp))
+            self._progress(min(2*(x+1), height), height)
+    
+    def _applyKernels(self, steps):
+        """
+        Applies the kernels for the given point filters in a single pass.
+        
+        The current image is processed a band of rows at a time.  Each band is 
+        read once, passed through every kernel in order, and written back once.
+        The kernels come from a6vector if it is enabled, and from this module 
+        otherwise.  If there is more than one worker and the image is large 
+        enough, the bands are processed in parallel by a6parallel instead.
+        
+        Parameter steps: The kernels to apply, in order
+        Precondition: steps is a list of kernel steps (see kernelStep)
+        """
+        if len(steps) == 0:
+            return
+        for (name, args) in steps:
+            self._noteEdit(name)
+        
+        current = self.getCurrent()
+        width   = current.getWidth()
+        height  = current.getHeight()
+        if self._workers > 1 and len(current) >= PARALLEL_PIXELS:
+            a6parallel.applyKernels(current, steps, self._workers)
+            self._progress(height, height)
+            return
+        
+        kernels = [(name, getKernel(name), args) for (name, args) in steps]
+        fixed   = VIGNETTE_MASKS.isFixed()
+        mask    = None
+        if 'vignette' in [name for (name, args) in steps]:
+            mask = VIGNETTE_MASKS.getMask(width, height)
+        
+        size    = max(1, BAND_PIXELS // width)
+        for row in range(0, height, size):          # Loop over the bands
+            band = current.region(row, 0, min(size, height-row), width)
+            data = band.read()
+            factors = None
+            for (name, kernel, args) in kernels:
+                if name == 'vignette':
+                    if factors is None:
+                        factors = _vignette_rows(mask, width, height, row, row+band.getHeight(), fixed)
+                    args = (factors, row)
+                data = kernel(data, row, width, height, *args)
+            band.write(data)
+            self._progress(row+band.getHeight(), height)
+    
+    def _transposeSquare(self, top=0, left=0, size=None):
+        """
+        Transposes a square of the current image in place.
+        
+        The square is split into blocks of BLOCK_SIZE x BLOCK_SIZE pixels.  Each
+        block above the diagonal is swapped with its mirror image below the 
+        diagonal, and both are transposed on the way.  Blocks on the diagonal 
+        are transposed where they are.  The only extra memory is two blocks.
+        
+        By default the square is the whole image (which must be square), and
+        the progress is reported.
+        
+        Parameter top: The top row of the square
+        Precondition: top is an int >= 0
+        
+        Parameter left: The left column of the square
+        Precondition: left is an int >= 0
+        
+        Parameter size: The side of the square (None for the whole image)
+        Precondition: size is None or an int > 0, and the square is in the image
+        """
+        current = self.getCurrent()
+        whole = size is None
+        if whole:
+            size = current.getWidth()
+        for row in range(0, size, BLOCK_SIZE):
+            height = min(BLOCK_SIZE, size-row)
+            for col in range(row, size, BLOCK_SIZE):
+                width = min(BLOCK_SIZE, size-col)
+                upper = current.region(top+row, left+col, height, width)
+                lower = current.region(top+col, left+row, width, height)
+                data  = upper.read()
+                if col != row:
+                    upper.write(_transpose_pixels(lower.read(), height))
+                lower.write(_transpose_pixels(data, width))
+            if whole:
+                self._progress(row+height, size)
+    
+    def _transposeChunks(self):
+        """
+        Transposes the current image in place, using the common divisor of its sides.
+        
+        Let g be the greatest common divisor of the width and height.  First
+        each g x g block of the image is transposed where it is (see 
+        _transposeSquare).  Each row of a block (a chunk of g pixels) then
+        holds part of a row of the result, so what is left is to move the
+        chunks to their new places.  That is a permutation, which is done by
+        following its cycles, holding one chunk at a time.  So the only extra
+        memory is two blocks and one byte per chunk (to mark the chunks done).
+        """
+        current = self.getCurrent()
+        width   = current.getWidth()
+        height  = current.getHeight()
+        side    = math.gcd(width, height)
+        for top in range(0, height, side):      # Transpose each block
+            for left in range(0, width, side):
+                self._transposeSquare(top, left, side)
+            self._progress(top+side, height)
+        
+        # The chunk in row r and block column j moves to row j*side + r % side 
+        # and block column r // side of the result
+        current.setWidth(height)
+        across = width // side
+        down   = height // side
+        count  = len(current) // side
+        done   = bytearray(count)
+        moved  = 0
+        for start in range(count):
+            if done[start]:
+                continue
+            pos  = start
+            data = current.region(pos // down, pos % down*side, 1, side).read()
+            while True:
+                row, col = divmod(pos, across)
+                pos   = (col*side+row % side)*down+row//side
+                chunk = current.region(pos // down, pos % down*side, 1, side)
+                saved = chunk.read()
+                chunk.write(data)
+                data  = saved
+                done[pos] = 1
+                moved += 1
+                self._progress(moved // down, width)
+                if pos == start:
+                    break
+    
     def _drawHBar(self, row, pixel):
         """
         Draws a horizontal bar on the current image at the given row.
@@ -233,17 +1778,48 @@ class Filter(a6editor.Editor):
         Precondition: pixel is a 3-element tuple (r,b,g) of ints in 0..255
         """
         current = self.getCurrent()
-        for col in range(current.getWidth()):
-            current.setPixel(row,   col, pixel)
-            current.setPixel(row+1, col, pixel)
-            current.setPixel(row+2, col, pixel)
+        current.fillRect(row, 0, 3, current.getWidth(), pixel)
 
     def _drawVBar(self, col, pixel):
+        """
+        Draws a vertical bar on the current image at the given column.
+        
+        This method draws a vertical 4-pixel-wide bar at the given column 
+        of the current image. This means that the bar includes the pixels 
+        col, col+1, col+2, and col+3. The bar uses the color given by the 
+        pixel value.
+        
+        Parameter col: The start of the column to draw the bar
+        Precondition: col is an int, 0 <= col  &&  col+3 < image width
+        
+        Parameter pixel: The pixel color to use
+        Precondition: pixel is a 3-element tuple (r,b,g) of ints in 0..255
+        """
         current = self.getCurrent()
-        for row in range(current.getHeight()):
-            current.setPixel(row, col, pixel)
-            current.setPixel(row, col+1, pixel)
-            current.setPixel(row, col+2, pixel)
-            current.setPixel(row, col+3, pixel)
+        current.fillRect(0, col, current.getHeight(), 4, pixel)
+
+    
+
 
-    
\ No newline at end of file
+class _Proxy(Filter):
+    """
+    A Filter that works directly on a proxy image, with no edit history.
+    
+    This is used to apply filters to the proxy in preview mode, to the copy of
+    the image that a background job works on, and to the images in a6bench.
+    """
+    
+    def __init__(self, image):
+        """
+        Initializes the filter to work on image.
+        
+        Parameter image: The image to edit
+        Precondition: image is an Image
+        """
+        self._image = image
+    
+    def getCurrent(self):
+        """
+        Returns the image being edited
+        """
+        return self._image
@@ -0,0 +1,245 @@
+"""
+Compact undo history for the imager application.
+
+Keeping a full copy of the image for every step of the edit history makes the
+memory grow with the number of steps times the image size.  This module keeps
+each step as small as it can instead:
+
+* If the step was made only of filters that are their own inverse (invert,
+  transpose, reflectHori, reflectVert, and the rotations, which are made of
+  these), only the names of the filters are kept.  The step is undone by
+  applying them again in reverse order.
+* Otherwise, only the tiles that the step changed are kept (see
+  Image.getDirtyTiles).  Each one is stored as the XOR of its old and new
+  contents, compressed with zlib.  Pixels that did not change XOR to zero, so
+  they compress to almost nothing.  The step is undone by XORing the tiles
+  with the image again.
+* If the step did not change the image at all, it is kept with no names, so
+  it costs only STEP_BYTES.  It must still be kept, so that each step begun
+  is undone by exactly one call to undo (as with Editor.increment and undo).
+
+The history has a budget in bytes.  When the stored steps go over it, the
+oldest steps are dropped, so the memory used stays fixed however many steps
+there are.
+
+The step being made needs a copy of the image from when it started, to find
+the changed tiles.  That copy shares its tiles with the image (see Image.copy),
+so it only costs memory for the tiles that change.
+"""
+import zlib
+
+# The default budget for the stored steps (in bytes)
+DEFAULT_BUDGET = 256 << 20
+
+# The bytes charged for each step, on top of its data
+STEP_BYTES = 64
+
+# The filters whose steps can be undone by applying them again
+INVERTIBLE = ('invert', 'transpose', 'reflectHori', 'reflectVert', '_rotate180')
+
+
+class History(object):
+    """
+    A class representing an undo history stored as compact steps.
+
+    A step is started with begin, which also finishes the step before it.
+    While a step is open, each filter that changes the image reports itself
+    with note.  The step is finished (and stored) by the next call to begin,
+    undo or finish.
+    """
+    # Attribute _steps: The stored steps, oldest first
+    # Invariant: _steps is a list of pairs (size, step), where size is the
+    # bytes charged for the step, and step is either ('inverse', names) or
+    # ('tiles', width, deltas) (see finish).  names may be empty.
+    #
+    # Attribute _size: The bytes charged for all of the stored steps
+    # Invariant: _size is the sum of the sizes in _steps
+    #
+    # Attribute _budget: The most bytes that the stored steps may use
+    # Invariant: _budget is an int >= 0
+    #
+    # Attribute _base: A copy of the image from when the open step started
+    # Invariant: _base is an Image, or None if no step is open
+    #
+    # Attribute _notes: The filters reported during the open step, in order
+    # Invariant: _notes is a list of strings
+
+    def getBudget(self):
+        """
+        Returns the most bytes that the stored steps may use
+        """
+        return self._budget
+
+    def setBudget(self, value):
+        """
+        Sets the most bytes that the stored steps may use.
+
+        If the steps already use more than this, the oldest are dropped.
+
+        Parameter value: The budget in bytes
+        Precondition: value is an int >= 0
+        """
+        assert type(value) == int and value >= 0, repr(value)
+        self._budget = value
+        self._evict()
+
+    def getSize(self):
+        """
+        Returns the bytes used by the stored steps
+        """
+        return self._size
+
+    def __len__(self):
+        """
+        Returns the number of stored steps that can be undone
+        """
+        return len(self._steps)
+
+    def isOpen(self):
+        """
+        Returns True if a step has been begun and not yet finished, False otherwise
+        """
+        return self._base is not None
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        """
+        Initializes an empty history.
+
+        Parameter budget: The most bytes that the stored steps may use
+        Precondition: budget is an int >= 0
+        """
+        assert type(budget) == int and budget >= 0, repr(budget)
+        self._steps  = []
+        self._size   = 0
+        self._budget = budget
+        self._base   = None
+        self._notes  = []
+
+    def begin(self, image):
+        """
+        Finishes the open step (if any) and starts a new one for image.
+
+        Parameter image: The image being edited
+        Precondition: image is an Image
+        """
+        self.finish(image)
+        self._base  = image.copy()
+        self._notes = []
+
+    def note(self, name):
+        """
+        Reports that the filter name is changing the image in the open step.
+
+        This does nothing if no step is open.
+
+        Parameter name: The filter method name
+        Precondition: name is a string
+        """
+        if self._base is not None:
+            self._notes.append(name)
+
+    def finish(self, image):
+        """
+        Finishes the open step (if any) and stores it.
+
+        A step that did not change the image is stored too, as an empty step.
+
+        Parameter image: The image being edited
+        Precondition: image is the Image given to begin
+        """
+        base = self._base
+        if base is None:
+            return
+        self._base = None
+
+        notes = self._notes
+        if len(notes) > 0 and all([name in INVERTIBLE for name in notes]):
+            self._push(STEP_BYTES, ('inverse', notes[::-1]))
+            return
+
+        changed = image.getChangedTiles(base)
+        if len(changed) == 0 and image.getWidth() == base.getWidth():
+            self._push(STEP_BYTES, ('inverse', []))
+            return
+        deltas = {}
+        size   = STEP_BYTES
+        for index in changed:
+            delta = zlib.compress(_xor(base.getTile(index), image.getTile(index)), 1)
+            deltas[index] = delta
+            size += len(delta)
+        self._push(size, ('tiles', base.getWidth(), deltas))
+
+    def undo(self, image, apply):
+        """
+        Returns True if it undid the last step of image, False if there is none.
+
+        The open step is finished first, so it is the one undone.
+
+        Parameter image: The image being edited
+        Precondition: image is the Image given to begin
+
+        Parameter apply: The function to apply a filter to the image
+        Precondition: apply is a function taking a filter method name
+        """
+        self.finish(image)
+        if len(self._steps) == 0:
+            return False
+
+        size, step = self._steps.pop()
+        self._size -= size
+        if step[0] == 'inverse':
+            for name in step[1]:
+                apply(name)
+        else:
+            for (index, delta) in step[2].items():
+                image.setTile(index, _xor(image.getTile(index), zlib.decompress(delta)))
+            image.setWidth(step[1])
+        return True
+
+    def clear(self):
+        """
+        Removes all of the steps, including the open one.
+        """
+        self._steps = []
+        self._size  = 0
+        self._base  = None
+        self._notes = []
+
+    # HELPER METHODS
+    def _push(self, size, step):
+        """
+        Stores a finished step, dropping the oldest steps if over budget.
+
+        Parameter size: The bytes charged for the step
+        Precondition: size is an int >= 0
+
+        Parameter step: The step to store
+        Precondition: step is a step as described in the invariant for _steps
+        """
+        self._steps.append((size, step))
+        self._size += size
+        self._evict()
+
+    def _evict(self):
+        """
+        Drops the oldest steps until the stored steps fit in the budget.
+        """
+        drop = 0
+        while self._size > self._budget and drop < len(self._steps):
+            self._size -= self._steps[drop][0]
+            drop += 1
+        del self._steps[:drop]
+
+
+def _xor(left, right):
+    """
+    Returns the bytes that are the XOR of left and right.
+
+    Parameter left: The first bytes
+    Precondition: left is a bytes-like object
+
+    Parameter right: The second bytes
+    Precondition: right is a bytes-like object of the same length
+    """
+    value = int.from_bytes(left, 'little') ^ int.from_bytes(right, 'little')
+    return value.to_bytes(len(left), 'little')
@@ -9,6 +9,20 @@ Based on an original file by Dexter Kozen (dck10) and Walker White (wmw2)
 Tiffany Yeung (ty272), Luke Shao (lys8)
 11/15/22
 """
+import io
+import itertools
+import mmap
+import os
+import weakref
+
+# The number of pixels in each tile of an image (a power of 2)
+TILE_SIZE = 4096
+
+# Helpers for finding the tile of a pixel position
+_TILE_SHIFT = 12
+_TILE_MASK  = TILE_SIZE-1
+_TILE_BYTES = 3*TILE_SIZE
+
 
 def _is_pixel(item):
     """
@@ -50,6 +64,118 @@ def _is_pixel_list(data):
     return True
 
 
+def _pack(data):
+    """
+    Returns a packed buffer holding the pixels of data.
+    
+    The buffer is a bytearray with three bytes per pixel, stored in the 
+    interleaved order red, green, blue.  So pixel pos occupies the bytes
+    3*pos, 3*pos+1 and 3*pos+2.
+    
+    Parameter data: The pixels to pack
+    Precondition: data is a pixel list
+    """
+    return bytearray(itertools.chain.from_iterable(data))
+
+
+def _unpack(buffer):
+    """
+    Returns the pixel list stored in the packed buffer.
+    
+    This is the inverse of _pack.  The tuples are created in bulk by slicing
+    out each color channel, so this is much faster than reading the pixels
+    one at a time.
+    
+    Parameter buffer: The packed pixel data
+    Precondition: buffer is a bytes-like object whose length is a multiple of 3
+    """
+    return list(zip(buffer[0::3], buffer[1::3], buffer[2::3]))
+
+
+def _parse_header(head):
+    """
+    Returns the tuple (width, height, offset) for a binary PPM or PAM header.
+    
+    The value offset is the number of header bytes, which is where the pixel
+    data starts.  Only 8-bit RGB images (maxval 255, depth 3) are supported.
+    This function raises a ValueError if head is not such a header.
+    
+    Parameter head: The first bytes of the file
+    Precondition: head is a bytes object containing the complete header
+    """
+    if head[:2] == b'P6':
+        # PPM: width, height and maxval separated by whitespace or comments
+        tokens = []
+        pos = 2
+        while len(tokens) < 3:
+            while pos < len(head) and head[pos] in b' \t\r\n#':
+                if head[pos] == ord('#'):
+                    pos = head.find(b'\n', pos)
+                    if pos == -1:
+                        raise ValueError('PPM header is incomplete')
+                pos += 1
+            start = pos
+            while pos < len(head) and head[pos] not in b' \t\r\n#':
+                pos += 1
+            if start == pos or pos == len(head):
+                raise ValueError('PPM header is incomplete')
+            tokens.append(int(head[start:pos]))
+        width, height, maxval = tokens
+        depth = 3
+        offset = pos+1          # Exactly one whitespace byte after maxval
+    elif head[:3] == b'P7\n':
+        # PAM: one KEY VALUE pair per line, up to ENDHDR
+        fields = {}
+        end = head.find(b'\nENDHDR\n')
+        if end == -1:
+            raise ValueError('PAM header is incomplete')
+        for line in head[3:end].split(b'\n'):
+            words = line.split()
+            if len(words) >= 2 and not line.startswith(b'#'):
+                fields[words[0]] = words[1]
+        try:
+            width  = int(fields[b'WIDTH'])
+            height = int(fields[b'HEIGHT'])
+            depth  = int(fields[b'DEPTH'])
+            maxval = int(fields[b'MAXVAL'])
+        except KeyError as e:
+            raise ValueError('PAM header is missing '+e.args[0].decode())
+        offset = end+len(b'\nENDHDR\n')
+    else:
+        raise ValueError('not a binary PPM or PAM file')
+    
+    if maxval != 255 or depth != 3:
+        raise ValueError('only 8-bit RGB images are supported')
+    if width <= 0 or height <= 0:
+        raise ValueError('image has no pixels')
+    return (width, height, offset)
+
+
+def _make_header(width, height, format):
+    """
+    Returns the file header for an image of the given size and format.
+    
+    The header can be read back with _parse_header (a 'raw' file has no header,
+    so the result is empty).
+    
+    Parameter width: The image width
+    Precondition: width is an int > 0
+    
+    Parameter height: The image height
+    Precondition: height is an int > 0
+    
+    Parameter format: The file format
+    Precondition: format is one of 'ppm', 'pam' or 'raw'
+    """
+    if format == 'ppm':
+        header = 'P6\n%d %d\n255\n' % (width, height)
+    elif format == 'pam':
+        header = ('P7\nWIDTH %d\nHEIGHT %d\nDEPTH 3\nMAXVAL 255\n'
+                  'TUPLTYPE RGB\nENDHDR\n') % (width, height)
+    else:
+        header = ''
+    return header.encode('ascii')
+
 
 # TASK 1: IMPLEMENT THIS CLASS
 class Image(object):
@@ -78,19 +204,53 @@ class Image(object):
         image.__setitem__(pos, (255,0,0))
     
      These operations are used by the greyscale filters and the stenography methods.
+    
+    Internally the pixels are not kept as a list of tuples, which costs over
+    a hundred bytes per pixel.  Instead they are packed with three bytes (red, 
+    green, blue) per pixel.  Tuples are only created when a pixel is read, so 
+    the public interface is unchanged.
+    
+    The packed data is split into tiles of TILE_SIZE pixels.  Copying an image
+    does not copy any tiles.  The copy shares them with the original, and a 
+    tile is only duplicated when one of the two images writes to it (this is
+    called copy-on-write).  So a copy takes time and memory proportional to 
+    the number of tiles, not pixels, and an edit history of copies only pays
+    for the tiles that each edit changed.
     """
     # IMMUTABLE ATTRIBUTES (Fixed after initialization)
-    # Attribute _data: The underlying list of pixels 
-    # Invariant: _data is a pixel list (see _is_pixel_list)
+    # Attribute _tiles: The packed pixel data (see _pack), split into tiles
+    # Invariant: _tiles is a list of writable bytes-like objects (bytearray or 
+    # memoryview).  Every tile but the last has 3*TILE_SIZE bytes, and the 
+    # tile lengths add up to 3*_length.
+    #
+    # Attribute _owned: Which tiles this image may change in place
+    # Invariant: _owned is a bytearray with one entry per tile.  An entry of 0
+    # means the tile may be shared with a copy, and must be duplicated before
+    # it is written to.
+    #
+    # Attribute _length: The number of pixels in the image
+    # Invariant: _length is an int >= 0
+    #
+    # Attribute _mmap: The memory-mapped file holding the pixels (see openMmap)
+    # Invariant: _mmap is an mmap object, or None if the image is in memory
+    #
+    # Attribute _mapped: The tiles of a writable memory-mapped file
+    # Invariant: _mapped is a list of views of the file (one per tile), shared by
+    # the image opened from the file and all of its copies, or None if there is
+    # no writable file
+    #
+    # Attribute _sharers: The images that may hold tiles of _mapped
+    # Invariant: _sharers is a WeakSet shared along with _mapped, or None if 
+    # _mapped is None
     #
     # MUTABLE ATTRIBUTES (Can be changed at any time, via the setters)
     # Attribute _width:  The image width, which is the number of columns
-    # Invariant: _width is an int > 0, _width*_height = len(_data)
-    # width = 0 only if len(_data) = 0
+    # Invariant: _width is an int > 0, _width*_height = len(self)
+    # width = 0 only if len(self) = 0
     #
     # Attribute _height:  The image height, which is the number of rows
-    # Invariant: _height is an int > 0, _width*_height = len(_data)
-    # height = 0 only if len(_data) = 0
+    # Invariant: _height is an int > 0, _width*_height = len(self)
+    # height = 0 only if len(self) = 0
     # Note that if you change width, you must change height (to satisfy the invariant)
     
     # PART A
@@ -100,9 +260,10 @@ class Image(object):
         Returns a COPY of the image data.
         
         The image data is a 1-dimensional list of 3-element tuples.  The list
-        returned by this method is a copy of the one managed by this object.
+        returned by this method is built from the packed buffer, so changing it
+        does not change the image.
         """
-        return self._data[:]
+        return _unpack(b''.join(self._tiles))
        
     
     def getWidth(self):
@@ -130,7 +291,7 @@ class Image(object):
         Precondition: value is a valid width >= 0
         """
         assert type(value) == int 
-        assert value == 0 if len(self._data) == 0 else len(self._data) % value == 0
+        assert value == 0 if len(self) == 0 else len(self) % value == 0
         assert value >= 0 
         
         self._width = value
@@ -138,7 +299,7 @@ class Image(object):
         if self._width == 0:
             self._height = 0
         else:
-            self._height = len(self._data) // self._width
+            self._height = len(self) // self._width
 
         pass    # Implement me
     
@@ -167,7 +328,7 @@ class Image(object):
         Precondition: value is a valid height >= 0
         """
         assert type(value) == int 
-        assert value == 0 if len(self._data) == 0 else len(self._data) % value == 0
+        assert value == 0 if len(self) == 0 else len(self) % value == 0
         assert value >= 0 
         
         self._height = value
@@ -175,7 +336,7 @@ class Image(object):
         if self._height == 0:
             self._width = 0
         else:
-            self._width = len(self._data) // self._height
+            self._width = len(self) // self._height
 
 
     
@@ -197,9 +358,9 @@ class Image(object):
         The height is not given explicitly, but you must compute it from the 
         width and pixel list length.
         
-        This initializer stores a reference to the original image data; it
-        does not copy it. So changes to the image will change the data
-        parameter as well.
+        This initializer packs the pixel list into a compact buffer (three
+        bytes per pixel).  So the image does not keep a reference to data,
+        and changes to the image will not change the data parameter.
         
         Parameter data: The image data as a pixel list
         Precondition: data is a pixel list
@@ -212,12 +373,74 @@ class Image(object):
         assert width > 0 
         assert len(data) % width == 0
 
-        self._data = data
-        #self._width = width
-        self.setWidth(width) 
-        #self._height = height
+        self._setBuffer(_pack(data))
+        self.setWidth(width)
+    
+    @classmethod
+    def fromBuffer(cls, buffer, width):
+        """
+        Returns a new image that uses buffer as its packed pixel data.
         
+        This is a trusted alternative to the initializer for data that is 
+        already packed, such as the output of an image decoder or the data of
+        another image.  It does not copy the buffer (the image takes it over),
+        and it only checks the length of the buffer, not every pixel.  Since 
+        every byte of a bytearray is in 0..255, this is enough to guarantee a
+        valid image.
         
+        Parameter buffer: The packed pixel data (see _pack)
+        Precondition: buffer is a bytearray whose length is a multiple of 3
+        
+        Parameter width: The image width
+        Precondition: width is an int > 0 and evenly divides len(buffer)//3
+        """
+        assert type(buffer) == bytearray
+        assert len(buffer) % 3 == 0
+        assert type(width) == int
+        assert width > 0
+        assert len(buffer) // 3 % width == 0
+        
+        image = cls.__new__(cls)
+        image._setBuffer(buffer)
+        image.setWidth(width)
+        return image
+    
+    @classmethod
+    def fromBytes(cls, data, width, check=False):
+        """
+        Returns a new image with a copy of the packed pixel data.
+        
+        This works like fromBuffer, except that data is copied, so it can be 
+        any bytes-like object (bytes, array('B'), memoryview) or a sequence of 
+        ints (list, array('H'), ...) with three channel values per pixel.
+        
+        Byte sources cannot hold an invalid channel value.  For other sources,
+        setting check to True verifies the channel range in bulk (with a single
+        min and max over the data) before copying.
+        
+        Parameter data: The packed pixel data
+        Precondition: data is bytes-like or a sequence of ints in 0..255, and 
+        its length is a multiple of 3
+        
+        Parameter width: The image width
+        Precondition: width is an int > 0 and evenly divides len(data)//3
+        
+        Parameter check: Whether to check the range of non-byte data
+        Precondition: check is a bool
+        """
+        assert type(check) == bool
+        try:
+            view = memoryview(data)
+        except TypeError:
+            view = None
+        
+        if view is not None and view.itemsize == 1:
+            buffer = bytearray(view)
+        else:
+            if check and len(data) > 0:
+                assert min(data) >= 0 and max(data) <= 255
+            buffer = bytearray(list(data) if view is not None else data)
+        return cls.fromBuffer(buffer, width)
     
     # PART B
     # OPERATOR OVERLOADING
@@ -227,8 +450,7 @@ class Image(object):
         
         This special method supports the built-in len function.
         """
-        return len(self._data)
-        pass    # Implement me
+        return self._length
     
     def __getitem__(self, pos):
         """
@@ -248,9 +470,11 @@ class Image(object):
         """
         assert type(pos) == int
         assert pos >= 0 
-        assert pos < len(self._data)
+        assert pos < len(self)
 
-        return self._data[pos]
+        tile = self._tiles[pos >> _TILE_SHIFT]
+        pos = 3*(pos & _TILE_MASK)
+        return (tile[pos], tile[pos+1], tile[pos+2])
 
         
     
@@ -269,10 +493,15 @@ class Image(object):
         """
         assert type(pos) == int
         assert pos >= 0 
-        assert pos < len(self._data)
+        assert pos < len(self)
         assert _is_pixel(pixel)
 
-        self._data[pos] = pixel
+        index = pos >> _TILE_SHIFT
+        tile = self._tiles[index] if self._owned[index] else self._detach(index)
+        pos = 3*(pos & _TILE_MASK)
+        tile[pos]   = pixel[0]
+        tile[pos+1] = pixel[1]
+        tile[pos+2] = pixel[2]
 
        
     
@@ -298,9 +527,10 @@ class Image(object):
         assert type(col) == int
         assert col >= 0 and col < self._width
 
-        newpos = row*self._width + col
-        
-        return self._data[newpos] 
+        pos  = row*self._width + col
+        tile = self._tiles[pos >> _TILE_SHIFT]
+        pos  = 3*(pos & _TILE_MASK)
+        return (tile[pos], tile[pos+1], tile[pos+2])
         
         
     
@@ -326,8 +556,13 @@ class Image(object):
         assert col >= 0 and col < self._width
         assert _is_pixel(pixel)
 
-        newpos = row*self._width + col 
-        self._data[newpos] = pixel 
+        pos   = row*self._width + col
+        index = pos >> _TILE_SHIFT
+        tile = self._tiles[index] if self._owned[index] else self._detach(index)
+        pos  = 3*(pos & _TILE_MASK)
+        tile[pos]   = pixel[0]
+        tile[pos+1] = pixel[1]
+        tile[pos+2] = pixel[2]
     
         
     
@@ -359,22 +594,45 @@ class Image(object):
         There should be spaces after the commas but no where else. Tuples 
         (the individual pixels) handle this  part for you automatically, but you
         need to handle the commas between pixels and the newlines between rows.
+        
+        The string is built with writeText, so it takes time linear in the 
+        size of the image.
+        """
+        buffer = io.StringIO()
+        self.writeText(buffer)
+        return buffer.getvalue()
+    
+    def iterTextRows(self):
+        """
+        Yields the string representation of each row of this image, in order.
+        
+        Each row looks like '[(255, 0, 0), (0, 255, 0)]', which is how it 
+        appears in the string representation of the image (see __str__). The
+        rows are made one at a time, so only one row is ever in memory.
         """
-        x = '['
         for row in range(self._height):
-            x += '[' 
-            for col in range(self._width):
-                x += str(self.getPixel(row, col))
-                if col != self._width-1:
-                    x += ', '
-            x += ']'
-            if row != self._height-1:
-                x += ',\n'
-        x += ']'
-
-        return x
-         
-       
+            data = self.row(row).getRow(0)
+            pixels = zip(data[0::3], data[1::3], data[2::3])
+            yield '['+', '.join(map('(%d, %d, %d)'.__mod__, pixels))+']'
+    
+    def writeText(self, file):
+        """
+        Writes the string representation of this image to file.
+        
+        The output is exactly str(self), but it is written a row at a time, so
+        large images can be dumped without building the whole string.
+        
+        Parameter file: The file to write to
+        Precondition: file is an open text file (or any object with a write 
+        method that accepts strings)
+        """
+        file.write('[')
+        separator = ''
+        for text in self.iterTextRows():
+            file.write(separator)
+            file.write(text)
+            separator = ',\n'
+        file.write(']')
     
     # ADDITIONAL METHODS (WE HAVE PROVIDED THESE FOR YOU)
     def swapPixels(self, row1, col1, row2, col2):
@@ -404,8 +662,627 @@ class Image(object):
         Returns a copy of this image object.
         
         The underlying pixel data must be copied (e.g. the copy cannot refer 
-        to the same list of pixels that this object does).
+        to the same list of pixels that this object does).  The copy is made 
+        lazily: both images share their tiles until one of them writes to a
+        tile, and only that tile is duplicated.
+        """
+        image = Image.__new__(Image)
+        image._tiles  = self._tiles[:]
+        image._owned  = bytearray(len(self._tiles))
+        image._length = self._length
+        image._mmap   = None
+        image._mapped  = self._mapped
+        image._sharers = self._sharers
+        if self._sharers is not None:
+            self._sharers.add(image)
+        image.setWidth(self._width)
+        
+        # Our tiles are now shared as well
+        self._owned = bytearray(len(self._tiles))
+        return image
+    
+    def getDirtyTiles(self):
         """
-        return Image(self._data[:],self._width)
+        Returns the list of tiles that this image has changed since it was copied.
+        
+        A tile is dirty if this image has its own private version of it.  That
+        is the case for tiles written to since the last time this image was 
+        copied (or was created as a copy).  An image that has never been copied
+        owns all of its tiles, so they are all dirty.
+        
+        Tile t holds the pixel positions t*TILE_SIZE to (t+1)*TILE_SIZE-1. The
+        number of dirty tiles times 3*TILE_SIZE bytes is the memory that this 
+        image does not share with any other image.
+        """
+        owned = self._owned
+        return [index for index in range(len(owned)) if owned[index]]
+    
+    def getTile(self, index):
+        """
+        Returns a copy of the packed pixels in the given tile.
+        
+        Tile t holds the pixel positions t*TILE_SIZE to (t+1)*TILE_SIZE-1 (see
+        getDirtyTiles).
+        
+        Parameter index: The tile index
+        Precondition: index is an int, 0 <= index < number of tiles
+        """
+        return bytes(self._tiles[index])
+    
+    def setTile(self, index, data):
+        """
+        Sets the packed pixels in the given tile.
+        
+        Parameter index: The tile index
+        Precondition: index is an int, 0 <= index < number of tiles
+        
+        Parameter data: The new packed pixels
+        Precondition: data is a bytes-like object with the length of the tile
+        """
+        tile = self._tiles[index] if self._owned[index] else self._detach(index)
+        assert len(data) == len(tile), repr(len(data))
+        tile[:] = data
+    
+    def getChangedTiles(self, other):
+        """
+        Returns the list of tiles that this image no longer shares with other.
+        
+        If other is a copy of this image, these are the tiles that either image
+        has written to since the copy was made.  Tiles that have not been 
+        written to are still shared, so they are not compared byte by byte.
+        
+        Parameter other: The image to compare with
+        Precondition: other is an Image with the same number of pixels
+        """
+        assert len(other) == len(self), repr(other)
+        mine   = self._tiles
+        theirs = other._tiles
+        return [index for index in range(len(self._owned)) if mine[index] is not theirs[index]]
+    
+    # FILE INPUT AND OUTPUT
+    @classmethod
+    def openMmap(cls, path, width=None, writable=False):
+        """
+        Returns an image whose pixels are memory-mapped from the given file.
+        
+        The file is either a binary PPM (P6) or PAM (P7) file with 8-bit RGB 
+        pixels, or (if width is given) a headerless file of packed RGB pixels.
+        Nothing is read up front.  The operating system loads pages of the file
+        as the pixels are accessed, so opening even a very large file is fast.
+        
+        If writable is False, the file is never changed.  Tiles of the image
+        are copied into memory the first time they are written to.
+        
+        If writable is True, changes to the image are written straight to the
+        file (call flush to force them to disk).  This also holds for copies 
+        of the image, such as the current image of an Editor.  When an image
+        writes to a tile of the file, the other images sharing that tile are
+        given a private copy of the old contents first, and the writer keeps 
+        the file.  So a snapshot in the edit history still has the pixels it
+        was copied with, while the edits go to disk.  A tile that was given a
+        private copy is no longer part of the file (so after Editor.clear, for
+        example, use saveRaw to write the image out).
+        
+        Parameter path: The file to open
+        Precondition: path is a string naming an existing file
+        
+        Parameter width: The image width of a headerless file
+        Precondition: width is None or an int > 0 that evenly divides the 
+        number of pixels in the file
+        
+        Parameter writable: Whether changes should be written to the file
+        Precondition: writable is a bool
+        """
+        assert type(path) == str
+        assert width is None or (type(width) == int and width > 0)
+        assert type(writable) == bool
+        
+        with open(path, 'r+b' if writable else 'rb') as file:
+            access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+            data = mmap.mmap(file.fileno(), 0, access=access)
+        
+        if width is None:
+            width, height, offset = _parse_header(data[:4096])
+            size = 3*width*height
+            if len(data)-offset < size:
+                raise ValueError('file is shorter than its header says')
+        else:
+            offset = 0
+            size = len(data)-len(data) % 3
+            assert size // 3 % width == 0
+        
+        image = cls.__new__(cls)
+        image._setBuffer(memoryview(data)[offset:offset+size], writable)
+        image._mmap = data
+        if writable:
+            image._mapped  = image._tiles[:]
+            image._sharers = weakref.WeakSet([image])
+        image.setWidth(width)
+        return image
+    
+    def saveRaw(self, path, format='ppm'):
+        """
+        Saves this image to the given file.
+        
+        The format is either 'ppm' (binary PPM), 'pam' or 'raw' (packed RGB 
+        pixels with no header).  All three can be reopened with openMmap.  The
+        data is written one tile at a time, so no extra copy of the image is 
+        made.  The file is written under a temporary name and then renamed, 
+        so it is safe to save over the file this image was opened from.
+        
+        Parameter path: The file to write
+        Precondition: path is a string
+        
+        Parameter format: The file format
+        Precondition: format is one of 'ppm', 'pam' or 'raw'
+        """
+        assert type(path) == str
+        assert format in ('ppm', 'pam', 'raw')
+        
+        temp = path+'.tmp'
+        with open(temp, 'wb') as file:
+            file.write(_make_header(self._width, self._height, format))
+            for tile in self._tiles:
+                file.write(tile)
+        os.replace(temp, path)
+    
+    def flush(self):
+        """
+        Writes any changes to a writable memory-mapped image back to its file.
+        
+        This method does nothing if the image is not memory-mapped.
+        """
+        if self._mmap is not None and not self._mmap.closed:
+            self._mmap.flush()
+    
+    # VIEWS
+    def region(self, row, col, height, width):
+        """
+        Returns a view of the rectangle with top-left corner (row, col).
+        
+        The view does not copy any pixels.  It shares the data of this image, 
+        so changes made through the view change this image (and vice versa).
+        The view supports bulk reads, writes and fills, which move a whole row
+        of the rectangle at a time instead of one pixel at a time.
+        
+        A view is only valid while the image keeps its current width.  Calling
+        setWidth or setHeight on the image invalidates any existing views.
+        
+        Parameter row: The top row of the rectangle
+        Precondition: row is an int >= 0 and < image height
+        
+        Parameter col: The left column of the rectangle
+        Precondition: col is an int >= 0 and < image width
+        
+        Parameter height: The number of rows in the rectangle
+        Precondition: height is an int >= 0 and row+height <= image height
+        
+        Parameter width: The number of columns in the rectangle
+        Precondition: width is an int >= 0 and col+width <= image width
+        """
+        return ImageView(self, row, col, height, width)
+    
+    def row(self, row):
+        """
+        Returns a view of a single row of this image.
+        
+        See region for how views behave.
+        
+        Parameter row: The row to view
+        Precondition: row is an int >= 0 and < height
+        """
+        return ImageView(self, row, 0, 1, self._width)
+    
+    def column(self, col):
+        """
+        Returns a view of a single column of this image.
+        
+        See region for how views behave.  A column view has width 1, so each 
+        of its rows is a single pixel.
+        
+        Parameter col: The column to view
+        Precondition: col is an int >= 0 and < width
+        """
+        return ImageView(self, 0, col, self._height, 1)
+    
+    # DRAWING
+    def fillRect(self, row, col, height, width, pixel):
+        """
+        Sets every pixel in the rectangle with top-left corner (row, col) to pixel.
+        
+        Each row of the rectangle is set with a single slice assignment, and a
+        rectangle as wide as the image is filled as one span.  So filling is
+        close to the speed of copying memory, however narrow the rectangle.
+        
+        Parameter row: The top row of the rectangle
+        Precondition: row is an int >= 0 and < image height
+        
+        Parameter col: The left column of the rectangle
+        Precondition: col is an int >= 0 and < image width
+        
+        Parameter height: The number of rows in the rectangle
+        Precondition: height is an int >= 0 and row+height <= image height
+        
+        Parameter width: The number of columns in the rectangle
+        Precondition: width is an int >= 0 and col+width <= image width
+        
+        Parameter pixel: The pixel value
+        Precondition: pixel is a 3-element tuple (r,g,b) of ints in 0..255
+        """
+        assert type(row) == int and 0 <= row < self._height, repr(row)
+        assert type(col) == int and 0 <= col < self._width, repr(col)
+        assert type(height) == int and 0 <= height <= self._height-row, repr(height)
+        assert type(width) == int and 0 <= width <= self._width-col, repr(width)
+        assert _is_pixel(pixel), repr(pixel)
+        
+        stride = self._width
+        start  = row*stride+col
+        if width == stride:
+            self._fillSpan(start, start+height*width, pixel)
+            return
+        
+        line  = bytes(pixel)*width
+        tiles = self._tiles
+        owned = self._owned
+        for pos in range(start, start+height*stride, stride):
+            index = pos >> _TILE_SHIFT
+            lo    = pos & _TILE_MASK
+            if lo+width > TILE_SIZE:
+                # The row crosses into the next tile
+                self._fillSpan(pos, pos+width, pixel)
+                continue
+            tile = tiles[index] if owned[index] else self._detach(index)
+            tile[3*lo:3*(lo+width)] = line
+    
+    # HELPER METHODS
+    def _setBuffer(self, buffer, owned=True):
+        """
+        Splits buffer into the tiles of this image.
+        
+        The tiles are memoryviews of buffer, so nothing is copied.  If owned
+        is True, writes to the image go straight to buffer.  Otherwise each 
+        tile is copied the first time it is written, and buffer is never changed.
+        
+        Parameter buffer: The packed pixel data
+        Precondition: buffer is a bytes-like object whose length is a multiple 
+        of 3 (it must be writable if owned is True)
+        
+        Parameter owned: Whether the image may write to buffer
+        Precondition: owned is a bool
+        """
+        view = memoryview(buffer)
+        self._tiles = [view[pos:pos+_TILE_BYTES] for pos in range(0, len(view), _TILE_BYTES)]
+        self._owned = bytearray([owned])*len(self._tiles)
+        self._length = len(view) // 3
+        self._mmap = None
+        self._mapped = None
+        self._sharers = None
+    
+    def _unmap(self):
+        """
+        Stops writes to this image from going to a memory-mapped file.
+    
+        This image still shares the tiles of the file, but it makes its own copy
+        of a tile the first time it writes to it, so the file (and the images
+        that write to it) are never changed by this image.
+        """
+        if self._sharers is not None:
+            self._sharers.discard(self)
+        self._mapped = None
+        self._sharers = None
+    
+    def _detach(self, index):
+        """
+        Returns tile index, after giving this image its own copy of it.
+        
+        This is the copy half of copy-on-write.  It is called before writing to
+        a tile that may be shared with another image.
+        
+        A tile of a writable memory-mapped file is the exception.  This image
+        keeps it (so writes go to the file), and the other images sharing it 
+        get the copy instead.
+        
+        Parameter index: The tile index
+        Precondition: index is an int, 0 <= index < len(self._tiles)
+        """
+        tile = self._tiles[index]
+        if self._mapped is not None and tile is self._mapped[index]:
+            private = None
+            for image in list(self._sharers):
+                if image is not self and image._tiles[index] is tile:
+                    if private is None:
+                        private = bytearray(tile)
+                    image._tiles[index] = private
+                    image._owned[index] = 0
+            self._owned[index] = 1
+            return tile
+        
+        tile = bytearray(tile)
+        self._tiles[index] = tile
+        self._owned[index] = 1
+        return tile
+    
+    def _spans(self, start, stop):
+        """
+        Yields the pieces of the tiles that hold pixel positions start..stop-1.
+        
+        Each piece is a tuple (index, lo, hi), where index is a tile index and
+        lo..hi-1 are the byte offsets in that tile.  The pieces are in order.
+        
+        Parameter start: The first pixel position
+        Precondition: start is an int, 0 <= start <= stop
+        
+        Parameter stop: The pixel position after the last one
+        Precondition: stop is an int, stop <= len(self)
+        """
+        while start < stop:
+            index = start >> _TILE_SHIFT
+            base  = index << _TILE_SHIFT
+            end   = min(stop, base+TILE_SIZE)
+            yield (index, 3*(start-base), 3*(end-base))
+            start = end
+    
+    def _readSpan(self, start, stop):
+        """
+        Returns the packed bytes of the pixels at positions start..stop-1.
+        
+        If the pixels are all in one tile, the value returned is a memoryview of
+        that tile, not a copy.  Otherwise the pieces are joined into bytes.
+        
+        Parameter start: The first pixel position
+        Precondition: start is an int, 0 <= start <= stop
+        
+        Parameter stop: The pixel position after the last one
+        Precondition: stop is an int, stop <= len(self)
+        """
+        tiles  = self._tiles
+        pieces = [memoryview(tiles[index])[lo:hi] for (index, lo, hi) in self._spans(start, stop)]
+        if len(pieces) == 1:
+            return pieces[0]
+        return b''.join(pieces)
+    
+    def _writeSpan(self, start, data):
+        """
+        Overwrites the pixels beginning at position start with packed data.
+        
+        Parameter start: The first pixel position
+        Precondition: start is an int >= 0
+        
+        Parameter data: The packed pixels to write
+        Precondition: data is a bytes-like object whose length is a multiple 
+        of 3 and which fits in the image starting at start
+        """
+        data = memoryview(data)
+        pos  = 0
+        for (index, lo, hi) in self._spans(start, start+len(data)//3):
+            tile = self._tiles[index] if self._owned[index] else self._detach(index)
+            tile[lo:hi] = data[pos:pos+hi-lo]
+            pos += hi-lo
+    
+    def _fillSpan(self, start, stop, pixel):
+        """
+        Sets the pixels at positions start..stop-1 to pixel.
+        
+        Parameter start: The first pixel position
+        Precondition: start is an int, 0 <= start <= stop
+        
+        Parameter stop: The pixel position after the last one
+        Precondition: stop is an int, stop <= len(self)
+        
+        Parameter pixel: The pixel value
+        Precondition: pixel is a 3-element tuple (r,g,b) of ints in 0..255
+        """
+        value = bytes(pixel)
+        for (index, lo, hi) in self._spans(start, stop):
+            tile = self._tiles[index] if self._owned[index] else self._detach(index)
+            tile[lo:hi] = value*((hi-lo)//3)
 
 
+class ImageView(object):
+    """
+    A class representing a rectangular window onto an Image.
+    
+    Views are created with the Image methods region, row and column.  A view 
+    does not have pixels of its own.  Every read and write goes to the image 
+    it was created from, so it is a cheap way to work on a strip or tile of a 
+    large image.
+    
+    Positions in a view are relative to its top-left corner.  So getPixel(0,0)
+    on a view is the pixel at (row, col) in the image.
+    
+    The bulk methods read, write and fill work on packed data (three bytes 
+    per pixel, in row-major order) and move one row of the view at a time.
+    That makes them much faster than a loop of getPixel and setPixel calls.
+    """
+    # Attribute _image: The image being viewed
+    # Invariant: _image is an Image
+    #
+    # Attribute _row: The top row of the view in the image
+    # Invariant: _row is an int, 0 <= _row and _row+_height <= image height
+    #
+    # Attribute _col: The left column of the view in the image
+    # Invariant: _col is an int, 0 <= _col and _col+_width <= image width
+    #
+    # Attribute _height: The number of rows in the view
+    # Invariant: _height is an int >= 0
+    #
+    # Attribute _width: The number of columns in the view
+    # Invariant: _width is an int >= 0
+    
+    def getWidth(self):
+        """
+        Returns the number of columns in this view
+        """
+        return self._width
+    
+    def getHeight(self):
+        """
+        Returns the number of rows in this view
+        """
+        return self._height
+    
+    def __init__(self, image, row, col, height, width):
+        """
+        Initializes a view of the given rectangle of image.
+        
+        See the method region in Image for the preconditions.
+        """
+        assert type(row) == int and type(col) == int
+        assert type(height) == int and type(width) == int
+        assert row >= 0 and height >= 0 and row+height <= image.getHeight()
+        assert col >= 0 and width >= 0 and col+width <= image.getWidth()
+        
+        self._image  = image
+        self._row    = row
+        self._col    = col
+        self._height = height
+        self._width  = width
+    
+    def __len__(self):
+        """
+        Returns the number of pixels in this view
+        """
+        return self._width*self._height
+    
+    def getPixel(self, row, col):
+        """
+        Returns the pixel value at (row, col) in this view
+        
+        Parameter row: The pixel row
+        Precondition: row is an int >= 0 and < view height
+        
+        Parameter col: The pixel column
+        Precondition: col is an int >= 0 and < view width
+        """
+        assert type(row) == int and row >= 0 and row < self._height
+        assert type(col) == int and col >= 0 and col < self._width
+        return self._image.getPixel(self._row+row, self._col+col)
+    
+    def setPixel(self, row, col, pixel):
+        """
+        Sets the pixel value at (row, col) in this view to pixel
+        
+        Parameter row: The pixel row
+        Precondition: row is an int >= 0 and < view height
+        
+        Parameter col: The pixel column
+        Precondition: col is an int >= 0 and < view width
+        
+        Parameter pixel: The pixel value
+        Precondition: pixel is a 3-element tuple (r,g,b) of ints in 0..255
+        """
+        assert type(row) == int and row >= 0 and row < self._height
+        assert type(col) == int and col >= 0 and col < self._width
+        self._image.setPixel(self._row+row, self._col+col, pixel)
+    
+    def region(self, row, col, height, width):
+        """
+        Returns a view of a rectangle inside of this view.
+        
+        The position (row, col) is relative to this view.  The new view shares
+        the same image as this one.
+        
+        Parameter row: The top row of the rectangle
+        Precondition: row is an int >= 0 and row+height <= view height
+        
+        Parameter col: The left column of the rectangle
+        Precondition: col is an int >= 0 and col+width <= view width
+        
+        Parameter height: The number of rows in the rectangle
+        Precondition: height is an int >= 0
+        
+        Parameter width: The number of columns in the rectangle
+        Precondition: width is an int >= 0
+        """
+        assert row >= 0 and height >= 0 and row+height <= self._height
+        assert col >= 0 and width >= 0 and col+width <= self._width
+        return ImageView(self._image, self._row+row, self._col+col, height, width)
+    
+    def getRow(self, row):
+        """
+        Returns the packed pixels of the given row of this view.
+        
+        The value returned is a bytes object with 3*width bytes.  It is a copy,
+        so it stays the same even if the image is changed afterwards.
+        
+        Parameter row: The row to read
+        Precondition: row is an int >= 0 and < view height
+        """
+        assert type(row) == int and row >= 0 and row < self._height
+        start = (self._row+row)*self._image.getWidth()+self._col
+        return bytes(self._image._readSpan(start, start+self._width))
+    
+    def setRow(self, row, data):
+        """
+        Overwrites the given row of this view with the packed pixels in data.
+        
+        Parameter row: The row to write
+        Precondition: row is an int >= 0 and < view height
+        
+        Parameter data: The packed pixels
+        Precondition: data is a bytes-like object with 3*width bytes
+        """
+        assert type(row) == int and row >= 0 and row < self._height
+        assert len(data) == 3*self._width
+        start = (self._row+row)*self._image.getWidth()+self._col
+        self._image._writeSpan(start, data)
+    
+    def read(self):
+        """
+        Returns the packed pixels of this view in row-major order.
+        
+        The value returned is a bytes object with 3 bytes for each pixel. If 
+        the view covers whole rows of the image, this is one slice of the 
+        image data.  Otherwise it is one slice per row.
+        """
+        image = self._image
+        stride = image.getWidth()
+        start = self._row*stride+self._col
+        if self._width == stride:
+            return bytes(image._readSpan(start, start+len(self)))
+        
+        result = bytearray()
+        for row in range(self._height):
+            result += image._readSpan(start, start+self._width)
+            start += stride
+        return bytes(result)
+    
+    def write(self, data):
+        """
+        Overwrites the pixels of this view with the packed pixels in data.
+        
+        This is the inverse of read.
+        
+        Parameter data: The packed pixels in row-major order
+        Precondition: data is a bytes-like object with 3*len(self) bytes
+        """
+        assert len(data) == 3*len(self)
+        image = self._image
+        stride = image.getWidth()
+        start = self._row*stride+self._col
+        if self._width == stride:
+            image._writeSpan(start, data)
+            return
+        
+        data = memoryview(data)
+        size = 3*self._width
+        for row in range(self._height):
+            image._writeSpan(start, data[row*size:(row+1)*size])
+            start += stride
+    
+    def fill(self, pixel):
+        """
+        Sets every pixel in this view to pixel.
+        
+        Parameter pixel: The pixel value
+        Precondition: pixel is a 3-element tuple (r,g,b) of ints in 0..255
+        """
+        assert _is_pixel(pixel)
+        if len(self) > 0:
+            self._image.fillRect(self._row, self._col, self._height, self._width, pixel)
+    
+    def getData(self):
+        """
+        Returns the pixels of this view as a pixel list in row-major order.
+        """
+        return _unpack(self.read())
@@ -0,0 +1,183 @@
+"""
+Parallel point filters for the imager application.
+
+This module runs the kernels of the point filters (see a6filter) in a pool of
+worker processes.  The pixels of the image are copied once into a block of
+shared memory.  Each worker is given only the name of the block and a band of
+rows, and it reads the band, runs every kernel on it and writes the result back
+into the block.  No pixel data is ever pickled.  When all of the bands are done,
+the block is copied back into the image.  Both copies go a tile at a time, so
+the only memory used besides the image is the block itself.
+
+The kernels are the same ones used by Filter, so the results are identical to
+running in a single process.  The vignette factors are computed by each worker
+for its own band, so that this work is split up as well.
+
+Filter uses this module when its worker count is more than 1 (see
+Filter.setWorkers).  The pool is created the first time it is needed and kept
+until the worker count changes or shutdown() is called.
+"""
+import a6filter
+import a6image
+import atexit
+import multiprocessing
+from multiprocessing import shared_memory
+
+# The number of bands given to each worker (more bands balance the load better)
+BANDS_PER_WORKER = 4
+
+# The current pool, and the number of processes in it
+_pool = None
+_size = 0
+
+
+def getPool(workers):
+    """
+    Returns a pool with the given number of worker processes.
+
+    The pool is reused between calls that ask for the same number of workers.
+    Otherwise the old pool is shut down and a new one is made.
+
+    Parameter workers: The number of worker processes
+    Precondition: workers is an int >= 1
+    """
+    global _pool, _size
+    assert type(workers) == int and workers >= 1, repr(workers)
+    if _pool is None or _size != workers:
+        shutdown()
+        _pool = multiprocessing.Pool(workers)
+        _size = workers
+    return _pool
+
+
+def shutdown():
+    """
+    Shuts down the worker processes, if there are any.
+    """
+    global _pool, _size
+    if _pool is not None:
+        _pool.terminate()
+        _pool.join()
+    _pool = None
+    _size = 0
+
+
+def applyKernels(image, steps, workers):
+    """
+    Applies the kernels for the given point filters to image in parallel.
+
+    The image is split into about BANDS_PER_WORKER*workers bands of whole rows,
+    which are handed out to the workers as they become free.
+
+    Parameter image: The image to filter
+    Precondition: image is an Image
+
+    Parameter steps: The kernels to apply, in order
+    Precondition: steps is a list of kernel steps (see a6filter.kernelStep)
+
+    Parameter workers: The number of worker processes
+    Precondition: workers is an int >= 1
+    """
+    width  = image.getWidth()
+    height = image.getHeight()
+
+    # The vignette factors are computed by the workers, so they only need the type
+    fixed = a6filter.VIGNETTE_MASKS.isFixed()
+    steps = [(name, (fixed,) if name == 'vignette' else args) for (name, args) in steps]
+
+    block = shared_memory.SharedMemory(create=True, size=3*len(image))
+    try:
+        _copy_in(image, block)
+        size  = max(1, -(-height // (BANDS_PER_WORKER*workers)))
+        tasks = [(block.name, row, min(size, height-row), width, height, steps)
+                 for row in range(0, height, size)]
+        getPool(workers).starmap(_run_band, tasks)
+        _copy_out(block, image)
+    finally:
+        block.close()
+        block.unlink()
+
+
+# HELPER FUNCTIONS
+def _copy_in(image, block):
+    """
+    Copies the pixels of image into a block of shared memory, a tile at a time.
+
+    Each tile is copied straight into the block, so the pixels are never held
+    in a third buffer.
+
+    Parameter image: The image to copy
+    Precondition: image is an Image
+
+    Parameter block: The shared memory to copy to
+    Precondition: block is a SharedMemory of at least 3*len(image) bytes
+    """
+    for start in range(0, len(image), a6image.TILE_SIZE):
+        stop = min(len(image), start+a6image.TILE_SIZE)
+        with block.buf[3*start:3*stop] as piece:
+            piece[:] = image._readSpan(start, stop)
+
+
+def _copy_out(block, image):
+    """
+    Copies the pixels in a block of shared memory back into image, a tile at a time.
+
+    Parameter block: The shared memory to copy from
+    Precondition: block is a SharedMemory of at least 3*len(image) bytes
+
+    Parameter image: The image to copy to
+    Precondition: image is an Image
+    """
+    for start in range(0, len(image), a6image.TILE_SIZE):
+        stop = min(len(image), start+a6image.TILE_SIZE)
+        with block.buf[3*start:3*stop] as piece:
+            image._writeSpan(start, piece)
+
+
+def _run_band(name, start, rows, width, height, steps):
+    """
+    Applies the kernels to a band of rows in a block of shared memory.
+
+    This runs in a worker process.  The band is processed in pieces of about
+    a6filter.BAND_PIXELS pixels, so the memory used does not grow with the band.
+
+    Parameter name: The name of the shared memory block holding the image
+    Precondition: name is a string
+
+    Parameter start: The first row of the band
+    Precondition: start is an int, 0 <= start < height
+
+    Parameter rows: The number of rows in the band
+    Precondition: rows is an int, 0 < rows <= height-start
+
+    Parameter width: The image width
+    Precondition: width is an int > 0
+
+    Parameter height: The image height
+    Precondition: height is an int > 0
+
+    Parameter steps: The kernels to apply, with (fixed,) as the vignette arguments
+    Precondition: steps is a list of kernel steps
+    """
+    kernels = []
+    for (kname, args) in steps:
+        if kname == 'vignette':
+            args = (a6filter._vignette_factors(width, height, start, start+rows, args[0]), start)
+        kernels.append((a6filter.getKernel(kname), args))
+
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        size = max(1, a6filter.BAND_PIXELS // width)
+        for row in range(start, start+rows, size):
+            count = min(size, start+rows-row)
+            piece = block.buf[3*row*width:3*(row+count)*width]
+            data  = bytes(piece)
+            for (kernel, args) in kernels:
+                data = kernel(data, row, width, height, *args)
+            piece[:] = data
+            piece.release()
+    finally:
+        block.close()
+
+
+atexit.register(shutdown)
@@ -0,0 +1,327 @@
+"""
+Profiling for the imager application.
+
+This module measures the operations of Filter and Encoder as they are used.
+Once enable is called, every call of an operation (see FILTER_OPERATIONS and
+ENCODER_OPERATIONS) produces a record, which is passed to a hook.  A record is
+a dictionary with the keys
+
+    'op':            the method name
+    'class':         the name of the class of the editor
+    'depth':         0 for a call made from outside, 1 for an operation called
+                     by another operation (like transpose by rotateRight), ...
+    'start':         the time the call started (as from time.time)
+    'seconds':       the wall time of the call
+    'pixels':        the number of pixels in the image afterwards
+    'mpx_per_sec':   the pixels processed per second (in megapixels)
+    'alloc_bytes':   the peak bytes allocated during the call (see enable)
+    'history_bytes': the change in the bytes used by the undo history
+    'error':         the name of the exception raised by the call, or None
+
+The cost of the undo history shows up in the records for increment, which
+is where each step is saved (see a6history), and in 'history_bytes'.
+
+The hook is any function taking a record.  A Recorder is a hook that keeps the
+records, adds them up by operation, and writes them out as JSON lines:
+
+    recorder = Recorder()
+    enable(recorder)
+    ...
+    recorder.save('profile.jsonl')
+
+The operations are measured by putting wrappers around the methods of the
+classes, and disable puts the original methods back.  So when profiling is
+off, there is no cost at all.
+"""
+import a6editor
+import a6encode
+import a6filter
+import functools
+import json
+import threading
+import time
+import tracemalloc
+
+# The Filter methods that are measured
+FILTER_OPERATIONS = a6filter.KERNEL_FILTERS+a6filter.OTHER_FILTERS+(
+                    'applyPipeline', 'submit', 'materialize', 'replay',
+                    'increment', 'undo', 'clear')
+
+# The Encoder methods that are measured
+ENCODER_OPERATIONS = ('encode', 'decode')
+
+# The current hook (None if profiling is off)
+_hook = None
+
+# Whether to measure the bytes allocated
+_memory = False
+
+# Whether tracemalloc was started by enable
+_tracing = False
+
+# The (class, name, method) for each method replaced by a wrapper
+_originals = []
+
+# The depth of the operation calls in each thread
+_local = threading.local()
+
+
+def getHook():
+    """
+    Returns the function that records are passed to, or None if profiling is off
+    """
+    return _hook
+
+
+def isEnabled():
+    """
+    Returns True if profiling is on, False otherwise
+    """
+    return _hook is not None
+
+
+def enable(hook, memory=False):
+    """
+    Turns on profiling, passing each record to hook.
+
+    If profiling is already on, the hook is replaced.  If memory is True,
+    tracemalloc is started to find the bytes allocated by each operation.  This
+    slows the operations down a good deal, so it is off by default, and then
+    'alloc_bytes' is None.  Only operations called from outside are measured
+    (the others are part of them), so 'alloc_bytes' is None for a depth above 0.
+
+    Parameter hook: The function to pass the records to
+    Precondition: hook is a function taking a dictionary
+
+    Parameter memory: Whether to measure the bytes allocated
+    Precondition: memory is a bool
+    """
+    global _hook, _memory, _tracing
+    assert callable(hook), repr(hook)
+    assert type(memory) == bool, repr(memory)
+    if _hook is None:
+        _wrap(a6filter.Filter, FILTER_OPERATIONS)
+        _wrap(a6encode.Encoder, ENCODER_OPERATIONS)
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _tracing = True
+    _hook   = hook
+    _memory = memory
+
+
+def disable():
+    """
+    Turns off profiling, putting back the original methods.
+    """
+    global _hook, _memory, _tracing
+    for (cls, name, method) in _originals:
+        setattr(cls, name, method)
+    del _originals[:]
+    if _tracing:
+        tracemalloc.stop()
+    _hook    = None
+    _memory  = False
+    _tracing = False
+
+
+class Recorder(object):
+    """
+    A class representing a hook that keeps the records it is given.
+
+    The records are kept in the order the calls finished, so an operation comes
+    after any operations that it called.
+    """
+    # Attribute _records: The records given to this hook
+    # Invariant: _records is a list of dictionaries
+    #
+    # Attribute _lock: The lock for adding records from several threads
+    # Invariant: _lock is a Lock
+
+    def getRecords(self):
+        """
+        Returns a copy of the list of records kept
+        """
+        with self._lock:
+            return self._records[:]
+
+    def __init__(self):
+        """
+        Initializes a recorder with no records.
+        """
+        self._records = []
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        """
+        Keeps the given record.
+
+        Parameter record: The record of an operation
+        Precondition: record is a dictionary (see the module description)
+        """
+        with self._lock:
+            self._records.append(record)
+
+    def __len__(self):
+        """
+        Returns the number of records kept
+        """
+        return len(self._records)
+
+    def clear(self):
+        """
+        Removes all of the records.
+        """
+        with self._lock:
+            self._records = []
+
+    def getTotals(self, depth=0):
+        """
+        Returns a dictionary of the totals for each operation.
+
+        The keys are the operation names, and each value is a dictionary with
+        the keys 'calls', 'seconds', 'pixels' and 'mpx_per_sec'.  Only records
+        of the given depth are counted, so the time of an operation is not
+        counted again for the operations it calls.
+
+        Parameter depth: The depth of the records to count (None for all)
+        Precondition: depth is None or an int >= 0
+        """
+        totals = {}
+        for record in self.getRecords():
+            if depth is not None and record['depth'] != depth:
+                continue
+            total = totals.setdefault(record['op'], {'calls': 0, 'seconds': 0.0,
+                                                     'pixels': 0, 'mpx_per_sec': 0.0})
+            total['calls']   += 1
+            total['seconds'] += record['seconds']
+            total['pixels']  += record['pixels']
+        for total in totals.values():
+            if total['seconds'] > 0:
+                total['mpx_per_sec'] = total['pixels']/total['seconds']/1e6
+        return totals
+
+    def dump(self, file):
+        """
+        Writes the records to an open text file as JSON lines.
+
+        Parameter file: The file to write to
+        Precondition: file is a text file object open for writing
+        """
+        for record in self.getRecords():
+            file.write(json.dumps(record)+'\n')
+
+    def save(self, path):
+        """
+        Writes the records to the given file as JSON lines.
+
+        Parameter path: The file to write
+        Precondition: path is a string
+        """
+        with open(path, 'w') as file:
+            self.dump(file)
+
+
+def jsonLines(file):
+    """
+    Returns a hook that writes each record to an open text file as a JSON line.
+
+    The lines are written as the calls finish, so nothing is kept in memory.
+
+    Parameter file: The file to write to
+    Precondition: file is a text file object open for writing
+    """
+    lock = threading.Lock()
+
+    def hook(record):
+        line = json.dumps(record)+'\n'
+        with lock:
+            file.write(line)
+    return hook
+
+
+# HELPER FUNCTIONS
+def _wrap(cls, names):
+    """
+    Replaces the given methods of cls with wrappers that measure them.
+
+    Only methods defined in cls itself are replaced, so a method inherited from
+    a class that is already wrapped is not measured twice.
+
+    Parameter cls: The class to wrap
+    Precondition: cls is Filter or a subclass of it
+
+    Parameter names: The method names
+    Precondition: names is a tuple of strings
+    """
+    for name in names:
+        if name in cls.__dict__:
+            method = cls.__dict__[name]
+            _originals.append((cls, name, method))
+            setattr(cls, name, _measured(name, method))
+
+
+def _measured(name, method):
+    """
+    Returns a wrapper for method that passes a record of each call to the hook.
+
+    Parameter name: The method name
+    Precondition: name is a string
+
+    Parameter method: The method to wrap
+    Precondition: method is a function taking an editor first
+    """
+    @functools.wraps(method)
+    def wrapper(editor, *args, **kwargs):
+        depth = getattr(_local, 'depth', 0)
+        memory = _memory and depth == 0 and tracemalloc.is_tracing()
+        history = _history_size(editor)
+        if memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        error = None
+        _local.depth = depth+1
+        stamp = time.time()
+        start = time.perf_counter()
+        try:
+            return method(editor, *args, **kwargs)
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            seconds = time.perf_counter()-start
+            _local.depth = depth
+            pixels = len(_image(editor))
+            record = {'op': name, 'class': type(editor).__name__, 'depth': depth,
+                      'start': stamp, 'seconds': seconds, 'pixels': pixels,
+                      'mpx_per_sec': pixels/seconds/1e6 if seconds > 0 else 0.0,
+                      'alloc_bytes': None, 'history_bytes': _history_size(editor)-history,
+                      'error': error}
+            if memory:
+                record['alloc_bytes'] = tracemalloc.get_traced_memory()[1]-base
+            hook = _hook
+            if hook is not None:
+                hook(record)
+    return wrapper
+
+
+def _image(editor):
+    """
+    Returns the image of editor, without applying any deferred filters.
+
+    Parameter editor: The editor to look at
+    Precondition: editor is a Filter
+    """
+    if isinstance(editor, a6filter._Proxy):
+        return editor.getCurrent()
+    return a6editor.Editor.getCurrent(editor)
+
+
+def _history_size(editor):
+    """
+    Returns the bytes used by the undo history of editor.
+
+    Parameter editor: The editor to look at
+    Precondition: editor is a Filter
+    """
+    edits = editor._edits
+    return 0 if edits is None else edits.getSize()
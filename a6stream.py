@@ -0,0 +1,274 @@
+"""
+Streaming filters for the imager application.
+
+This module applies filters to an image file without ever holding the whole
+image in memory.  The image is read a band of rows at a time, each band is
+passed through a chain of generators (one per filter), and the bands are
+written to the output file as they come out.  So the memory used is only a
+few bands, however tall the image is.
+
+Only filters that work on each row by itself can be streamed: the point filters
+(invert, monochromify, vignette and the tone curves) and jail.  They use the
+same kernels as Filter, so the results are exactly the same.  Filters that need
+the whole image, like transpose and the rotations, are rejected with a
+ValueError.  For those, open the file with a6tiled.TiledImage instead, which
+keeps only part of the image in memory.
+
+For example, to make an antique copy of a large scan:
+
+    streamFile('scan.ppm', 'antique.ppm', [('monochromify', True), 'vignette'])
+"""
+import a6filter
+import a6image
+import os
+
+# The filters that can be streamed
+STREAM_FILTERS = a6filter.KERNEL_FILTERS+('jail',)
+
+
+def readBands(path, rows=None, width=None):
+    """
+    Returns the tuple (width, height, bands) for the image in the given file.
+
+    The value bands is a generator of pairs (row, data), where data is the
+    packed pixels of the band of rows starting at row.  The file is read as
+    the generator is consumed, and closed when it is finished.
+
+    The file is either a binary PPM (P6) or PAM (P7) file with 8-bit RGB pixels,
+    or (if width is given) a headerless file of packed RGB pixels.  A ValueError
+    is raised if the header is bad, or (while reading) if the file is too short.
+
+    Parameter path: The file to read
+    Precondition: path is a string naming an existing file
+
+    Parameter rows: The number of rows per band (None for about BAND_PIXELS pixels)
+    Precondition: rows is None or an int > 0
+
+    Parameter width: The image width of a headerless file
+    Precondition: width is None or an int > 0
+    """
+    assert type(path) == str
+    assert rows is None or (type(rows) == int and rows > 0), repr(rows)
+    assert width is None or (type(width) == int and width > 0), repr(width)
+
+    file = open(path, 'rb')
+    try:
+        if width is None:
+            width, height, offset = a6image._parse_header(file.read(4096))
+        else:
+            offset = 0
+            height = os.path.getsize(path) // (3*width)
+    except:
+        file.close()
+        raise
+
+    if rows is None:
+        rows = max(1, a6filter.BAND_PIXELS // width)
+    return (width, height, _read_bands(file, offset, width, height, rows))
+
+
+def filterBands(bands, steps, width, height):
+    """
+    Returns a generator of the bands with the given filters applied.
+
+    The steps are given as for Filter.applyPipeline.  Each one becomes a
+    generator that takes bands from the one before it, so a band goes through
+    the whole chain before the next one is read.  All of the steps are checked
+    before any band is read.
+
+    This raises a ValueError if a step is not in STREAM_FILTERS.
+
+    Parameter bands: The bands to filter
+    Precondition: bands is an iterable of pairs (row, data) covering the image
+    in order (see readBands)
+
+    Parameter steps: The filters to apply, in order
+    Precondition: steps is a list of filter names or tuples of a name and the
+    arguments for that method
+
+    Parameter width: The image width
+    Precondition: width is an int > 0
+
+    Parameter height: The image height
+    Precondition: height is an int > 0
+    """
+    assert type(steps) == list
+    stages = []
+    for step in steps:
+        name, args = (step, ()) if type(step) == str else (step[0], tuple(step[1:]))
+        if name not in STREAM_FILTERS:
+            raise ValueError('%s needs the whole image and cannot be streamed '
+                             '(use a6tiled.TiledImage instead)' % name)
+        if name == 'jail':
+            assert len(args) == 0, repr(args)
+            stages.append(None)
+        else:
+            stages.append(a6filter.kernelStep(name, args))
+
+    for step in stages:
+        if step is None:
+            bands = _jail_stage(bands, width, height)
+        else:
+            bands = _kernel_stage(bands, step, width, height)
+    return bands
+
+
+def writeBands(path, width, height, bands, format='ppm'):
+    """
+    Writes the bands of an image to the given file.
+
+    The file is written under a temporary name and then renamed, so it is safe
+    to write over the file the bands are read from.  The format is as for
+    Image.saveRaw.
+
+    Parameter path: The file to write
+    Precondition: path is a string
+
+    Parameter width: The image width
+    Precondition: width is an int > 0
+
+    Parameter height: The image height
+    Precondition: height is an int > 0
+
+    Parameter bands: The bands to write
+    Precondition: bands is an iterable of pairs (row, data) covering the image
+    in order (see readBands)
+
+    Parameter format: The file format
+    Precondition: format is one of 'ppm', 'pam' or 'raw'
+    """
+    assert type(path) == str
+    assert format in ('ppm', 'pam', 'raw')
+
+    temp = path+'.tmp'
+    try:
+        with open(temp, 'wb') as file:
+            file.write(a6image._make_header(width, height, format))
+            total = 0
+            for (row, data) in bands:
+                assert row*width == total, 'bands are out of order'
+                file.write(data)
+                total += len(data)//3
+            assert total == width*height, 'bands do not cover the image'
+        os.replace(temp, path)
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def streamFile(source, target, steps, format='ppm', rows=None):
+    """
+    Applies the filters in steps to the image in source, writing it to target.
+
+    See readBands, filterBands and writeBands for details.  This raises a
+    ValueError if a step cannot be streamed or the file is not a valid image.
+
+    Parameter source: The image file to read
+    Precondition: source is a string naming an existing PPM or PAM file
+
+    Parameter target: The file to write
+    Precondition: target is a string
+
+    Parameter steps: The filters to apply, in order
+    Precondition: steps is a list of steps as for Filter.applyPipeline
+
+    Parameter format: The output file format
+    Precondition: format is one of 'ppm', 'pam' or 'raw'
+
+    Parameter rows: The number of rows per band (None for about BAND_PIXELS pixels)
+    Precondition: rows is None or an int > 0
+    """
+    width, height, bands = readBands(source, rows)
+    try:
+        writeBands(target, width, height, filterBands(bands, steps, width, height), format)
+    finally:
+        bands.close()
+
+
+# HELPER FUNCTIONS
+def _read_bands(file, offset, width, height, rows):
+    """
+    Yields the bands of rows of the image in file, closing it at the end.
+
+    Parameter file: The open file
+    Precondition: file is a binary file object
+
+    Parameter offset: The position of the first pixel in the file
+    Precondition: offset is an int >= 0
+
+    Parameter width: The image width
+    Precondition: width is an int > 0
+
+    Parameter height: The image height
+    Precondition: height is an int >= 0
+
+    Parameter rows: The number of rows per band
+    Precondition: rows is an int > 0
+    """
+    with file:
+        file.seek(offset)
+        for row in range(0, height, rows):
+            size = 3*width*min(rows, height-row)
+            data = file.read(size)
+            if len(data) < size:
+                raise ValueError('file is shorter than its header says')
+            yield (row, data)
+
+
+def _kernel_stage(bands, step, width, height):
+    """
+    Yields the bands with the kernel for step applied to each one.
+
+    The vignette factors are computed for each band as it goes by, instead of
+    taking the mask for the whole image from the cache.
+
+    Parameter bands: The bands to filter
+    Precondition: bands is an iterable of pairs (row, data)
+
+    Parameter step: The kernel step to apply
+    Precondition: step is a kernel step (see a6filter.kernelStep)
+
+    Parameter width: The image width
+    Precondition: width is an int > 0
+
+    Parameter height: The image height
+    Precondition: height is an int > 0
+    """
+    name, args = step
+    kernel = a6filter.getKernel(name)
+    fixed  = a6filter.VIGNETTE_MASKS.isFixed()
+    for (row, data) in bands:
+        if name == 'vignette':
+            stop = row+len(data)//(3*width)
+            args = (a6filter._vignette_factors(width, height, row, stop, fixed), row)
+        yield (row, kernel(data, row, width, height, *args))
+
+
+def _jail_stage(bands, width, height):
+    """
+    Yields the bands with the bars drawn by Filter.jail added to them.
+
+    Parameter bands: The bands to filter
+    Precondition: bands is an iterable of pairs (row, data)
+
+    Parameter width: The image width
+    Precondition: width is an int >= 4
+
+    Parameter height: The image height
+    Precondition: height is an int >= 3
+    """
+    color   = bytes(a6filter.JAIL_COLOR)
+    line    = color*width
+    bar     = color*4
+    columns = a6filter._jail_columns(width)
+    for (row, data) in bands:
+        data = bytearray(data)
+        for pos in range(0, len(data), 3*width):    # Loop over the rows
+            current = row+pos//(3*width)
+            if current < 3 or current >= height-3:
+                data[pos:pos+3*width] = line
+                continue
+            for col in columns:
+                data[pos+3*col:pos+3*col+12] = bar
+        yield (row, data)
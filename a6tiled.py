@@ -0,0 +1,586 @@
+"""
+Out-of-core images for the imager application.
+
+This module contains a subclass of Image for images that are too large to fit in
+memory, such as panoramas and scans.  The pixels stay in a file on disk, and only
+a limited number of tiles are kept in memory at any time.  Since the class has the
+same interface as Image, the Filter and Encoder methods work on it unchanged.
+
+The tiles in memory are managed by a TileCache.  When the cache is over its memory
+budget, the least recently used tile is dropped (and written back to disk first if
+it was changed).  So the memory used by an image is bounded by the budget, no
+matter how large the image is.
+
+Copies are copy-on-write, as they are for Image: a copy reads its tiles from the
+image it was copied from until one of the two writes to them.  So copies (like
+the ones made by the undo history) cost disk space only for the tiles that change.
+"""
+import a6image
+import collections
+import itertools
+import os
+import tempfile
+import threading
+import weakref
+
+# The source of the version numbers of changed tiles
+_VERSIONS = itertools.count(1)
+
+# The default memory budget of a tile cache, in bytes
+DEFAULT_BUDGET = 64*1024*1024
+
+
+class TileCache(object):
+    """
+    A class that pages the tiles of an image in and out of a backing file.
+
+    An instance of this class stands in for the list of tiles in an Image.
+    Indexing it returns the tile as a bytearray, reading it from the backing
+    file if it is not already in memory.  The tiles in memory are kept in least
+    recently used order, and the oldest ones are dropped whenever the total size
+    goes over the budget.
+
+    A tile that has been changed is called dirty, and it is written back before
+    it is dropped.  If the backing file is read-only, dirty tiles are written
+    to a temporary spill file instead, so the original file is never changed.
+
+    A cache can also be a copy of another cache (its source).  A tile that the
+    copy has not stored in its own file yet is read from the source.  Before the
+    source changes a tile, it stores the old contents in each of its copies
+    that still read the tile from it.  Each tile has a version number, which
+    changes whenever the tile is about to be changed, so a copy and its source
+    can tell which tiles differ without comparing them.  A copy may be used in
+    a different thread from its source, as the jobs of Filter.submit are, since
+    they share a lock while tiles are passed between them.
+    """
+    # Attribute _file: The backing file
+    # Invariant: _file is an open binary file object
+    #
+    # Attribute _offset: The position of the first pixel in the backing file
+    # Invariant: _offset is an int >= 0
+    #
+    # Attribute _writable: Whether dirty tiles are written to the backing file
+    # Invariant: _writable is a bool
+    #
+    # Attribute _spill: The file holding dirty tiles of a read-only backing file
+    # Invariant: _spill is an open binary file object, or None if not needed yet
+    #
+    # Attribute _spilled: Which tiles have been written to the spill file
+    # Invariant: _spilled is a bytearray with one entry per tile
+    #
+    # Attribute _stored: Which tiles are held in the backing file
+    # Invariant: _stored is a bytearray with one entry per tile (all 1 unless
+    # this cache is a copy)
+    #
+    # Attribute _source: The cache that this cache is a copy of
+    # Invariant: _source is a TileCache, or None if this cache is not a copy.
+    # Tiles that are not stored, spilled or in memory are read from _source.
+    #
+    # Attribute _copies: The caches that are copies of this one
+    # Invariant: _copies is a WeakSet of TileCaches whose _source is this cache
+    #
+    # Attribute _versions: The version of each tile
+    # Invariant: _versions is a list of ints, one per tile.  A tile has the
+    # same version in a copy and its source exactly when neither has changed it
+    # since the copy was made.
+    #
+    # Attribute _lock: The lock held while tiles are passed between caches
+    # Invariant: _lock is an RLock shared by a cache, its source and its copies
+    #
+    # Attribute _length: The number of pixels in the image
+    # Invariant: _length is an int >= 0
+    #
+    # Attribute _resident: The tiles in memory, from least to most recently used
+    # Invariant: _resident is an OrderedDict mapping tile indices to bytearrays
+    #
+    # Attribute _size: The total number of bytes of the tiles in memory
+    # Invariant: _size is an int >= 0
+    #
+    # Attribute _dirty: The tiles in memory that have been changed
+    # Invariant: _dirty is a set of keys of _resident
+    #
+    # Attribute _owned: The owned flags of the image using this cache
+    # Invariant: _owned is a bytearray with one entry per tile, or None.  An
+    # entry is reset to 0 when its tile is dropped (see Image._detach).
+    #
+    # Attribute _budget: The maximum number of bytes of tiles in memory
+    # Invariant: _budget is an int >= 3*TILE_SIZE
+    #
+    # Attribute _hits: The number of tile requests found in memory
+    # Invariant: _hits is an int >= 0
+    #
+    # Attribute _misses: The number of tile requests read from disk
+    # Invariant: _misses is an int >= 0
+
+    def getBudget(self):
+        """
+        Returns the maximum number of bytes of tiles kept in memory
+        """
+        return self._budget
+
+    def setBudget(self, value):
+        """
+        Sets the maximum number of bytes of tiles kept in memory.
+
+        If the new budget is smaller, tiles are dropped right away to meet it.
+
+        Parameter value: The new budget
+        Precondition: value is an int >= 3*TILE_SIZE (enough for one tile)
+        """
+        assert type(value) == int and value >= 3*a6image.TILE_SIZE
+        self._budget = value
+        self._evict(0)
+
+    def getHits(self):
+        """
+        Returns the number of tile requests that were found in memory
+        """
+        return self._hits
+
+    def getMisses(self):
+        """
+        Returns the number of tile requests that had to be read from disk
+        """
+        return self._misses
+
+    def __init__(self, file, offset, length, budget=DEFAULT_BUDGET, writable=False,
+                 source=None):
+        """
+        Initializes a tile cache for the pixels stored in file.
+
+        If source is given, this cache is a copy of it, and file does not hold
+        any tiles yet.  Each tile is written to file the first time it has to
+        be kept apart from the source.
+
+        Parameter file: The backing file
+        Precondition: file is an open binary file; it must be open for writing
+        if writable is True
+
+        Parameter offset: The position of the first pixel in file
+        Precondition: offset is an int >= 0
+
+        Parameter length: The number of pixels in file
+        Precondition: length is an int >= 0
+
+        Parameter budget: The maximum number of bytes of tiles kept in memory
+        Precondition: budget is an int >= 3*TILE_SIZE
+
+        Parameter writable: Whether dirty tiles are written back to file
+        Precondition: writable is a bool (True if source is given)
+
+        Parameter source: The cache that this cache is a copy of
+        Precondition: source is None or a TileCache with length pixels
+        """
+        assert type(offset) == int and offset >= 0
+        assert type(length) == int and length >= 0
+        assert type(budget) == int and budget >= 3*a6image.TILE_SIZE
+        assert type(writable) == bool
+        assert source is None or (writable and source._length == length)
+
+        self._file     = file
+        self._offset   = offset
+        self._writable = writable
+        self._length   = length
+        self._spill    = None
+        self._spilled  = bytearray(len(self))
+        self._stored   = bytearray([source is None])*len(self)
+        self._source   = source
+        self._copies   = weakref.WeakSet()
+        if source is None:
+            self._lock     = threading.RLock()
+            self._versions = [0]*len(self)
+        else:
+            self._lock     = source._lock
+            with self._lock:
+                self._versions = source._versions[:]
+                source._copies.add(self)
+        self._resident = collections.OrderedDict()
+        self._size     = 0
+        self._dirty    = set()
+        self._owned    = None
+        self._budget   = budget
+        self._hits     = 0
+        self._misses   = 0
+
+    def __len__(self):
+        """
+        Returns the number of tiles
+        """
+        return -(-self._length // a6image.TILE_SIZE)
+
+    def __getitem__(self, index):
+        """
+        Returns the given tile as a bytearray, reading it from disk if necessary.
+
+        Parameter index: The tile index
+        Precondition: index is an int; an IndexError is raised if it is not
+        0 <= index < len(self) (so that the cache can be iterated over)
+        """
+        tile = self._resident.get(index)
+        if tile is not None:
+            self._hits += 1
+            self._resident.move_to_end(index)
+            return tile
+
+        if index < 0 or index >= len(self):
+            raise IndexError('tile index out of range')
+
+        self._misses += 1
+        size = self._tileBytes(index)
+        with self._lock:
+            self._evict(size)
+            tile = bytearray(self._read(index))
+            self._resident[index] = tile
+            self._size += size
+        return tile
+
+    def __setitem__(self, index, tile):
+        """
+        Replaces the given tile, marking it as dirty.
+
+        Parameter index: The tile index
+        Precondition: index is an int, 0 <= index < len(self)
+
+        Parameter tile: The new tile contents
+        Precondition: tile is a bytearray of the same size as the old tile
+        """
+        with self._lock:
+            self._change(index)
+            old = self._resident.pop(index, None)
+            if old is None:
+                self._evict(len(tile))
+            else:
+                self._size -= len(old)
+            self._resident[index] = tile
+            self._size += len(tile)
+            self._resident.move_to_end(index)
+            self._dirty.add(index)
+
+    def markDirty(self, index):
+        """
+        Records that the given tile (which is in memory) is about to be changed.
+
+        This must be called before the tile is changed, so that the copies of
+        this cache can keep the old contents.
+
+        Parameter index: The tile index
+        Precondition: index is the index of a tile in memory
+        """
+        assert index in self._resident
+        with self._lock:
+            self._change(index)
+            self._dirty.add(index)
+
+    def getVersion(self, index):
+        """
+        Returns the version of the given tile.
+
+        Parameter index: The tile index
+        Precondition: index is an int, 0 <= index < len(self)
+        """
+        return self._versions[index]
+
+    def flush(self):
+        """
+        Writes every dirty tile in memory back to disk.
+
+        The tiles stay in memory, but are no longer dirty.  They are no longer
+        owned by the image either, so its next write to one marks it dirty again.
+        """
+        with self._lock:
+            for index in sorted(self._dirty):
+                self._writeBack(index, self._resident[index])
+                if self._owned is not None:
+                    self._owned[index] = 0
+            self._dirty.clear()
+        if self._writable:
+            self._file.flush()
+
+    def close(self):
+        """
+        Flushes this cache and closes its files.
+
+        Any copies of this cache are given their own copies of the tiles that
+        they still read from it first.
+        """
+        with self._lock:
+            for copy in list(self._copies):
+                for index in range(len(self)):
+                    copy._keep(index, self)
+        self.flush()
+        self._resident.clear()
+        self._size = 0
+        self._file.close()
+        if self._spill is not None:
+            self._spill.close()
+
+    # HELPER METHODS
+    def _read(self, index):
+        """
+        Returns the contents of the given tile, without adding it to memory.
+
+        The caller must hold the lock, since the tile may come from the source.
+
+        Parameter index: The tile index
+        Precondition: index is an int, 0 <= index < len(self)
+        """
+        tile = self._resident.get(index)
+        if tile is not None:
+            return bytes(tile)
+        size = self._tileBytes(index)
+        if self._spilled[index]:
+            return os.pread(self._spill.fileno(), size, index*3*a6image.TILE_SIZE)
+        if self._stored[index]:
+            return os.pread(self._file.fileno(), size, self._position(index))
+        return self._source._read(index)
+
+    def _change(self, index):
+        """
+        Prepares the given tile to be changed.
+
+        The copies that still read the tile from this cache are given the old
+        contents, and the tile gets a new version.  The caller must hold the lock.
+
+        Parameter index: The tile index
+        Precondition: index is an int, 0 <= index < len(self)
+        """
+        for copy in list(self._copies):
+            copy._keep(index, self)
+        self._versions[index] = next(_VERSIONS)
+
+    def _keep(self, index, source):
+        """
+        Stores the given tile in this cache if it still reads it from source.
+
+        The caller must hold the lock.
+
+        Parameter index: The tile index
+        Precondition: index is an int, 0 <= index < len(self)
+
+        Parameter source: The source of this cache
+        Precondition: source is a TileCache
+        """
+        if self._source is not source or self._stored[index] or index in self._dirty:
+            return
+        os.pwrite(self._file.fileno(), source._read(index), self._position(index))
+        self._stored[index] = 1
+
+    def _tileBytes(self, index):
+        """
+        Returns the number of bytes in the given tile
+
+        Parameter index: The tile index
+        Precondition: index is an int, 0 <= index < len(self)
+        """
+        start = index*a6image.TILE_SIZE
+        return 3*(min(self._length, start+a6image.TILE_SIZE)-start)
+
+    def _position(self, index):
+        """
+        Returns the position of the given tile in the backing file
+
+        Parameter index: The tile index
+        Precondition: index is an int, 0 <= index < len(self)
+        """
+        return self._offset+index*3*a6image.TILE_SIZE
+
+    def _writeBack(self, index, tile):
+        """
+        Writes the given tile to disk (the backing file or the spill file).
+
+        Parameter index: The tile index
+        Precondition: index is an int, 0 <= index < len(self)
+
+        Parameter tile: The tile contents
+        Precondition: tile is a bytes-like object
+        """
+        if self._writable:
+            os.pwrite(self._file.fileno(), tile, self._position(index))
+            self._stored[index] = 1
+            return
+
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile()
+        os.pwrite(self._spill.fileno(), tile, index*3*a6image.TILE_SIZE)
+        self._spilled[index] = 1
+
+    def _evict(self, size):
+        """
+        Drops the least recently used tiles until size more bytes fit in the budget.
+
+        Dirty tiles are written back before they are dropped.  The caller must
+        hold the lock, so that no copy reads a tile while it is written back.
+
+        Parameter size: The number of bytes about to be added
+        Precondition: size is an int >= 0
+        """
+        resident = self._resident
+        while resident and self._size+size > self._budget:
+            index, tile = resident.popitem(last=False)
+            if index in self._dirty:
+                self._writeBack(index, tile)
+                self._dirty.discard(index)
+            if self._owned is not None:
+                self._owned[index] = 0
+            self._size -= len(tile)
+
+
+class TiledImage(a6image.Image):
+    """
+    A class representing an image whose pixels are kept on disk.
+
+    This class supports every method of Image.  The difference is that the tiles
+    are loaded from a backing file on demand, through a TileCache with a fixed
+    memory budget.  Changed tiles are written back to the file when they are
+    dropped from memory, or when flush is called.
+
+    Copying a tiled image is copy-on-write (see TileCache), and the tiles that
+    have to be kept apart go to a new temporary file, so copies are also
+    out-of-core.  The method getData still returns every pixel as a list, so it
+    should not be used on very large images.
+    """
+    # Attribute _tiles: The tiles of the image
+    # Invariant: _tiles is a TileCache
+    #
+    # Attribute _owned: Which tiles are in memory and known to be dirty
+    # Invariant: _owned is a bytearray with one entry per tile, shared with the
+    # cache (which resets an entry when its tile is dropped)
+
+    @classmethod
+    def open(cls, path, width=None, budget=DEFAULT_BUDGET, writable=False):
+        """
+        Returns an out-of-core image for the pixels in the given file.
+
+        The file is a binary PPM or PAM file with 8-bit RGB pixels or (if width
+        is given) a headerless file of packed RGB pixels, as for Image.openMmap.
+
+        If writable is False, the file is never changed.  Changed tiles are
+        kept in a temporary spill file instead.
+
+        Parameter path: The file to open
+        Precondition: path is a string naming an existing file
+
+        Parameter width: The image width of a headerless file
+        Precondition: width is None or an int > 0 that evenly divides the
+        number of pixels in the file
+
+        Parameter budget: The maximum number of bytes of tiles kept in memory
+        Precondition: budget is an int >= 3*TILE_SIZE
+
+        Parameter writable: Whether changes should be written to the file
+        Precondition: writable is a bool
+        """
+        assert type(path) == str
+        assert width is None or (type(width) == int and width > 0)
+
+        file = open(path, 'r+b' if writable else 'rb')
+        if width is None:
+            width, height, offset = a6image._parse_header(os.pread(file.fileno(), 4096, 0))
+            length = width*height
+            if os.fstat(file.fileno()).st_size-offset < 3*length:
+                file.close()
+                raise ValueError('file is shorter than its header says')
+        else:
+            offset = 0
+            length = os.fstat(file.fileno()).st_size // 3
+            assert length % width == 0
+
+        return cls._fromCache(TileCache(file, offset, length, budget, writable), width)
+
+    def getCache(self):
+        """
+        Returns the tile cache of this image.
+
+        The cache can be used to change the memory budget, or to check the hit
+        and miss counts.
+        """
+        return self._tiles
+
+    def copy(self):
+        """
+        Returns a copy of this image object.
+
+        Nothing is copied at first.  The copy reads the tiles of this image
+        until one of the two images changes them, and then the old contents
+        are written to a new temporary file, which is deleted when the copy is
+        closed.  The copy has the same budget as this image.
+        """
+        # Our next write to each tile must go through _detach again
+        self._owned[:] = bytes(len(self._owned))
+        cache = TileCache(tempfile.TemporaryFile(), 0, len(self), self._tiles.getBudget(),
+                          True, self._tiles)
+        return TiledImage._fromCache(cache, self._width)
+
+    def getChangedTiles(self, other):
+        """
+        Returns the list of tiles that this image no longer shares with other.
+
+        If other is a copy of this image (or this image is a copy of other),
+        these are the tiles that either image has changed since the copy was
+        made.  They are found from the tile versions, without comparing the
+        tiles.  Every tile is listed if other is not a tiled image.
+
+        Parameter other: The image to compare with
+        Precondition: other is an Image with the same number of pixels
+        """
+        if not isinstance(other, TiledImage):
+            return super().getChangedTiles(other)
+        assert len(other) == len(self), repr(other)
+        mine   = self._tiles._versions
+        theirs = other._tiles._versions
+        return [index for index in range(len(mine)) if mine[index] != theirs[index]]
+
+    def flush(self):
+        """
+        Writes every changed tile in memory back to disk.
+        """
+        self._tiles.flush()
+
+    def close(self):
+        """
+        Writes back any changes and closes the backing file.
+
+        The image cannot be used after it is closed.
+        """
+        self._tiles.close()
+
+    # HELPER METHODS
+    @classmethod
+    def _fromCache(cls, cache, width):
+        """
+        Returns a new tiled image that uses the given cache for its tiles.
+
+        Parameter cache: The tile cache
+        Precondition: cache is a TileCache not used by any other image
+
+        Parameter width: The image width
+        Precondition: width is an int > 0 that evenly divides the number of
+        pixels in the cache
+        """
+        image = cls.__new__(cls)
+        image._tiles  = cache
+        image._owned  = bytearray(len(cache))
+        image._length = cache._length
+        image._mmap   = None
+        image._mapped  = None
+        image._sharers = None
+        cache._owned  = image._owned
+        image.setWidth(width)
+        return image
+
+    def _detach(self, index):
+        """
+        Returns tile index, after marking it as dirty.
+
+        Nothing is copied here.  The cache gives the old contents to any copies
+        that still share the tile (see TileCache.markDirty).  The tile stays
+        marked as owned (so that later writes are fast) until the cache drops
+        it from memory or this image is copied.
+
+        Parameter index: The tile index
+        Precondition: index is an int, 0 <= index < len(self._tiles)
+        """
+        tile = self._tiles[index]
+        self._tiles.markDirty(index)
+        self._owned[index] = 1
+        return tile
@@ -0,0 +1,227 @@
+"""
+Vectorized versions of the point filters for the imager application.
+
+This module contains NumPy versions of the kernels for the Filter methods invert,
+monochromify and vignette (see a6filter for what a kernel is).  Instead of looping
+over the pixels in Python, they turn the band of rows into an array and do the
+arithmetic on whole arrays.  Filter uses them automatically whenever NumPy can be
+imported.  If it cannot, Filter uses the pure-Python kernels in a6filter.  There
+is no version of the tone curve kernel, as bytes.translate is already a C loop
+that is faster than NumPy indexing, so Filter always uses the one in a6filter.  The
+same goes for the functions that Encoder uses to hide and read messages 
+(embedDigits, extractDigits, embedBits and extractBits).
+
+The results are exactly the same as the pure-Python versions.  All of the
+arithmetic is done on float64 arrays in the same order as the Python code, and
+int() is replaced by truncation of non-negative values, which is the same thing.
+The one exception is the vignette factor, which uses ** (the C library pow) in
+Python.  NumPy computes powers with sqrt and multiplication (or its own SIMD
+code), which can differ in the last bit, and truncation can turn that into an
+off-by-one pixel value.  So the vignette kernel uses the factors from the mask
+cache in a6filter, which are computed with Python floats, and only the
+multiplication by the pixels is vectorized.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Whether Filter should use this module
+_enabled = numpy is not None
+
+
+def isAvailable():
+    """
+    Returns True if NumPy could be imported, False otherwise.
+    """
+    return numpy is not None
+
+
+def isEnabled():
+    """
+    Returns True if Filter should use the vectorized filters, False otherwise.
+
+    This is True by default whenever NumPy is available.
+    """
+    return _enabled
+
+
+def setEnabled(value):
+    """
+    Sets whether Filter should use the vectorized filters.
+
+    Turning this off forces the pure-Python versions, which is useful for
+    comparing the two.  It cannot be turned on if NumPy is not available.
+
+    Parameter value: Whether to use the vectorized filters
+    Precondition: value is a bool, and value is False if NumPy is not available
+    """
+    global _enabled
+    assert type(value) == bool
+    assert not value or isAvailable()
+    _enabled = value
+
+
+def invert(data, row, width, height):
+    """
+    Returns the color complement of the pixels in data.
+
+    This is a kernel for Filter.invert (see a6filter for the parameters).
+    """
+    return (255-_array(data)).tobytes()
+
+
+def monochromify(data, row, width, height, sepia):
+    """
+    Returns the pixels in data converted to greyscale or sepia tone.
+
+    This is a kernel for Filter.monochromify (see a6filter for the parameters).
+
+    Parameter sepia: Whether to use sepia tone instead of greyscale.
+    Precondition: sepia is a bool
+    """
+    pixels = _array(data).reshape(-1, 3).astype(numpy.float64)
+    brightness = 0.3*pixels[:, 0] + 0.6*pixels[:, 1] + 0.1*pixels[:, 2]
+
+    result = numpy.empty(pixels.shape, numpy.uint8)
+    result[:, 0] = _truncate(brightness)
+    if sepia:
+        result[:, 1] = _truncate(0.6*brightness)
+        result[:, 2] = _truncate(0.4*brightness)
+    else:
+        result[:, 1] = result[:, 0]
+        result[:, 2] = result[:, 0]
+    return result.tobytes()
+
+
+def vignette(data, row, width, height, mask, first=0):
+    """
+    Returns the pixels in data darkened to simulate vignetting.
+
+    This is a kernel for Filter.vignette (see a6filter for the parameters).
+
+    Parameter mask: The falloff factors for rows first and below
+    Precondition: mask is an array of factors as for the a6filter kernel
+
+    Parameter first: The image row of the first factors in mask
+    Precondition: first is an int, 0 <= first <= row
+    """
+    rows    = len(data)//(3*width)
+    row     = row-first
+    pixels  = _array(data).reshape(rows, width, 3)
+    if mask.typecode == 'd':
+        factors = numpy.frombuffer(mask, numpy.float64)[row*width:(row+rows)*width]
+        result  = _truncate(pixels*factors.reshape(rows, width, 1))
+    else:
+        factors = numpy.frombuffer(mask, 'u%d' % mask.itemsize)[row*width:(row+rows)*width]
+        result  = (pixels*factors.reshape(rows, width, 1).astype(numpy.uint64)) >> 16
+    return result.astype(numpy.uint8).tobytes()
+
+
+def embedDigits(data, payload):
+    """
+    Returns the packed pixels in data with the bytes of payload hidden in them.
+
+    This is the vectorized version of a6encode._embed_digits.  Each byte is
+    split into its three decimal digits, which replace the last digits of the
+    red, green and blue channels of its pixel (going down 10 if that is over
+    255).
+
+    Parameter data: The packed pixels
+    Precondition: data is a bytes object with 3*len(payload) bytes
+
+    Parameter payload: The bytes to hide
+    Precondition: payload is a bytes object
+    """
+    values = numpy.frombuffer(payload, numpy.uint8).astype(numpy.int16)
+    digits = numpy.stack([values//100, values//10 % 10, values % 10], axis=1).ravel()
+    pixels = _array(data).astype(numpy.int16)
+    result = pixels-pixels % 10+digits
+    result[result > 255] -= 10
+    return result.astype(numpy.uint8).tobytes()
+
+
+def extractDigits(data):
+    """
+    Returns the bytes hidden in the packed pixels in data, or None if invalid.
+
+    This is the vectorized version of a6encode._extract_digits.  The last
+    decimal digits of the red, green and blue channels of each pixel make up
+    the value hidden in it.  If any value is over 255, this returns None.
+
+    Parameter data: The packed pixels
+    Precondition: data is a bytes object
+    """
+    digits = (_array(data) % 10).reshape(-1, 3).astype(numpy.int16)
+    values = digits[:, 0]*100+digits[:, 1]*10+digits[:, 2]
+    if len(values) > 0 and values.max() > 255:
+        return None
+    return values.astype(numpy.uint8).tobytes()
+
+
+def embedBits(data, payload, bits):
+    """
+    Returns the channels in data with the bits of payload packed into them.
+
+    This is the vectorized version of a6encode._embed_bits.  The bits of the
+    payload are unpacked (highest first), padded with zeros to a multiple of
+    bits, and each group replaces the low bits of one channel.
+
+    Parameter data: The channels to change
+    Precondition: data is a bytes object with one byte for each group of bits
+
+    Parameter payload: The bytes to hide
+    Precondition: payload is a bytes object
+
+    Parameter bits: The number of low bits of each channel to use
+    Precondition: bits is an int, 1 <= bits <= 4
+    """
+    stream  = numpy.unpackbits(_array(payload))
+    stream  = numpy.concatenate([stream, numpy.zeros(-len(stream) % bits, numpy.uint8)])
+    weights = (1 << numpy.arange(bits-1, -1, -1)).astype(numpy.uint8)
+    groups  = (stream.reshape(-1, bits)*weights).sum(axis=1).astype(numpy.uint8)
+    mask    = numpy.uint8(255 ^ ((1 << bits)-1))
+    return ((_array(data) & mask) | groups).tobytes()
+
+
+def extractBits(data, length, bits):
+    """
+    Returns the bytes packed into the low bits of the channels in data.
+
+    This is the vectorized version of a6encode._extract_bits.
+
+    Parameter data: The channels to read
+    Precondition: data is a bytes object with one byte for each group of bits
+
+    Parameter length: The number of bytes packed into data
+    Precondition: length is an int >= 0
+
+    Parameter bits: The number of low bits of each channel used
+    Precondition: bits is an int, 1 <= bits <= 4
+    """
+    shifts = numpy.arange(bits-1, -1, -1, dtype=numpy.uint8)
+    stream = (_array(data)[:, None] >> shifts) & 1
+    return numpy.packbits(stream.ravel()[:8*length]).tobytes()
+
+
+# HELPER FUNCTIONS
+def _array(data):
+    """
+    Returns the packed pixels in data as a flat uint8 array.
+
+    Parameter data: The packed pixels
+    Precondition: data is a bytes-like object
+    """
+    return numpy.frombuffer(data, numpy.uint8)
+
+
+def _truncate(data):
+    """
+    Returns the array data converted to uint8, rounding toward zero.
+
+    This is the same as calling int() on each (non-negative) element.
+
+    Parameter data: The values to convert
+    Precondition: data is a float array with values in 0..255.99...
+    """
+    return numpy.trunc(data).astype(numpy.uint8)
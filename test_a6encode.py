@@ -0,0 +1,231 @@
+"""
+Behavior tests for the message format of a6encode.
+
+The pixels written by encode are checked against the baseline encoding: each
+byte of the header and the message hidden in one pixel by _encode_pixel, one
+pixel at a time.  Messages must decode to the same text, and images without a
+header (the legacy format, which ends with a terminator) must still decode.
+The images include channels near 255, where a digit has to go down instead.
+
+Messages packed into the low bits of each channel (see Encoder.setBits) are
+checked against a bit-by-bit packing of the message, for each number of bits.
+
+The tests are skipped if a6editor (which a6filter needs) is not installed.
+Run them with
+
+    python -m pytest test_a6encode.py
+"""
+import pytest
+
+pytest.importorskip('a6editor')
+
+import a6encode
+import a6image
+import random
+
+# The image size (width, height)
+WIDTH  = 31
+HEIGHT = 17
+
+# The messages to hide
+MESSAGES = ['', 'a', 'hello world', 'café \U0001f600', 'x'*150]
+
+
+def make_encoder(seed):
+    """
+    Returns an encoder for an image of random pixels, some near 255.
+
+    Parameter seed: The random seed
+    Precondition: seed is an int
+    """
+    rand   = random.Random(seed)
+    values = list(range(246, 256))+[rand.randrange(256) for _ in range(50)]
+    data   = bytes(rand.choice(values) for _ in range(3*WIDTH*HEIGHT))
+    return a6encode.Encoder(a6image.Image.fromBytes(data, WIDTH))
+
+
+def pixels(encoder):
+    """
+    Returns the packed pixels of the current image of encoder.
+
+    Parameter encoder: The encoder to read
+    Precondition: encoder is an Encoder
+    """
+    image = encoder.getCurrent()
+    return image.region(0, 0, image.getHeight(), image.getWidth()).read()
+
+
+def baseline(encoder, payload):
+    """
+    Hides payload in encoder one pixel at a time, with _encode_pixel.
+
+    Parameter encoder: The encoder to change
+    Precondition: encoder is an Encoder with at least len(payload) pixels
+
+    Parameter payload: The bytes to hide
+    Precondition: payload is a bytes object
+    """
+    for (pos, value) in enumerate(payload):
+        encoder._encode_pixel(pos, value)
+
+
+def pack(encoder, payload, bits, start):
+    """
+    Packs payload into the low bits of the channels of encoder, one bit at a time.
+
+    The bits of payload (highest bit of each byte first) are split into groups
+    of the given size, which replace the low bits of each channel in turn, from
+    the first channel of pixel start.  The last group is padded with zeros.
+
+    Parameter encoder: The encoder to change
+    Precondition: encoder is an Encoder with room for the payload
+
+    Parameter payload: The bytes to hide
+    Precondition: payload is a bytes object
+
+    Parameter bits: The number of low bits of each channel to use
+    Precondition: bits is an int, 1 <= bits <= MAX_BITS
+
+    Parameter start: The first pixel to use
+    Precondition: start is an int >= 0
+    """
+    stream = [(byte >> (7-shift)) & 1 for byte in payload for shift in range(8)]
+    stream += [0]*(-len(stream) % bits)
+    current = encoder.getCurrent()
+    for group in range(len(stream)//bits):
+        low = 0
+        for bit in stream[group*bits:(group+1)*bits]:
+            low = 2*low+bit
+        pos, channel = divmod(group, 3)
+        rgb = list(current[start+pos])
+        rgb[channel] = rgb[channel] >> bits << bits | low
+        current[start+pos] = tuple(rgb)
+
+
+def header(length):
+    """
+    Returns the header for a message of the given length, as decimal digits.
+
+    Parameter length: The number of bytes in the message
+    Precondition: length is an int, 0 <= length <= 999999
+    """
+    return (a6encode.MARKER+bytes([a6encode.HEADER_TAG, a6encode.VERSION])+
+            length.to_bytes(a6encode.LENGTH_BYTES, 'big'))
+
+
+@pytest.mark.parametrize('text', MESSAGES)
+def test_matches_baseline(text):
+    encoder = make_encoder(len(text))
+    assert encoder.encode(text)
+    assert encoder.decode() == text
+
+    expected = make_encoder(len(text))
+    blist    = text.encode('utf-8')
+    baseline(expected, header(len(blist))+blist)
+    assert pixels(encoder) == pixels(expected)
+
+
+@pytest.mark.parametrize('text', MESSAGES)
+def test_legacy(text):
+    encoder = make_encoder(1)
+    baseline(encoder, a6encode.MARKER+text.encode('utf-8')+a6encode.TERMINATOR)
+    assert encoder.decode() == text
+
+
+def test_legacy_unterminated():
+    encoder = make_encoder(2)
+    baseline(encoder, a6encode.MARKER+b'no end')
+    assert encoder.decode() is None
+
+
+def test_no_message():
+    encoder = make_encoder(3)
+    baseline(encoder, b'xyz')
+    assert encoder.decode() is None
+
+
+def test_bad_header():
+    for head in [a6encode.MARKER+bytes([a6encode.HEADER_TAG, 9, 0, 0, 1]),
+                 header(WIDTH*HEIGHT)]:
+        encoder = make_encoder(4)
+        baseline(encoder, head)
+        assert encoder.decode() is None
+
+
+def test_capacity():
+    limit = WIDTH*HEIGHT-a6encode.HEADER_SIZE
+    encoder = make_encoder(5)
+    before  = pixels(encoder)
+    assert not encoder.encode('x'*(limit+1))
+    assert pixels(encoder) == before
+    assert encoder.encode('x'*limit)
+    assert encoder.decode() == 'x'*limit
+    assert not encoder.encode('x'*1000000)
+
+
+def test_undo():
+    encoder = make_encoder(6)
+    before  = pixels(encoder)
+    encoder.increment()
+    assert encoder.encode('hello')
+    assert encoder.undo()
+    assert pixels(encoder) == before
+    assert encoder.decode() is None
+
+
+@pytest.mark.parametrize('bits', range(1, a6encode.MAX_BITS+1))
+@pytest.mark.parametrize('text', MESSAGES)
+def test_bits_matches_baseline(bits, text):
+    encoder = make_encoder(bits)
+    encoder.setBits(bits)
+    assert encoder.encode(text)
+    assert encoder.decode() == text
+
+    expected = make_encoder(bits)
+    blist    = text.encode('utf-8')
+    head     = (a6encode.MARKER+bytes([a6encode.HEADER_TAG, a6encode.BITS_VERSION, bits])+
+                len(blist).to_bytes(a6encode.LENGTH_BYTES, 'big'))
+    baseline(expected, head)
+    pack(expected, blist, bits, a6encode.BITS_HEADER_SIZE)
+    assert pixels(encoder) == pixels(expected)
+
+
+@pytest.mark.parametrize('bits', range(1, a6encode.MAX_BITS+1))
+def test_bits_capacity(bits):
+    limit = 3*bits*(WIDTH*HEIGHT-a6encode.BITS_HEADER_SIZE)//8
+    encoder = make_encoder(7)
+    encoder.setBits(bits)
+    before = pixels(encoder)
+    assert not encoder.encode('x'*(limit+1))
+    assert pixels(encoder) == before
+    assert encoder.encode('x'*limit)
+    assert encoder.decode() == 'x'*limit
+
+
+def test_bits_fewer_pixels():
+    text   = 'y'*300
+    before = pixels(make_encoder(8))
+    last   = []
+    for bits in [0, 4]:
+        encoder = make_encoder(8)
+        encoder.setBits(bits)
+        assert encoder.encode(text)
+        after = pixels(encoder)
+        last.append(max([pos for pos in range(len(after)) if after[pos] != before[pos]]))
+    assert last[1] < last[0]
+
+
+def test_bits_decoded_without_setting():
+    encoder = make_encoder(9)
+    encoder.setBits(3)
+    assert encoder.encode('hello')
+    encoder.setBits(0)
+    assert encoder.decode() == 'hello'
+
+
+def test_bits_bad_header():
+    for bits in [0, a6encode.MAX_BITS+1]:
+        encoder = make_encoder(10)
+        baseline(encoder, a6encode.MARKER+bytes([a6encode.HEADER_TAG, a6encode.BITS_VERSION,
+                                                 bits, 0, 0, 1]))
+        assert encoder.decode() is None
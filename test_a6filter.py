@@ -0,0 +1,141 @@
+"""
+Behavior tests for the deferred mode of a6filter.
+
+Each test applies the same filters to the same image twice: once at once (the
+eager mode), which is the reference, and once in deferred mode, where the
+filters are simplified before they are applied.  The results must be
+identical, byte for byte, both after the filters and after each undo.  The
+images are not square, so that a wrong transform cannot go unnoticed.
+
+The tests are skipped if a6editor (which a6filter needs) is not installed.
+Run them with
+
+    python -m pytest test_a6filter.py
+"""
+import pytest
+
+pytest.importorskip('a6editor')
+
+import a6filter
+import a6image
+import itertools
+import random
+
+# The transforms of the dihedral group
+TRANSFORMS = ['transpose', 'reflectHori', 'reflectVert', 'rotateLeft', 'rotateRight']
+
+# The filters to mix with them (name and arguments)
+FILTERS = TRANSFORMS+['invert', 'jail', 'vignette', ('monochromify', False),
+                      ('levels', 20, 230), ('posterize', 4), ('gamma', 1.5)]
+
+
+def make_data(width, height, seed):
+    """
+    Returns random packed pixels for an image.
+
+    Parameter width: The image width
+    Precondition: width is an int > 0
+
+    Parameter height: The image height
+    Precondition: height is an int > 0
+
+    Parameter seed: The random seed
+    Precondition: seed is an int
+    """
+    rand = random.Random(seed)
+    return bytes(rand.randrange(256) for _ in range(3*width*height))
+
+
+def pixels(editor):
+    """
+    Returns the width and packed pixels of the current image of editor.
+
+    Parameter editor: The editor to read
+    Precondition: editor is a Filter
+    """
+    image = editor.getCurrent()
+    return (image.getWidth(), image.region(0, 0, image.getHeight(), image.getWidth()).read())
+
+
+def apply(editor, op):
+    """
+    Applies a filter to editor.
+
+    Parameter editor: The editor to change
+    Precondition: editor is a Filter
+
+    Parameter op: The filter
+    Precondition: op is a method name or a tuple of a name and its arguments
+    """
+    if type(op) == str:
+        getattr(editor, op)()
+    else:
+        getattr(editor, op[0])(*op[1:])
+
+
+def plan_of(names):
+    """
+    Returns the deferred plan for the given filters.
+
+    Parameter names: The filters
+    Precondition: names is a list of transform names or 'invert'
+    """
+    return [(name, a6filter.kernelStep(name, ()) if name == 'invert' else None)
+            for name in names]
+
+
+def test_inverse_pairs():
+    for names in [['reflectHori', 'reflectHori'], ['rotateLeft', 'rotateRight'],
+                  ['transpose', 'transpose'], ['invert', 'invert'],
+                  ['rotateLeft', 'rotateLeft', 'rotateLeft', 'rotateLeft']]:
+        assert a6filter._simplify_plan(plan_of(names)) == [], names
+
+
+def test_dihedral_merged():
+    for count in range(1, 5):
+        for names in itertools.product(TRANSFORMS, repeat=count):
+            plan = a6filter._simplify_plan(plan_of(list(names)))
+            assert len(plan) <= 2, names
+            assert a6filter._dihedral_key([name for (name, step) in plan]) == \
+                   a6filter._dihedral_key(names), names
+
+
+def test_increment_not_merged():
+    plan = plan_of(['reflectHori'])+[('increment', None)]+plan_of(['reflectHori'])
+    assert a6filter._simplify_plan(plan) == plan
+
+
+def test_dihedral_pixels():
+    data = make_data(7, 4, 0)
+    for count in range(1, 4):
+        for names in itertools.product(TRANSFORMS, repeat=count):
+            eager = a6filter.Filter(a6image.Image.fromBytes(data, 7))
+            lazy  = a6filter.Filter(a6image.Image.fromBytes(data, 7))
+            lazy.setDeferred(True)
+            for name in names:
+                apply(eager, name)
+                apply(lazy, name)
+            assert pixels(lazy) == pixels(eager), names
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_deferred_matches_eager(seed):
+    rand = random.Random(seed)
+    data = make_data(13, 9, seed)
+    eager = a6filter.Filter(a6image.Image.fromBytes(data, 13))
+    lazy  = a6filter.Filter(a6image.Image.fromBytes(data, 13))
+    lazy.setDeferred(True)
+    for _ in range(30):
+        op = rand.choice(FILTERS+['increment', 'undo', 'show'])
+        if op == 'show':
+            assert pixels(lazy) == pixels(eager)
+        elif op in ('increment', 'undo'):
+            assert getattr(lazy, op)() == getattr(eager, op)()
+        else:
+            apply(eager, op)
+            apply(lazy, op)
+    assert pixels(lazy) == pixels(eager)
+    while eager.undo():
+        assert lazy.undo()
+        assert pixels(lazy) == pixels(eager)
+    assert not lazy.undo()
@@ -0,0 +1,174 @@
+"""
+Behavior tests for the compact undo history in a6history.
+
+Each test edits an image and keeps a full copy of it after every step, as the
+undo history did before it kept deltas.  Undoing each step must give back
+exactly that copy.  The tests also check how each step is stored: the names of
+the inverse filters, or the compressed XOR of only the tiles that changed.  The
+images span several tiles, so that a step can leave some of them alone.
+
+The tests are skipped if a6editor (which a6filter needs) is not installed.
+Run them with
+
+    python -m pytest test_a6history.py
+"""
+import pytest
+
+pytest.importorskip('a6editor')
+
+import a6filter
+import a6history
+import a6image
+import a6tiled
+import random
+
+# The image size (width, height), which is over two tiles
+WIDTH  = 97
+HEIGHT = 101
+
+# The filters to apply (name and arguments)
+FILTERS = ['invert', 'transpose', 'reflectHori', 'reflectVert', 'rotateLeft',
+           'rotateRight', 'jail', 'vignette', ('monochromify', True), ('posterize', 4)]
+
+
+def make_image(seed):
+    """
+    Returns an image of random pixels.
+
+    Parameter seed: The random seed
+    Precondition: seed is an int
+    """
+    rand = random.Random(seed)
+    data = bytes(rand.randrange(256) for _ in range(3*WIDTH*HEIGHT))
+    return a6image.Image.fromBytes(data, WIDTH)
+
+
+def pixels(image):
+    """
+    Returns the width and packed pixels of image.
+
+    Parameter image: The image to read
+    Precondition: image is an Image
+    """
+    return (image.getWidth(), image.region(0, 0, image.getHeight(), image.getWidth()).read())
+
+
+def apply(editor, op):
+    """
+    Applies a filter to editor.
+
+    Parameter editor: The editor to change
+    Precondition: editor is a Filter
+
+    Parameter op: The filter
+    Precondition: op is a method name or a tuple of a name and its arguments
+    """
+    if type(op) == str:
+        getattr(editor, op)()
+    else:
+        getattr(editor, op[0])(*op[1:])
+
+
+def last_step(editor):
+    """
+    Returns the most recent stored step of the history of editor.
+
+    Parameter editor: The editor to read
+    Precondition: editor is a Filter with at least one stored step
+    """
+    return editor._getEdits()._steps[-1][1]
+
+
+def test_inverse_step():
+    editor = a6filter.Filter(make_image(0))
+    editor.increment()
+    editor.invert()
+    editor.rotateLeft()
+    editor.increment()
+    step = last_step(editor)
+    assert step[0] == 'inverse'
+    assert set(step[1]) <= set(a6history.INVERTIBLE)
+    assert editor._getEdits().getSize() == a6history.STEP_BYTES
+
+
+def test_tile_step():
+    image  = make_image(1)
+    before = pixels(image)
+    editor = a6filter.Filter(image)
+    editor.increment()
+    editor.getCurrent().setPixel(HEIGHT-1, WIDTH-1, (1, 2, 3))
+    editor.increment()
+    step = last_step(editor)
+    assert step[0] == 'tiles'
+    assert list(step[2]) == [len(image)//a6image.TILE_SIZE]
+    assert editor._getEdits().getSize() < a6image.TILE_SIZE
+    assert editor.undo() and editor.undo()
+    assert pixels(editor.getCurrent()) == before
+
+
+def test_empty_step():
+    editor = a6filter.Filter(make_image(2))
+    editor.increment()
+    editor.increment()
+    assert last_step(editor) == ('inverse', [])
+    assert editor.undo() and editor.undo()
+    assert not editor.undo()
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_matches_snapshots(seed):
+    rand   = random.Random(seed)
+    editor = a6filter.Filter(make_image(seed))
+    states = [pixels(editor.getCurrent())]
+    for _ in range(12):
+        editor.increment()
+        for _ in range(rand.randrange(1, 3)):
+            apply(editor, rand.choice(FILTERS))
+        states.append(pixels(editor.getCurrent()))
+    while len(states) > 1:
+        assert pixels(editor.getCurrent()) == states.pop()
+        assert editor.undo()
+    assert pixels(editor.getCurrent()) == states.pop()
+    assert not editor.undo()
+
+
+def test_budget():
+    budget = 3*3*a6image.TILE_SIZE
+    editor = a6filter.Filter(make_image(3))
+    editor.setHistoryBudget(budget)
+    states = [pixels(editor.getCurrent())]
+    for _ in range(10):
+        editor.increment()
+        editor.vignette()
+        states.append(pixels(editor.getCurrent()))
+    editor.increment()
+    states.append(states[-1])
+
+    history = editor._getEdits()
+    assert history.getSize() <= budget
+    assert 0 < len(history) < len(states)-2
+    # The open step is undone too
+    for _ in range(len(history)+1):
+        assert pixels(editor.getCurrent()) == states.pop()
+        assert editor.undo()
+    assert pixels(editor.getCurrent()) == states.pop()
+    assert not editor.undo()
+
+
+def test_tiled(tmp_path):
+    path = str(tmp_path / 'image.ppm')
+    make_image(4).saveRaw(path)
+    image  = a6tiled.TiledImage.open(path)
+    before = pixels(image)
+    editor = a6filter.Filter(image)
+    editor.increment()
+    editor.getCurrent().setPixel(0, 0, (1, 2, 3))
+    editor.increment()
+    assert list(last_step(editor)[2]) == [0]
+    editor.increment()
+    editor.vignette()
+    editor.increment()
+    while editor.undo():
+        pass
+    assert pixels(editor.getCurrent()) == before
+    image.close()
@@ -0,0 +1,132 @@
+"""
+Parity tests for the vectorized filters in a6vector.
+
+Each test applies a filter to the same image twice: once with the pure-Python
+kernels in a6filter (a6vector.setEnabled(False)), which is the reference, and
+once with the NumPy kernels.  The results must be identical, byte for byte.
+The images include saturated channels (0 and 255) as well as random values.
+
+The tests are skipped if NumPy or a6editor (which a6filter needs) is not
+installed.  Run them with
+
+    python -m pytest test_a6vector.py
+"""
+import pytest
+
+numpy = pytest.importorskip('numpy')
+pytest.importorskip('a6editor')
+
+import a6filter
+import a6image
+import a6vector
+import random
+
+# The image sizes to test (width, height), including ones that are not square
+SIZES = [(1, 1), (7, 5), (64, 64), (129, 37)]
+
+
+@pytest.fixture(autouse=True)
+def restore():
+    """
+    Restores the backend and the vignette masks after each test.
+    """
+    enabled = a6vector.isEnabled()
+    masks = a6filter.VIGNETTE_MASKS
+    yield
+    a6vector.setEnabled(enabled)
+    a6filter.VIGNETTE_MASKS = masks
+
+
+def make_data(width, height, seed):
+    """
+    Returns random packed pixels for an image, with some channels saturated.
+
+    Parameter width: The image width
+    Precondition: width is an int > 0
+
+    Parameter height: The image height
+    Precondition: height is an int > 0
+
+    Parameter seed: The random seed
+    Precondition: seed is an int
+    """
+    rand = random.Random(seed)
+    values = [0, 255, 254, 1]+[rand.randrange(256) for _ in range(252)]
+    data = bytearray(rand.choice(values) for _ in range(3*width*height))
+    data[0:3] = b'\xff\xff\xff'
+    data[-3:] = b'\x00\x00\x00'
+    return bytes(data)
+
+
+def run(data, width, vector, name, *args):
+    """
+    Returns the packed pixels after applying a filter to an image of data.
+
+    Parameter data: The packed pixels
+    Precondition: data is a bytes object
+
+    Parameter width: The image width
+    Precondition: width is an int > 0 that evenly divides len(data)//3
+
+    Parameter vector: Whether to use the NumPy kernels
+    Precondition: vector is a bool
+
+    Parameter name: The filter method name
+    Precondition: name is in a6filter.KERNEL_FILTERS
+
+    Parameter args: The arguments to the filter method
+    Precondition: args are valid for that method
+    """
+    a6vector.setEnabled(vector)
+    editor = a6filter.Filter(a6image.Image.fromBytes(data, width))
+    getattr(editor, name)(*args)
+    image = editor.getCurrent()
+    return image.region(0, 0, image.getHeight(), image.getWidth()).read()
+
+
+def check(name, *args, seed=0):
+    """
+    Checks that the NumPy and pure-Python versions of a filter agree.
+
+    Parameter name: The filter method name
+    Precondition: name is in a6filter.KERNEL_FILTERS
+
+    Parameter args: The arguments to the filter method
+    Precondition: args are valid for that method
+
+    Parameter seed: The random seed for the images
+    Precondition: seed is an int
+    """
+    for (width, height) in SIZES:
+        data = make_data(width, height, seed+width*height)
+        expected = run(data, width, False, name, *args)
+        assert run(data, width, True, name, *args) == expected, (name, width, height)
+
+
+def test_invert():
+    check('invert')
+
+
+@pytest.mark.parametrize('sepia', [False, True])
+def test_monochromify(sepia):
+    check('monochromify', sepia)
+
+
+@pytest.mark.parametrize('fixed', [False, True])
+def test_vignette(fixed):
+    a6filter.VIGNETTE_MASKS = a6filter.MaskCache(fixed=fixed)
+    check('vignette')
+
+
+@pytest.mark.parametrize('fixed', [False, True])
+def test_vignette_bands(fixed, monkeypatch):
+    # Small bands, so that each band starts part way down the mask
+    monkeypatch.setattr(a6filter, 'BAND_PIXELS', 100)
+    a6filter.VIGNETTE_MASKS = a6filter.MaskCache(fixed=fixed)
+    check('vignette', seed=1)
+
+
+def test_saturated():
+    data = b'\xff'*(3*16*16)
+    for name, args in [('invert', ()), ('monochromify', (True,)), ('vignette', ())]:
+        assert run(data, 16, True, name, *args) == run(data, 16, False, name, *args)